@@ -0,0 +1,230 @@
+import multiprocessing as mp
+from itertools import islice
+import pandas as pd
+from pymongo import MongoClient
+from lightweight_predictor import make_lightweight_predictions_v2, \
+    load_models_v2, predictions_frame
+from parallel_featurizer import split_ranges
+
+"""
+This module makes predictions on collections of tweets that are too large to
+hold in memory at once (i.e. a whole mongo collection)
+
+Tweets are pulled from any iterator a fixed size chunk at a time, each chunk
+is scored with make_lightweight_predictions_v2, and its predictions are
+appended to a csv file before the next chunk is read, so memory stays
+constant no matter how many tweets there are. The csv has the same columns
+and running index as writing the single dataframe of
+make_lightweight_predictions_v2 with to_csv
+
+predict_sharded scores one list of tweets across several processes: the
+models are loaded once in the parent, the workers are forked afterwards so
+they share the model memory copy-on-write and inherit the tweets instead of
+having them pickled over, every worker featurizes, scores and builds the
+dataframe of its own shards, and the shards are put back together in order.
+predict_in_chunks with n_workers forks one such pool up front and sends it
+the shards of every chunk, rather than forking a new pool per chunk
+
+Example:
+    n_tweets = predict_mongo_collection('spammytweets', 'freeiphone',
+                                        'pred_v2_freeiphone.csv',
+                                        n_workers=8)
+"""
+
+
+_worker_state = {}
+
+
+def iterate_chunks(tweet_iter, chunksize):
+    """
+    Args:
+        tweet_iter (iterable): any iterable of json tweet objects
+        chunksize (int): the number of tweets per chunk
+    Returns:
+        chunks (generator): yields lists of at most chunksize tweets
+    """
+    iterator = iter(tweet_iter)
+    while True:
+        chunk = list(islice(iterator, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _init_worker(tweet_list, kwargs):
+    """
+    Args:
+        tweet_list (list): the tweets to score
+        kwargs (dict): passed on to make_lightweight_predictions_v2
+    Returns:
+        nothing, keeps the tweets the worker inherited
+    """
+    _worker_state['tweet_list'] = tweet_list
+    _worker_state['kwargs'] = kwargs
+
+
+def _predict_shard(bounds):
+    """
+    Args:
+        bounds (tuple): the (start, stop) tweets of this shard
+    Returns:
+        predicted_tweets (dataframe): the predictions of the shard
+    """
+    start, stop = bounds
+    return _predict_tweets(_worker_state['tweet_list'][start:stop])
+
+
+def _predict_tweets(tweet_list):
+    """
+    Args:
+        tweet_list (list): the tweets of one shard, sent to the worker
+    Returns:
+        predicted_tweets (dataframe): the predictions of the shard
+    """
+    return make_lightweight_predictions_v2(tweet_list,
+                                           **_worker_state['kwargs'])
+
+
+def _check_worker_kwargs(kwargs):
+    """
+    Args:
+        kwargs (dict): passed on to make_lightweight_predictions_v2, n_jobs
+        is set to 1 unless given
+    Returns:
+        nothing, raises ValueError if a prediction cache is given
+    """
+    if kwargs.get('cache') is not None:
+        raise ValueError('the prediction cache cannot be shared between '
+                         'worker processes, score with a cache in one '
+                         'process instead')
+    kwargs.setdefault('n_jobs', 1)
+
+
+def _fork_pool(n_workers, tweet_list, kwargs):
+    """
+    Args:
+        n_workers (int): the number of worker processes
+        tweet_list (list): the tweets the workers inherit
+        kwargs (dict): passed on to make_lightweight_predictions_v2
+    Returns:
+        pool (Pool): worker processes forked after the models are loaded,
+        so that every worker shares them
+    """
+    load_models_v2(kwargs.get('flat', False))
+    try:
+        context = mp.get_context('fork')
+    except AttributeError:
+        context = mp
+    return context.Pool(n_workers, initializer=_init_worker,
+                        initargs=(tweet_list, kwargs))
+
+
+def predict_sharded(tweet_list, n_workers=None, shards_per_worker=4,
+                    **kwargs):
+    """
+    Args:
+        tweet_list (list): list of json tweet objects
+        n_workers (int): the number of worker processes, defaults to the
+        number of cpus
+        shards_per_worker (int): how many shards each worker gets, so that
+        a slow shard does not hold up the rest
+        **kwargs: passed on to make_lightweight_predictions_v2 (i.e. flat,
+        cascade_band, n_jobs), n_jobs defaults to 1 so that the workers do
+        not each start a thread per cpu
+    Returns:
+        predicted_tweets (dataframe): the same dataframe that
+        make_lightweight_predictions_v2 returns for the whole list
+    """
+    _check_worker_kwargs(kwargs)
+    n_workers = n_workers or mp.cpu_count()
+    ranges = split_ranges(len(tweet_list), n_workers * shards_per_worker)
+    if n_workers == 1 or len(ranges) <= 1:
+        return make_lightweight_predictions_v2(tweet_list, **kwargs)
+    pool = _fork_pool(n_workers, tweet_list, kwargs)
+    try:
+        shards = pool.map(_predict_shard, ranges, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return pd.concat(shards, ignore_index=True)
+
+
+def predict_in_chunks(tweet_iter, filename, chunksize=10000, verbose=False,
+                      n_workers=None, shards_per_worker=4, **kwargs):
+    """
+    Args:
+        tweet_iter (iterable): any iterable of json tweet objects
+        filename (str): the csv file to write the predictions to, it is
+        overwritten by the first chunk and appended to by the rest
+        chunksize (int): the number of tweets scored at a time
+        verbose (boolean): whether to print progress after every chunk
+        n_workers (int): if given, every chunk is split into shards that
+        are scored across this many worker processes, forked once before
+        the first chunk, see predict_sharded
+        shards_per_worker (int): how many shards of every chunk each worker
+        gets
+        **kwargs: passed on to make_lightweight_predictions_v2 (i.e. cache,
+        n_processes, flat, cascade_band)
+    Returns:
+        n_tweets (int): the number of tweets that were predicted, the csv
+        has its header even when there were none
+    """
+    pool = None
+    if n_workers is not None and n_workers > 1:
+        _check_worker_kwargs(kwargs)
+        pool = _fork_pool(n_workers, [], kwargs)
+    n_tweets = 0
+    try:
+        for chunk in iterate_chunks(tweet_iter, chunksize):
+            if pool is None:
+                predicted_tweets = make_lightweight_predictions_v2(chunk,
+                                                                   **kwargs)
+            else:
+                ranges = split_ranges(len(chunk),
+                                      n_workers * shards_per_worker)
+                shards = pool.map(_predict_tweets,
+                                  [chunk[start:stop]
+                                   for start, stop in ranges],
+                                  chunksize=1)
+                predicted_tweets = pd.concat(shards, ignore_index=True)
+            predicted_tweets.index += n_tweets
+            first_chunk = n_tweets == 0
+            predicted_tweets.to_csv(filename,
+                                    mode='w' if first_chunk else 'a',
+                                    header=first_chunk)
+            n_tweets += len(chunk)
+            if verbose:
+                print('predicted {} tweets'.format(n_tweets))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if n_tweets == 0:
+        predictions_frame([], []).to_csv(filename)
+    return n_tweets
+
+
+def predict_mongo_collection(dbname, collection, filename, chunksize=10000,
+                             verbose=False, n_workers=None, **kwargs):
+    """
+    Args:
+        dbname (str): the name of the mongo db to connect to
+        collection (str): the name of the collection in that db to predict
+        filename (str): the csv file to write the predictions to
+        chunksize (int): the number of tweets scored at a time
+        verbose (boolean): whether to print progress after every chunk
+        n_workers (int): the number of worker processes to score every chunk
+        with, see predict_sharded
+        **kwargs: passed on to make_lightweight_predictions_v2
+    Returns:
+        n_tweets (int): the number of tweets that were predicted, streamed
+        from the mongo cursor without loading the collection into memory
+    """
+    client = MongoClient()
+    cursor = client[dbname][collection].find(batch_size=chunksize)
+    try:
+        return predict_in_chunks(cursor, filename, chunksize=chunksize,
+                                 verbose=verbose, n_workers=n_workers,
+                                 **kwargs)
+    finally:
+        cursor.close()
@@ -9,21 +9,33 @@ import pandas as pd
 from evaltestcvbs import EvalTestCVBS as Eval
 import information_gain_ratio as igr
 from sklearn.grid_search import GridSearchCV
+from sklearn.base import clone
+from halving_search import SuccessiveHalvingSearch
+from oob_evaluation import OutOfBagSearch, oob_report
+from training_profiler import TrainingProfiler
 from sklearn.svm import SVC
 
 
-def evaluate_model(model, X_train, y_train):
+def evaluate_model(model, X_train, y_train, oob=False):
     '''
     INPUT
          - model: this is a classification model from sklearn
          - X_train: 2d array of the features
          - y_train: 1d array of the target
+         - oob: whether to use the out of bag estimates of a bootstrapped
+         forest instead of 10 fold cross validation
     OUTPUT
          - information about the model's accuracy using 10
-         fold cross validation
+         fold cross validation, or its out of bag accuracy and confusion
+         matrix
          - model: the fit model
     Returns the model
     '''
+    if oob:
+        report = oob_report(model, X_train, y_train)
+        print(report['accuracy'])
+        print(report['confusion_matrix'])
+        return report['model']
     print(np.mean(cross_val_score(model, X_train, y_train,
                                   cv=10, n_jobs=-1, verbose=10)))
     model.fit(X_train, y_train)
@@ -91,26 +103,46 @@ def view_feature_importances(df, model):
                                                    ascending=False))
 
 
-def gridsearch(paramgrid, model, X_train, y_train):
+def gridsearch(paramgrid, model, X_train, y_train, search='grid',
+               n_jobs=-1, random_state=None):
     '''
     INPUT
          - paramgrid: dictionary of lists containing parmeters and
          hypermarameters
          - X_train: 2d array of features
          - y_train: 1d array of class labels
+         - search: 'halving' for a successive halving search, 'oob' to
+         pick the forest with the best out of bag accuracy, or 'grid' for
+         the exhaustive ten fold grid search
+         - n_jobs: the number of cpus the whole search may use
+         - random_state: the seed of the folds and of the models of the
+         successive halving search, None keeps the seed of the model
     OUTPUT
          - best_model: a fit sklearn classifier with the best parameters
          - the gridsearch object
 
-    Performs grid search cross validation and
-    returns the best model and the gridsearch object
+    Performs a successive halving or grid search cross validation and
+    returns the best model and the gridsearch object, the model is fit
+    single threaded during the search so that the cpus are not
+    oversubscribed
     '''
-    gridsearch = GridSearchCV(model,
-                              paramgrid,
-                              n_jobs=-1,
-                              verbose=10,
-                              cv=10)
+    if search == 'halving':
+        gridsearch = SuccessiveHalvingSearch(model, paramgrid, n_jobs=n_jobs,
+                                             random_state=random_state,
+                                             verbose=10)
+    elif search == 'oob':
+        gridsearch = OutOfBagSearch(model, paramgrid, verbose=10)
+    else:
+        if 'n_jobs' in model.get_params():
+            model = clone(model).set_params(n_jobs=1)
+        gridsearch = GridSearchCV(model,
+                                  paramgrid,
+                                  n_jobs=n_jobs,
+                                  verbose=10,
+                                  cv=10)
     gridsearch.fit(X_train, y_train)
+    if search == 'grid' and 'n_jobs' in model.get_params():
+        gridsearch.best_estimator_.set_params(n_jobs=n_jobs)
     best_model = gridsearch.best_estimator_
     print('these are the parameters of the best model')
     print(best_model)
@@ -138,18 +170,23 @@ def get_igr_attribute_weights(X_train_b, y_train_b, df):
     return np.array(weights)
 
 if __name__ == "__main__":
-    df = pd.read_csv('data/training_df.csv')
-    df.drop('Unnamed: 0', axis=1, inplace=True)
-    user_id_array = df.pop('id')
-    y = df.pop('label')
-    y = y.values
-    X = df.values
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=.2)
-    X_train_b, y_train_b = balance_classes(RandomUnderSampler(),
-                                           X_train, y_train)
-    X_test_b, y_test_b = balance_classes(RandomUnderSampler(),
-                                         X_test, y_test)
-    weights = get_igr_attribute_weights(X_train_b, y_train_b, df)
+    profiler = TrainingProfiler()
+    with profiler.stage('loading'):
+        df = pd.read_csv('data/training_df.csv')
+        df.drop('Unnamed: 0', axis=1, inplace=True)
+        user_id_array = df.pop('id')
+        y = df.pop('label')
+        y = y.values
+        X = df.values
+    with profiler.stage('resampling'):
+        X_train, X_test, y_train, y_test = train_test_split(X, y,
+                                                            test_size=.2)
+        X_train_b, y_train_b = balance_classes(RandomUnderSampler(),
+                                               X_train, y_train)
+        X_test_b, y_test_b = balance_classes(RandomUnderSampler(),
+                                             X_test, y_test)
+    with profiler.stage('attribute_weights'):
+        weights = get_igr_attribute_weights(X_train_b, y_train_b, df)
     X_train_bw = X_train_b * weights
     # paramgrid = {'n_estimators': [1000],
     #              'loss': ['exponential'],
@@ -171,8 +208,11 @@ if __name__ == "__main__":
     # model = SVC(probability=True)
     model = RandomForestClassifier(n_jobs=-1)
     # model = GradientBoostingClassifier()
-    # model, gridsearch = gridsearch(paramgrid, model, X_train_bw, y_train_b)
-    model = evaluate_model(model, X_train_bw, y_train_b)
+    # with profiler.stage('gridsearch'):
+    #     model, gridsearch = gridsearch(paramgrid, model, X_train_bw,
+    #                                    y_train_b)
+    with profiler.stage('fitting'):
+        model = evaluate_model(model, X_train_bw, y_train_b)
     print("\nthis is the model performance on the training data\n")
     view_classification_report(model, X_train_b, y_train_b)
     confusion_matrix(y_train_b, model.predict(X_train_b))
@@ -181,9 +221,14 @@ if __name__ == "__main__":
     confusion_matrix(y_test_b, model.predict(X_test_b))
     print("this is the model performance on different split ratios\n")
     etcb = Eval(model, .05, .5, .05, 100)
-    etcb.evaluate_data(X_test_b, y_test_b)
+    with profiler.stage('split_ratio_evaluation'):
+        etcb.evaluate_data(X_test_b, y_test_b)
     etcb.plot_performance()
     # print("\nthese are the model feature importances\n")
     # view_feature_importances(df, model)
     print(model)
-    # write_model_to_pkl(model, 'tuned_gboostc')
+    # with profiler.stage('pickling'):
+    #     write_model_to_pkl(model, 'tuned_gboostc')
+    profiler.record_model('model', model)
+    profiler.summary()
+    profiler.write('models/classification_model_profile.json')
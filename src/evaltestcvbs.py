@@ -1,12 +1,26 @@
 import numpy as np
 import pandas as pd
 from sklearn.cross_validation import train_test_split
-from sklearn.metrics import precision_score, recall_score, confusion_matrix
 import matplotlib.pyplot as plt
 from sklearn.ensemble import RandomForestClassifier
 import dill as pickle
 
 
+def _safe_ratio(numerator, denominator):
+    '''
+    INPUT
+         - numerator: 1d array of counts
+         - denominator: 1d array of counts
+    OUTPUT
+         - 1d array of floats
+    Returns the ratios, which are 0 where the denominator is 0 like the
+    sklearn precision and recall scores
+    '''
+    denominator = np.asarray(denominator, dtype=float)
+    return np.where(denominator > 0, numerator /
+                    np.maximum(denominator, 1.), 0.)
+
+
 class EvalTestCVBS(object):
     '''
     this is a class that does random sampling from test data to solidify
@@ -19,7 +33,8 @@ class EvalTestCVBS(object):
     there are more 1 cases than 0 cases
     the natural distribution (ratio) of 1:0 is unknown and needs to be tested
     '''
-    def __init__(self, model, r_min, r_max, r_step, n_jobs):
+    def __init__(self, model, r_min, r_max, r_step, n_jobs,
+                 random_state=None):
         '''
         INPUT
              - model: this is an sklearn classification
@@ -30,7 +45,8 @@ class EvalTestCVBS(object):
              - r_step: this is the size of the step to take in checking
              different ratio percentages between r_min and r_max
              - n_jobs: this is the number of times that a sample will be drawn
-             and fit in order to get average classification performance values
+             in order to get average classification performance values
+             - random_state: int or None, the seed of the bootstrap draws
         this initializes the class, and this class assumes that the 1 class
         is an anomaly or fraud and it is larger than 0 (currently)
         '''
@@ -39,6 +55,7 @@ class EvalTestCVBS(object):
         self.r_max = r_max
         self.r_step = r_step
         self.n_jobs = n_jobs
+        self.random_state = random_state
 
     def evaluate_data(self, X_test, y_test):
         '''
@@ -55,13 +72,18 @@ class EvalTestCVBS(object):
         Returns the percent range over which the n_jobs evaluation was done,
         and this also has the classification report information in four
         lists for these different percent values over the percent range
+
+        the model predicts X_test only once, since a resample only repeats
+        rows of X_test, and every draw is a set of indices into whether
+        those predictions were right, so that the confusion counts of all
+        n_jobs draws of a percent are computed at once
         '''
-        X_pos = X_test[y_test == 1]
-        X_neg = X_test[y_test == 0]
-        y_pos = y_test[y_test == 1]
-        y_neg = y_test[y_test == 0]
-        n_pos_total = y_pos.shape[0]
-        n_neg_total = y_neg.shape[0]
+        rng = np.random.RandomState(self.random_state)
+        y_pred = self.model.predict(X_test)
+        pos_hit = y_pred[y_test == 1] == 1
+        neg_hit = y_pred[y_test == 0] == 0
+        n_pos_total = pos_hit.shape[0]
+        n_neg_total = neg_hit.shape[0]
         n_total = y_test.shape[0]
         self.percent_range = np.arange(self.r_min, self.r_max, self.r_step)
         self.avg_precision_0 = []
@@ -74,49 +96,29 @@ class EvalTestCVBS(object):
         self.std_recall_0 = []
         self.std_precision_1 = []
         self.std_recall_1 = []
-        print('total of {} prediction jobs'.
+        print('total of {} bootstrap draws'.
               format(self.percent_range.shape[0]*self.n_jobs))
         for percent in self.percent_range:
             print('currently evaluating split at {} percent'.format(percent))
             # n_draw = int((n_neg_total*percent)/(1-percent))
             n_draw_pos = int(n_total*percent)
             n_draw_neg = n_total - n_draw_pos
-            precision_0 = []
-            recall_0 = []
-            precision_1 = []
-            recall_1 = []
-            fpr_list = []
-            fnr_list = []
-            for i in xrange(self.n_jobs):
-                print('currently doing job {} for {} percent'.
-                      format(i+1, percent))
-                ix_draw_pos = np.random.choice(n_pos_total, n_draw_pos,
-                                               replace=True)
-                ix_draw_neg = np.random.choice(n_neg_total, n_draw_neg,
-                                               replace=True)
-                test_X = np.vstack((X_neg[ix_draw_neg],
-                                    X_pos[ix_draw_pos]))
-                test_y = np.hstack((np.zeros(n_draw_neg), np.ones(n_draw_pos)))
-                y_pred = self.model.predict(test_X)
-
-                precision_0.append(precision_score(test_y, y_pred,
-                                                   pos_label=0))
-                recall_0.append(recall_score(test_y, y_pred, pos_label=0))
-                precision_1.append(precision_score(test_y, y_pred,
-                                                   pos_label=1))
-                recall_1.append(recall_score(test_y, y_pred, pos_label=1))
-                fp = confusion_matrix(test_y, y_pred)[0, 1]
-                n = np.sum(confusion_matrix(test_y, y_pred)[0])
-                fn = confusion_matrix(test_y, y_pred)[1, 0]
-                p = np.sum(confusion_matrix(test_y, y_pred)[1])
-                fpr_list.append(float(fp)/n)
-                fnr_list.append(float(fn)/p)
+            tp = pos_hit[rng.randint(0, n_pos_total,
+                                     (self.n_jobs, n_draw_pos))].sum(axis=1)
+            tn = neg_hit[rng.randint(0, n_neg_total,
+                                     (self.n_jobs, n_draw_neg))].sum(axis=1)
+            fn = n_draw_pos - tp
+            fp = n_draw_neg - tn
+            precision_0 = _safe_ratio(tn, tn + fn)
+            recall_0 = _safe_ratio(tn, tn + fp)
+            precision_1 = _safe_ratio(tp, tp + fp)
+            recall_1 = _safe_ratio(tp, tp + fn)
             self.avg_precision_0.append(np.mean(precision_0))
             self.avg_recall_0.append(np.mean(recall_0))
             self.avg_precision_1.append(np.mean(precision_1))
             self.avg_recall_1.append(np.mean(recall_1))
-            self.avg_fpr.append(np.mean(fpr_list))
-            self.avg_fnr.append(np.mean(fnr_list))
+            self.avg_fpr.append(np.mean(_safe_ratio(fp, fp + tn)))
+            self.avg_fnr.append(np.mean(_safe_ratio(fn, fn + tp)))
             self.std_precision_0.append(np.std(precision_0, ddof=1))
             self.std_recall_0.append(np.std(recall_0, ddof=1))
             self.std_precision_1.append(np.std(precision_1, ddof=1))
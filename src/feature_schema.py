@@ -0,0 +1,195 @@
+import numpy as np
+
+"""
+This module declares the features used by the random forest ensemble so that
+the tweet featurizer, the three stages of the ensemble, and the training code
+all refer to the same columns by name instead of by position
+
+A schema describes the account history features (RF1), the behavior rate
+features (RF2) which are the account history features divided by the
+account age, and the stacked input of the ensemble model (RF3), which is
+the account history features, the behavior rate features, and the
+probabilities of RF1 and RF2.
+
+The stacked input is held in one preallocated float block, and the inputs of
+each stage are views into that block, so that the behavior rate features
+are written in place and the probabilities are dropped into their columns
+rather than concatenating new arrays at every stage
+
+Example:
+    block = V2_SCHEMA.allocate(n_tweets)
+    block.history[:] = tweet_history
+    block.fill_behavior_rates()
+    block.set_base_probas(y_pred, y_pred_b)
+    ensemble_model.predict(block.matrix)
+"""
+
+
+HISTORY_FEATURES = ['profile_use_background_image',
+                    'geo_enabled',
+                    'verified',
+                    'followers_count',
+                    'default_profile_image',
+                    'listed_count',
+                    'statuses_count',
+                    'friends_count',
+                    'favourites_count',
+                    'favorite_count',
+                    'num_hashtags',
+                    'num_mentions',
+                    'retweet_count',
+                    'account_age',
+                    'followers_friends',
+                    'has_30_followers',
+                    'favorited_by_another',
+                    'has_hashtagged',
+                    'has_mentions']
+
+RATIO_FEATURES = ['tweets_followers',
+                  'tweets_friends',
+                  'likes_followers',
+                  'likes_friends']
+
+TEXT_COLUMNS = ['id', 'text', 'screen_name']
+
+BASE_PROBA_COLUMNS = ['pred_model_1', 'pred_model_2']
+
+
+class FeatureSchema(object):
+    """
+    this is the declared layout of the features of one version of the
+    ensemble, it knows the position of every feature and the layout of the
+    stacked ensemble input
+    """
+    def __init__(self, features, rate_divisor='account_age'):
+        """
+        Args:
+            features (list): the names of the account history features, in
+            the order the history model expects them
+            rate_divisor (str): the feature that the behavior rate features
+            are computed per
+        Returns:
+            nothing, initializes the schema
+        """
+        self.features = list(features)
+        self.n_features = len(self.features)
+        self.rate_divisor = rate_divisor
+        self.divisor_ix = self.features.index(rate_divisor)
+        self.ensemble_columns = \
+            self.features + [feature+'_rate' for feature in self.features] + \
+            BASE_PROBA_COLUMNS
+        self.n_ensemble_columns = len(self.ensemble_columns)
+
+    def index(self, feature):
+        """
+        Args:
+            feature (str): the name of an account history feature
+        Returns:
+            ix (int): the column of that feature in the history matrix
+        """
+        return self.features.index(feature)
+
+    def check_columns(self, columns):
+        """
+        Args:
+            columns (list): the columns of a training dataframe, without
+            the label
+        Returns:
+            nothing, raises a ValueError if the columns do not match the
+            schema so that the models are never trained on drifted columns
+        """
+        columns = list(columns)
+        if columns != self.features:
+            missing = [col for col in self.features if col not in columns]
+            extra = [col for col in columns if col not in self.features]
+            raise ValueError('columns do not match the feature schema, '
+                             'missing: {}, unexpected: {}, or the order '
+                             'differs'.format(missing, extra))
+
+    def allocate(self, n_rows, dtype=float):
+        """
+        Args:
+            n_rows (int): the number of tweets or users
+            dtype (numpy dtype): the float type of the block
+        Returns:
+            block (EnsembleBlock): an empty block with room for the stacked
+            ensemble input of n_rows rows
+        """
+        return EnsembleBlock(self, np.empty((n_rows,
+                                             self.n_ensemble_columns),
+                                            dtype=dtype))
+
+    def block_from_history(self, X, dtype=float):
+        """
+        Args:
+            X (2d numpy array): an account history feature matrix
+            dtype (numpy dtype): the float type of the block
+        Returns:
+            block (EnsembleBlock): a block with the history features copied
+            in and the behavior rate features filled
+        """
+        block = self.allocate(X.shape[0], dtype=dtype)
+        block.history[:] = X
+        block.fill_behavior_rates()
+        return block
+
+
+class EnsembleBlock(object):
+    """
+    this is the preallocated stacked ensemble input, where the history,
+    behavior rate, and base model probability columns are views into
+    a single matrix
+    """
+    def __init__(self, schema, matrix):
+        """
+        Args:
+            schema (FeatureSchema): the layout of the matrix
+            matrix (2d numpy array): the stacked ensemble input
+        Returns:
+            nothing, initializes the views into the matrix
+        """
+        k = schema.n_features
+        self.schema = schema
+        self.matrix = matrix
+        self.history = matrix[:, :k]
+        self.behavior = matrix[:, k:2*k]
+        self.base_probas = matrix[:, 2*k:]
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def rows(self, start, stop):
+        """
+        Args:
+            start (int): the first row
+            stop (int): one past the last row
+        Returns:
+            block (EnsembleBlock): a block that is a view over those rows
+        """
+        return EnsembleBlock(self.schema, self.matrix[start:stop])
+
+    def fill_behavior_rates(self):
+        """
+        Args:
+            none
+        Returns:
+            nothing, writes the history features divided by the rate divisor
+            into the behavior rate columns in place
+        """
+        ix = self.schema.divisor_ix
+        np.divide(self.history, self.history[:, ix:ix+1], out=self.behavior)
+
+    def set_base_probas(self, y_pred, y_pred_b):
+        """
+        Args:
+            y_pred (1d numpy array): the output of the history model
+            y_pred_b (1d numpy array): the output of the behavior rate model
+        Returns:
+            nothing, writes the base model outputs into their columns
+        """
+        self.base_probas[:, 0] = y_pred
+        self.base_probas[:, 1] = y_pred_b
+
+
+V1_SCHEMA = FeatureSchema(HISTORY_FEATURES)
+V2_SCHEMA = FeatureSchema(HISTORY_FEATURES + RATIO_FEATURES)
@@ -0,0 +1,399 @@
+import os
+import time
+import numpy as np
+
+"""
+This module flattens the fit random forests of the ensemble into contiguous
+node arrays and evaluates them with vectorized numpy traversal, so that
+single tweets and small batches do not pay sklearn's per call overhead three
+times over
+
+Every tree of a forest is laid end to end in the same arrays (the feature
+each node splits on, its threshold, its two children, and the class
+probabilities of the node), and all the trees are walked for all the rows
+at once, one level per step. Leaves point to themselves so that rows that
+reach a leaf early simply stay there. Rows are cast to float32 and compared
+with the float64 thresholds, and the trees' probabilities are summed in
+tree order and then divided by the number of trees, exactly as sklearn
+does, so the probabilities are bit-identical to sklearn's when it evaluates
+the trees in order.
+
+The arrays of a flat forest are saved as plain .npy files, so they can be
+memory-mapped read only and shared between processes, which is not possible
+for sklearn's own trees
+
+Example:
+    flat = export_flat_ensemble(V2_MODELS, 'ensemble_rf_v2')
+    probas, pred = flat.score_block(block)
+"""
+
+
+class FlatForest(object):
+    """
+    this is a random forest classifier stored as flat node arrays
+    """
+    arrays = ('feature', 'threshold', 'left', 'right', 'value', 'roots',
+              'classes')
+
+    def __init__(self, feature, threshold, left, right, value, roots,
+                 classes, max_depth):
+        """
+        Args:
+            feature (1d numpy array): the feature each node splits on
+            threshold (1d numpy array): the split threshold of each node
+            left (1d numpy array): the left child of each node, leaves point
+            to themselves
+            right (1d numpy array): the right child of each node, leaves
+            point to themselves
+            value (2d numpy array): the normalized class probabilities of
+            each node
+            roots (1d numpy array): the root node of each tree
+            classes (1d numpy array): the class labels of the forest
+            max_depth (int): the depth of the deepest tree
+        Returns:
+            nothing, initializes the flat forest
+        """
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.roots = roots
+        self.classes = classes
+        self.max_depth = int(max_depth)
+
+    @classmethod
+    def from_forest(cls, forest, max_depth=None):
+        """
+        Args:
+            forest (RandomForestClassifier): a fit sklearn random forest
+            max_depth (int): optionally cut every tree off at this depth,
+            nodes at that depth become leaves with their own probabilities
+            and the nodes below them are dropped
+        Returns:
+            flat (FlatForest): the forest as flat node arrays
+        """
+        features, thresholds, lefts, rights, values, roots = \
+            [], [], [], [], [], []
+        offset = 0
+        deepest = 0
+        for estimator in forest.estimators_:
+            tree = estimator.tree_
+            left = tree.children_left.copy()
+            right = tree.children_right.copy()
+            feature = tree.feature
+            threshold = tree.threshold
+            value = tree.value[:, 0, :forest.n_classes_].copy()
+            if max_depth is not None:
+                depth = node_depths(left, right)
+                keep = depth <= max_depth
+                new_ix = np.cumsum(keep) - 1
+                left = np.where(depth < max_depth, left, -1)[keep]
+                right = np.where(depth < max_depth, right, -1)[keep]
+                left[left != -1] = new_ix[left[left != -1]]
+                right[right != -1] = new_ix[right[right != -1]]
+                feature = feature[keep]
+                threshold = threshold[keep]
+                value = value[keep]
+            n_nodes = left.shape[0]
+            ix = np.arange(n_nodes)
+            is_leaf = left == -1
+            feature = np.where(is_leaf, 0, feature)
+            left = np.where(is_leaf, ix, left) + offset
+            right = np.where(is_leaf, ix, right) + offset
+            normalizer = value.sum(axis=1)[:, np.newaxis]
+            normalizer[normalizer == 0.0] = 1.0
+            value /= normalizer
+            features.append(feature)
+            thresholds.append(threshold)
+            lefts.append(left)
+            rights.append(right)
+            values.append(value)
+            roots.append(offset)
+            deepest = max(deepest, tree.max_depth if max_depth is None
+                          else min(tree.max_depth, max_depth))
+            offset += n_nodes
+        return cls(np.concatenate(features).astype(np.intp),
+                   np.concatenate(thresholds).astype(np.float64),
+                   np.concatenate(lefts).astype(np.intp),
+                   np.concatenate(rights).astype(np.intp),
+                   np.vstack(values),
+                   np.array(roots, dtype=np.intp),
+                   forest.classes_.copy(),
+                   deepest)
+
+    @property
+    def classes_(self):
+        return self.classes
+
+    @property
+    def n_trees(self):
+        return self.roots.shape[0]
+
+    @property
+    def n_nodes(self):
+        return self.feature.shape[0]
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.arrays)
+
+    def apply(self, X):
+        """
+        Args:
+            X (2d numpy array): the feature matrix
+        Returns:
+            leaves (2d numpy array): the leaf each row reaches in each tree
+        """
+        X = np.asarray(X, dtype=np.float32)
+        rows = np.arange(X.shape[0])[:, np.newaxis]
+        node = np.tile(self.roots, (X.shape[0], 1))
+        for _ in range(self.max_depth):
+            go_left = X[rows, self.feature[node]] <= self.threshold[node]
+            node = np.where(go_left, self.left[node], self.right[node])
+        return node
+
+    def predict_proba(self, X, chunksize=4096):
+        """
+        Args:
+            X (2d numpy array): the feature matrix
+            chunksize (int): the number of rows walked at a time, which
+            bounds the memory of the rows by trees node matrix
+        Returns:
+            proba (2d numpy array): the class probabilities of each row
+        """
+        X = np.asarray(X)
+        proba = np.zeros((X.shape[0], self.value.shape[1]))
+        for start in range(0, X.shape[0], chunksize):
+            stop = start + chunksize
+            leaves = self.apply(X[start:stop])
+            chunk = proba[start:stop]
+            for tree in range(self.n_trees):
+                chunk += self.value[leaves[:, tree]]
+        proba /= self.n_trees
+        return proba
+
+    def predict(self, X):
+        """
+        Args:
+            X (2d numpy array): the feature matrix
+        Returns:
+            pred (1d numpy array): the predicted class of each row
+        """
+        return self.classes.take(np.argmax(self.predict_proba(X), axis=1))
+
+    def save(self, dirname, prefix=''):
+        """
+        Args:
+            dirname (str): the directory to write the arrays to
+            prefix (str): prepended to every array file name
+        Returns:
+            nothing, writes one .npy file per array
+        """
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        for name in self.arrays:
+            np.save(os.path.join(dirname, prefix + name + '.npy'),
+                    getattr(self, name))
+        np.save(os.path.join(dirname, prefix + 'max_depth.npy'),
+                np.array(self.max_depth))
+
+    @classmethod
+    def load(cls, dirname, prefix='', mmap_mode='r'):
+        """
+        Args:
+            dirname (str): the directory the arrays were written to
+            prefix (str): prepended to every array file name
+            mmap_mode (str): how the arrays are memory-mapped, or None to
+            read them fully into memory
+        Returns:
+            flat (FlatForest): the loaded flat forest
+        """
+        loaded = [np.load(os.path.join(dirname, prefix + name + '.npy'),
+                          mmap_mode=mmap_mode) for name in cls.arrays]
+        max_depth = np.load(os.path.join(dirname, prefix + 'max_depth.npy'))
+        return cls(*(loaded + [max_depth]))
+
+
+class FlatEnsemble(object):
+    """
+    this is the three stage random forest ensemble (history, behavior rate,
+    and the stacked ensemble model) as flat forests
+    """
+    stages = ('history', 'behavior', 'ensemble')
+
+    def __init__(self, history, behavior, ensemble):
+        """
+        Args:
+            history (FlatForest): the account history model
+            behavior (FlatForest): the behavior rate model
+            ensemble (FlatForest): the stacked ensemble model
+        Returns:
+            nothing, initializes the flat ensemble
+        """
+        self.history = history
+        self.behavior = behavior
+        self.ensemble = ensemble
+
+    @classmethod
+    def from_models(cls, history_model, behavior_model, ensemble_model,
+                    max_depth=None):
+        """
+        Args:
+            history_model (RandomForestClassifier): the fit history model
+            behavior_model (RandomForestClassifier): the fit behavior model
+            ensemble_model (RandomForestClassifier): the fit ensemble model
+            max_depth (int): optionally cut every tree off at this depth
+        Returns:
+            flat (FlatEnsemble): the three models as flat forests
+        """
+        return cls(FlatForest.from_forest(history_model, max_depth),
+                   FlatForest.from_forest(behavior_model, max_depth),
+                   FlatForest.from_forest(ensemble_model, max_depth))
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, stage).nbytes for stage in self.stages)
+
+    def score_block(self, block):
+        """
+        Args:
+            block (EnsembleBlock): the stacked ensemble input with the
+            account history features filled in, the behavior rate and base
+            model columns are filled in place
+        Returns:
+            probas (2d numpy array): one row per tweet with the probability of
+            being fake according to the history model, the behavior rate model,
+            and the ensemble model
+            pred (1d numpy array): the prediction of the ensemble model
+        """
+        block.fill_behavior_rates()
+        y_pred = self.history.predict_proba(block.history)[:, 1]
+        y_pred_b = self.behavior.predict_proba(block.behavior)[:, 1]
+        block.set_base_probas(y_pred, y_pred_b)
+        y_proba_ens = self.ensemble.predict_proba(block.matrix)
+        pred = self.ensemble.classes.take(np.argmax(y_proba_ens, axis=1))
+        probas = np.column_stack((y_pred, y_pred_b, y_proba_ens[:, 1]))
+        return probas, pred
+
+    def save(self, dirname):
+        """
+        Args:
+            dirname (str): the directory to write the arrays to
+        Returns:
+            nothing, writes the arrays of every stage
+        """
+        for stage in self.stages:
+            getattr(self, stage).save(dirname, prefix=stage + '_')
+
+    @classmethod
+    def load(cls, dirname, mmap_mode='r'):
+        """
+        Args:
+            dirname (str): the directory the arrays were written to
+            mmap_mode (str): how the arrays are memory-mapped
+        Returns:
+            flat (FlatEnsemble): the loaded flat ensemble
+        """
+        return cls(*[FlatForest.load(dirname, prefix=stage + '_',
+                                     mmap_mode=mmap_mode)
+                     for stage in cls.stages])
+
+
+def node_depths(children_left, children_right):
+    """
+    Args:
+        children_left (1d numpy array): the left child of each node, -1 for
+        leaves
+        children_right (1d numpy array): the right child of each node
+    Returns:
+        depth (1d numpy array): the depth of each node, the root being 0
+    """
+    depth = np.zeros(children_left.shape[0], dtype=int)
+    for node in range(children_left.shape[0]):
+        if children_left[node] != -1:
+            depth[children_left[node]] = depth[node] + 1
+            depth[children_right[node]] = depth[node] + 1
+    return depth
+
+
+def flat_dirname(name, model_dir='models'):
+    """
+    Args:
+        name (str): the name of the flat ensemble
+        model_dir (str): the directory the models are kept in
+    Returns:
+        dirname (str): the directory the flat ensemble is kept in
+    """
+    return os.path.join(model_dir, '{}_flat'.format(name))
+
+
+def export_flat_ensemble(model_names, name, registry=None,
+                         model_dir='models'):
+    """
+    Args:
+        model_names (tuple): the names of the history, behavior rate, and
+        ensemble models in the registry
+        name (str): the name to save the flat ensemble under
+        registry (ModelRegistry): where to get the fit models from
+        model_dir (str): the directory the models are kept in
+    Returns:
+        flat (FlatEnsemble): the exported flat ensemble, which is also
+        written to models/<name>_flat
+    """
+    if registry is None:
+        from model_registry import models as registry
+    flat = FlatEnsemble.from_models(*[registry.get(model_name)
+                                      for model_name in model_names])
+    flat.save(flat_dirname(name, model_dir))
+    return flat
+
+
+def benchmark_flat_ensemble(tweet_list, flat, score_block,
+                            batch_sizes=(1, 10, 100, 1000), n_repeats=5):
+    """
+    Args:
+        tweet_list (list): list of json tweet objects downloaded from twitter
+        flat (FlatEnsemble): the flat ensemble to benchmark
+        score_block (function): the sklearn scoring function to compare
+        against (i.e. lightweight_predictor.score_ensemble_block_v2)
+        batch_sizes (tuple): the batch sizes to time
+        n_repeats (int): how many times each batch is scored, the best time
+        is kept
+    Returns:
+        results (list): one dictionary per batch size with the best sklearn
+        and flat latency in seconds and whether the outputs are identical
+    """
+    from lightweight_predictor import featurize_tweets_v2
+    results = []
+    for batch_size in batch_sizes:
+        batch = tweet_list[:batch_size]
+        block = featurize_tweets_v2(batch)
+        timings = {}
+        outputs = {}
+        for engine, score in (('sklearn', score_block),
+                              ('flat', flat.score_block)):
+            best = np.inf
+            for _ in range(n_repeats):
+                start = time.time()
+                outputs[engine] = score(block)
+                best = min(best, time.time() - start)
+            timings[engine] = best
+        identical = \
+            np.array_equal(outputs['sklearn'][0], outputs['flat'][0]) and \
+            np.array_equal(outputs['sklearn'][1], outputs['flat'][1])
+        results.append({'batch_size': len(batch),
+                        'sklearn': timings['sklearn'],
+                        'flat': timings['flat'],
+                        'identical': identical})
+        print(results[-1])
+    return results
+
+
+if __name__ == "__main__":
+    import dill as pickle
+    from lightweight_predictor import V2_MODELS, score_ensemble_block_v2
+    with open('data/test_tweet_scrape.pkl', 'r+') as f:
+        tweet_list = pickle.load(f)
+    flat = export_flat_ensemble(V2_MODELS, 'ensemble_rf_v2')
+    benchmark_flat_ensemble(tweet_list, flat, score_ensemble_block_v2)
@@ -0,0 +1,231 @@
+import copy
+import time
+import numpy as np
+import pandas as pd
+import dill as pickle
+from feature_schema import V2_SCHEMA
+from flat_forest import FlatForest, FlatEnsemble, flat_dirname
+
+"""
+This module compresses the three stage random forest ensemble into a smaller
+ensemble, trading a little accuracy for lower latency and a smaller model
+
+For every stage the trees are ordered greedily: starting from no trees, the
+tree that most improves the accuracy of the growing forest on a selection set
+(ties broken by the mean probability given to the true class) is added next,
+so keeping the first k trees of the order gives the best k tree forest the
+greedy search could find. The stages are compressed in order, and the
+ensemble model is ordered on the outputs of the already compressed history
+and behavior rate models. Every tree can optionally be cut off at a maximum
+depth as well.
+
+compression_curve reports, for a range of sizes, the number of trees and
+nodes, the size of the pickled depth capped ensemble and of its flat
+arrays, the scoring latency, and the accuracy on a separate evaluation set,
+so a smaller deployable ensemble can be picked on purpose. The selection and
+evaluation sets should both be held out from training, which is why
+create_ensemble_model(compress=True) splits its held out test set in two.
+
+Example:
+    curve, ensembles = compression_curve(model, modelb, model_ens,
+                                         X_select, y_select, X_eval, y_eval)
+    save_compressed_ensemble(ensembles[(.25, None)], 'ensemble_rf_v2')
+"""
+
+
+COMPRESSION_FRACTIONS = (1., .5, .25, .1, .05)
+
+
+def tree_probas(forest, X):
+    """
+    Args:
+        forest (RandomForestClassifier): a fit sklearn random forest
+        X (2d numpy array): the feature matrix
+    Returns:
+        probas (3d numpy array): the class probabilities of every tree, with
+        shape (n_trees, n_rows, n_classes)
+    """
+    flat = FlatForest.from_forest(forest)
+    leaves = flat.apply(X)
+    return np.array([flat.value[leaves[:, tree]]
+                     for tree in range(flat.n_trees)])
+
+
+def greedy_tree_order(probas, y_ix, n_trees):
+    """
+    Args:
+        probas (3d numpy array): the output of tree_probas
+        y_ix (1d numpy array): the index of the true class of every row
+        n_trees (int): how many trees to order
+    Returns:
+        order (list): the indices of the chosen trees in the order they
+        were added
+    """
+    rows = np.arange(y_ix.shape[0])
+    remaining = list(range(probas.shape[0]))
+    total = np.zeros(probas.shape[1:])
+    order = []
+    for _ in range(min(n_trees, len(remaining))):
+        candidates = total[np.newaxis] + probas[remaining]
+        accuracy = np.mean(np.argmax(candidates, axis=2) == y_ix, axis=1)
+        true_proba = np.mean(candidates[:, rows, y_ix], axis=1)
+        best = np.lexsort((-true_proba, -accuracy))[0]
+        tree = remaining.pop(best)
+        order.append(tree)
+        total += probas[tree]
+    return order
+
+
+def subset_forest(forest, tree_ix):
+    """
+    Args:
+        forest (RandomForestClassifier): a fit sklearn random forest
+        tree_ix (list): the indices of the trees to keep
+    Returns:
+        forest (RandomForestClassifier): a shallow copy of the forest with
+        only those trees
+    """
+    subset = copy.copy(forest)
+    subset.estimators_ = [forest.estimators_[ix] for ix in tree_ix]
+    subset.n_estimators = len(tree_ix)
+    return subset
+
+
+def compress_stage(forest, X, y, fraction, order=None):
+    """
+    Args:
+        forest (RandomForestClassifier): a fit sklearn random forest
+        X (2d numpy array): the selection feature matrix
+        y (1d numpy array): the selection targets
+        fraction (float): the share of the trees to keep
+        order (list): a greedy order that was already computed for this
+        forest and selection set, if there is one
+    Returns:
+        subset (RandomForestClassifier): the forest with the greedily
+        chosen trees
+        order (list): the greedy order, to reuse for smaller fractions
+    """
+    n_keep = max(1, int(np.ceil(fraction * len(forest.estimators_))))
+    if n_keep >= len(forest.estimators_):
+        return forest, order
+    if order is None or len(order) < n_keep:
+        y_ix = np.searchsorted(forest.classes_, y)
+        order = greedy_tree_order(tree_probas(forest, X), y_ix, n_keep)
+    return subset_forest(forest, order[:n_keep]), order
+
+
+def compress_ensemble(model, modelb, model_ens, X, y, fraction,
+                      orders=None):
+    """
+    Args:
+        model (RandomForestClassifier): the fit history model
+        modelb (RandomForestClassifier): the fit behavior rate model
+        model_ens (RandomForestClassifier): the fit ensemble model
+        X (2d numpy array): the selection account history feature matrix
+        y (1d numpy array): the selection targets
+        fraction (float): the share of the trees of every stage to keep
+        orders (dict): greedy orders of the base models from larger
+        fractions, updated in place
+    Returns:
+        models (tuple): the compressed history, behavior rate, and ensemble
+        models
+    """
+    orders = {} if orders is None else orders
+    block = V2_SCHEMA.block_from_history(X)
+    model_c, orders['history'] = \
+        compress_stage(model, block.history, y, fraction,
+                       orders.get('history'))
+    modelb_c, orders['behavior'] = \
+        compress_stage(modelb, block.behavior, y, fraction,
+                       orders.get('behavior'))
+    block.set_base_probas(model_c.predict_proba(block.history)[:, 1],
+                          modelb_c.predict_proba(block.behavior)[:, 1])
+    model_ens_c, _ = compress_stage(model_ens, block.matrix, y, fraction)
+    return model_c, modelb_c, model_ens_c
+
+
+def measure_ensemble(flat, X, y, n_repeats=3):
+    """
+    Args:
+        flat (FlatEnsemble): the ensemble to measure
+        X (2d numpy array): the evaluation account history feature matrix
+        y (1d numpy array): the evaluation targets
+        n_repeats (int): how many times to time the scoring, the best time
+        is kept
+    Returns:
+        accuracy (float): the accuracy of the ensemble
+        latency (float): the best time in seconds to score all of X
+    """
+    latency = np.inf
+    for _ in range(n_repeats):
+        block = V2_SCHEMA.block_from_history(X)
+        start = time.time()
+        _, pred = flat.score_block(block)
+        latency = min(latency, time.time() - start)
+    return np.mean(pred == y), latency
+
+
+def compression_curve(model, modelb, model_ens, X_select, y_select,
+                      X_eval, y_eval, fractions=COMPRESSION_FRACTIONS,
+                      max_depths=(None,)):
+    """
+    Args:
+        model (RandomForestClassifier): the fit history model
+        modelb (RandomForestClassifier): the fit behavior rate model
+        model_ens (RandomForestClassifier): the fit ensemble model
+        X_select (2d numpy array): held out features to choose trees on
+        y_select (1d numpy array): the corresponding targets
+        X_eval (2d numpy array): held out features to measure accuracy on
+        y_eval (1d numpy array): the corresponding targets
+        fractions (tuple): the shares of the trees to keep
+        max_depths (tuple): the depths to cut the trees at, None keeps the
+        full depth
+    Returns:
+        curve (pandas dataframe): one row per fraction and depth with the
+        trees, nodes, pickled size, flat size, latency and accuracy
+        ensembles (dict): the compressed flat ensembles keyed by
+        (fraction, max_depth)
+    """
+    orders = {}
+    rows = []
+    ensembles = {}
+    for fraction in sorted(fractions, reverse=True):
+        compressed = compress_ensemble(model, modelb, model_ens,
+                                       X_select, y_select, fraction, orders)
+        for max_depth in max_depths:
+            flat = FlatEnsemble.from_models(*compressed, max_depth=max_depth)
+            # pickle the depth capped ensemble, the sklearn forests keep
+            # every node whatever the cap
+            pickled_size = len(pickle.dumps(flat))
+            accuracy, latency = measure_ensemble(flat, X_eval, y_eval)
+            ensembles[(fraction, max_depth)] = flat
+            rows.append({'fraction': fraction,
+                         'max_depth': max_depth,
+                         'n_trees': sum(stage.n_trees for stage in
+                                        (flat.history, flat.behavior,
+                                         flat.ensemble)),
+                         'n_nodes': sum(stage.n_nodes for stage in
+                                        (flat.history, flat.behavior,
+                                         flat.ensemble)),
+                         'pickled_bytes': pickled_size,
+                         'flat_bytes': flat.nbytes,
+                         'latency': latency,
+                         'accuracy': accuracy})
+    curve = pd.DataFrame(rows, columns=['fraction', 'max_depth', 'n_trees',
+                                        'n_nodes', 'pickled_bytes',
+                                        'flat_bytes', 'latency', 'accuracy'])
+    print(curve)
+    return curve, ensembles
+
+
+def save_compressed_ensemble(flat, name, model_dir='models'):
+    """
+    Args:
+        flat (FlatEnsemble): a compressed ensemble from compression_curve
+        name (str): the name to save it under, saving it as ensemble_rf_v2
+        makes it the flat ensemble that the predictor uses
+        model_dir (str): the directory the models are kept in
+    Returns:
+        nothing, writes the flat ensemble to models/<name>_flat
+    """
+    flat.save(flat_dirname(name, model_dir))
@@ -0,0 +1,232 @@
+import itertools
+import numpy as np
+from sklearn.base import clone
+from stacking import stratified_folds
+try:
+    from joblib import Parallel, delayed
+except ImportError:
+    from sklearn.externals.joblib import Parallel, delayed
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+"""
+This module tunes the stages of the random forest ensemble with successive
+halving instead of an exhaustive ten fold grid search
+
+Every candidate of the grid is first cross validated with a small budget,
+the best 1 / factor of them are promoted to a budget factor times larger,
+and so on until a single candidate is left at the full budget. For forests
+the budget is the number of trees, and a promoted candidate keeps the fold
+forests of the previous rung and only grows the extra trees with
+warm_start; for other models the budget is the number of training rows.
+
+All the candidate and fold fits of a rung share one pool of n_jobs threads
+while every model fits single threaded, so the search never runs forests
+with n_jobs=-1 inside a parallel search and oversubscribes the cpus. The
+forests grow their trees with the gil released, so threads do not need to
+copy the training rows into other processes. Models without n_jobs (i.e.
+HistGradientBoostingClassifier) use every cpu through openmp instead, so
+every fit thread limits openmp to a single thread with threadpoolctl, and
+without threadpoolctl their fits run one at a time.
+
+Example:
+    search = SuccessiveHalvingSearch(RandomForestClassifier(), paramgrid)
+    search.fit(X_train, y_train)
+    best_model = search.best_estimator_
+"""
+
+
+def expand_grid(paramgrid):
+    """
+    Args:
+        paramgrid (dictionary): a dictionary of lists of parameter values
+    Returns:
+        candidates (list): one dictionary per combination of the values
+    """
+    names = sorted(paramgrid)
+    return [dict(zip(names, values)) for values in
+            itertools.product(*[paramgrid[name] for name in names])]
+
+
+def halving_budgets(n_candidates, max_resource, min_resource, factor):
+    """
+    Args:
+        n_candidates (int): the number of candidates in the first rung
+        max_resource (int): the budget of the last rung
+        min_resource (int): the smallest budget a rung may get
+        factor (int): how many times fewer candidates each rung keeps
+    Returns:
+        budgets (list): the budget of every rung, the last being
+        max_resource
+    """
+    n_rungs = 1
+    while n_candidates > 1:
+        n_candidates = max(1, n_candidates // factor)
+        n_rungs += 1
+    return [max(min(min_resource, max_resource),
+                max_resource // factor ** (n_rungs - 1 - rung))
+            for rung in range(n_rungs)]
+
+
+def _fit_and_score(model, X, y, train_ix, test_ix, limit_openmp=False):
+    """
+    Args:
+        model (sklearn classifier model): the model to fit, grown in place
+        if it is a warm started forest
+        X (2d numpy array): the feature matrix
+        y (1d numpy array): the targets
+        train_ix (1d numpy array): the rows to fit on
+        test_ix (1d numpy array): the rows to score on
+        limit_openmp (boolean): whether to fit and score with a single
+        openmp thread, which is set per thread so it has to be set by the
+        thread that fits
+    Returns:
+        model (sklearn classifier model): the fit model
+        score (float): the accuracy on the test rows
+    """
+    if limit_openmp:
+        with threadpool_limits(limits=1, user_api='openmp'):
+            return _fit_and_score(model, X, y, train_ix, test_ix)
+    model.fit(X[train_ix], y[train_ix])
+    return model, np.mean(model.predict(X[test_ix]) == y[test_ix])
+
+
+class SuccessiveHalvingSearch(object):
+    """
+    this is a successive halving search over a parameter grid that can be
+    used in place of GridSearchCV
+    """
+    def __init__(self, model, paramgrid, cv=3, factor=3, min_resource=None,
+                 n_jobs=-1, random_state=None, verbose=0):
+        """
+        Args:
+            model (sklearn classifier model): the model to tune
+            paramgrid (dictionary): a dictionary of lists of parameter
+            values, for forests n_estimators is the budget of the last rung
+            rather than a parameter to search over
+            cv (int): the number of stratified folds every candidate is
+            scored on
+            factor (int): how many times fewer candidates each rung keeps,
+            and how many times larger its budget is
+            min_resource (int): the smallest budget, 10 trees for forests
+            or 100 rows otherwise by default
+            n_jobs (int): the number of threads of the whole search, and of
+            the refit of the best model
+            random_state (int): the seed of the folds and of the models,
+            None keeps the random_state the model was given and draws the
+            folds at random
+            verbose (int): whether to print the scores of every rung
+        Returns:
+            nothing, initializes the search
+        """
+        self.model = model
+        self.paramgrid = paramgrid
+        self.cv = cv
+        self.factor = factor
+        self.min_resource = min_resource
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+        self.verbose = verbose
+
+    def fit(self, X, y):
+        """
+        Args:
+            X (2d numpy array): the feature matrix
+            y (1d numpy array): the targets
+        Returns:
+            self, with best_params_, best_score_, best_estimator_, and
+            history_, which holds the budget and mean score of every
+            candidate at every rung it reached
+        """
+        model_params = self.model.get_params()
+        by_trees = 'n_estimators' in model_params and \
+            'warm_start' in model_params
+        paramgrid = dict(self.paramgrid)
+        fixed = {}
+        n_jobs = self.n_jobs
+        limit_openmp = False
+        if 'n_jobs' in model_params:
+            fixed['n_jobs'] = 1
+        elif threadpool_limits is not None:
+            limit_openmp = True
+        else:
+            n_jobs = 1
+        if 'random_state' in model_params and self.random_state is not None:
+            fixed['random_state'] = self.random_state
+        folds = stratified_folds(y, self.cv, self.random_state)
+        splits = [(np.flatnonzero(folds != fold),
+                   np.flatnonzero(folds == fold)) for fold in range(self.cv)]
+        if by_trees:
+            max_resource = max(paramgrid.pop('n_estimators',
+                                             [model_params['n_estimators']]))
+            min_resource = self.min_resource or 10
+            fixed['warm_start'] = True
+        else:
+            rng = np.random.RandomState(self.random_state)
+            splits = [(rng.permutation(train_ix), test_ix)
+                      for train_ix, test_ix in splits]
+            max_resource = min(train_ix.shape[0] for train_ix, _ in splits)
+            min_resource = self.min_resource or 100
+        candidates = expand_grid(paramgrid)
+        budgets = halving_budgets(len(candidates), max_resource,
+                                  min_resource, self.factor)
+        fold_models = dict(((candidate, fold),
+                            clone(self.model).set_params(
+                                **dict(candidates[candidate], **fixed)))
+                           for candidate in range(len(candidates))
+                           for fold in range(self.cv))
+        alive = list(range(len(candidates)))
+        self.history_ = []
+        scores = {}
+        for rung, budget in enumerate(budgets):
+            tasks = [(candidate, fold) for candidate in alive
+                     for fold in range(self.cv)]
+            for candidate, fold in tasks:
+                if by_trees:
+                    fold_models[candidate, fold].set_params(
+                        n_estimators=budget)
+                else:
+                    fold_models[candidate, fold] = \
+                        clone(fold_models[candidate, fold])
+            results = Parallel(n_jobs=n_jobs, backend='threading')(
+                delayed(_fit_and_score)(
+                    fold_models[candidate, fold], X, y,
+                    splits[fold][0] if by_trees
+                    else splits[fold][0][:budget],
+                    splits[fold][1], limit_openmp)
+                for candidate, fold in tasks)
+            fold_scores = {}
+            for (candidate, fold), (model, score) in zip(tasks, results):
+                fold_models[candidate, fold] = model
+                fold_scores.setdefault(candidate, []).append(score)
+            for candidate in alive:
+                scores[candidate] = np.mean(fold_scores[candidate])
+                self.history_.append({'rung': rung,
+                                      'budget': budget,
+                                      'params': candidates[candidate],
+                                      'score': scores[candidate]})
+            if self.verbose:
+                print('rung {}: {} candidates with a budget of {}, best '
+                      'score {}'.format(rung, len(alive), budget,
+                                        max(scores[c] for c in alive)))
+            n_keep = 1 if rung == len(budgets) - 1 else \
+                max(1, len(alive) // self.factor)
+            alive = sorted(alive, key=lambda c: -scores[c])[:n_keep]
+            for candidate in set(c for c, _ in tasks) - set(alive):
+                for fold in range(self.cv):
+                    fold_models.pop((candidate, fold))
+        best = alive[0]
+        self.best_params_ = dict(candidates[best])
+        if by_trees:
+            self.best_params_['n_estimators'] = max_resource
+        self.best_score_ = scores[best]
+        final_params = dict(self.best_params_)
+        if 'n_jobs' in model_params:
+            final_params['n_jobs'] = self.n_jobs
+        if 'random_state' in fixed:
+            final_params['random_state'] = self.random_state
+        self.best_estimator_ = clone(self.model).set_params(**final_params)
+        self.best_estimator_.fit(X, y)
+        return self
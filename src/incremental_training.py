@@ -0,0 +1,367 @@
+import copy
+import os
+import time
+import numpy as np
+from feature_schema import V2_SCHEMA
+from lightweight_predictor import featurize_tweets_v2, load_models_v2, \
+    V2_BUNDLE
+from lightweight_classifier import load_training_block
+from model_registry import publish_bundle
+from oob_evaluation import oob_probas, with_oob
+from stacking import merge_forests
+from training_pipeline import ArtifactCache
+from training_profiler import TrainingProfiler
+
+"""
+This module refreshes the v2 random forest ensemble with newly labelled
+accounts (i.e. today's spammers that the model missed) without rebuilding
+all of its trees
+
+The labelled accounts are appended to a training store, which starts out as
+the training and test rows of create_ensemble_model. The store is a
+directory of chunks of .npy files, and every append writes a new chunk
+without rewriting the older ones, so the store can also be memory-mapped
+chunk by chunk, which is how sharded_training trains on stores that do not
+fit in memory. Every stage then keeps its trees and grows a few more on the
+combined rows, optionally weighting the rows by how recently they were
+added so that the new trees lean towards today's spam. The history and
+behavior rate models are grown first, the stacked input is rebuilt with
+their new probabilities, and the ensemble model grows its trees on that.
+The refreshed ensemble is published as a new bundle version, which running
+processes pick up without restarting, and which can be rolled back with
+bundles.rollback.
+
+The stacked input follows the stacking the live models were trained with.
+For in_sample stacking it holds the in-sample probabilities of the grown
+base models. For out_of_fold and out_of_bag stacking it holds the out of
+bag probabilities of the new base model trees, the only trees whose
+bootstrap rows are known, as the old ones were grown on an earlier store.
+These come from n_new_trees trees rather than the whole forest, so they are
+noisier than what the ensemble model is served, but they are not
+overconfident on the training rows the way in-sample probabilities are.
+Only random forest stages can be grown; boosted stages have to be refit
+from scratch with create_ensemble_model.
+
+Growing 50 trees per stage costs about a sixth of the 900 trees of a full
+retrain, and max_trees drops the oldest trees so that the models do not
+keep getting larger.
+
+Example:
+    X_new = history_from_tweets(false_negative_tweets)
+    models, version = incremental_update(X_new, np.ones(len(X_new)),
+                                         half_life=30)
+"""
+
+
+TRAINING_STORE = 'models/training_store'
+
+
+def history_from_tweets(tweet_list):
+    """
+    Args:
+        tweet_list (list): list of json tweet objects of labelled accounts
+    Returns:
+        X (2d numpy array): their account history features
+    """
+    return featurize_tweets_v2(tweet_list).history.copy()
+
+
+def training_store_chunks(dirname=TRAINING_STORE):
+    """
+    Args:
+        dirname (str): the training store
+    Returns:
+        chunks (list): the directory of every chunk of the store, oldest
+        first
+    """
+    if not os.path.isdir(dirname):
+        return []
+    return [os.path.join(dirname, chunk) for chunk in
+            sorted(os.listdir(dirname)) if chunk.startswith('chunk_')]
+
+
+def load_store_chunk(chunk, mmap_mode=None):
+    """
+    Args:
+        chunk (str): the directory of a chunk of the training store
+        mmap_mode (str): how to memory-map the arrays, or None to read them
+    Returns:
+        chunk (dict): the account history features, targets, and the unix
+        time every row was added
+    """
+    return dict((name, np.load(os.path.join(chunk, name + '.npy'),
+                               mmap_mode=mmap_mode))
+                for name in ('X', 'y', 'added'))
+
+
+def check_history_features(X):
+    """
+    Args:
+        X (2d numpy array): account history features
+    Returns:
+        nothing, raises a ValueError if X does not have one column per v2
+        account history feature
+    """
+    if X.ndim != 2 or X.shape[1] != V2_SCHEMA.n_features:
+        raise ValueError('expected {} account history features, got an '
+                         'array of shape {}'.format(V2_SCHEMA.n_features,
+                                                    X.shape))
+
+
+def add_store_chunk(X, y, added, dirname=TRAINING_STORE):
+    """
+    Args:
+        X (2d numpy array): account history features
+        y (1d numpy array): their labels, 1 = fake and 0 = human
+        added (1d numpy array): the unix time every row was added
+        dirname (str): the training store
+    Returns:
+        chunk (str): the directory of the new chunk, which is written to a
+        temporary directory and renamed so that it appears whole, without
+        reading or rewriting the rest of the store
+    """
+    check_history_features(X)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    chunk = os.path.join(dirname, 'chunk_{:05d}'.format(
+        len(training_store_chunks(dirname))))
+    tmp_chunk = os.path.join(dirname, '.{}.{}.tmp'.format(
+        os.path.basename(chunk), os.getpid()))
+    os.makedirs(tmp_chunk)
+    for name, values in (('X', X), ('y', y), ('added', added)):
+        np.save(os.path.join(tmp_chunk, name + '.npy'), values)
+    os.rename(tmp_chunk, chunk)
+    return chunk
+
+
+def seed_training_store(dirname=TRAINING_STORE):
+    """
+    Args:
+        dirname (str): the training store
+    Returns:
+        nothing, writes the cached training and test rows of
+        create_ensemble_model as the first chunk of an empty store
+    """
+    if training_store_chunks(dirname):
+        return
+    trained = load_training_block(ArtifactCache())
+    split = trained['split']
+    X = np.vstack((split['X_train'], split['X_test']))
+    add_store_chunk(X, np.hstack((split['y_train'], split['y_test'])),
+                    np.zeros(X.shape[0]), dirname)
+
+
+def load_training_store(dirname=TRAINING_STORE):
+    """
+    Args:
+        dirname (str): the training store
+    Returns:
+        store (dict): the account history features, targets, and the unix
+        time every row was added, of every chunk, seeded from the cached
+        training and test rows of create_ensemble_model the first time
+    """
+    seed_training_store(dirname)
+    chunks = [load_store_chunk(chunk) for chunk in
+              training_store_chunks(dirname)]
+    return dict((name, np.concatenate([chunk[name] for chunk in chunks]))
+                for name in ('X', 'y', 'added'))
+
+
+def append_to_training_store(X_new, y_new, dirname=TRAINING_STORE):
+    """
+    Args:
+        X_new (2d numpy array): account history features of new accounts
+        y_new (1d numpy array): their labels, 1 = fake and 0 = human
+        dirname (str): the training store
+    Returns:
+        chunk (str): the directory of the chunk the rows were written to
+    """
+    seed_training_store(dirname)
+    return add_store_chunk(X_new, y_new, np.full(X_new.shape[0], time.time()),
+                           dirname)
+
+
+def recency_weights(added, half_life=None, now=None):
+    """
+    Args:
+        added (1d numpy array): the unix time every row was added
+        half_life (float): the number of days after which a row counts half
+        as much, or None to weight every row the same
+        now (float): the current unix time
+    Returns:
+        weights (1d numpy array): the sample weight of every row, where
+        the seed rows count as if they were added at the oldest later row
+    """
+    if half_life is None:
+        return None
+    now = time.time() if now is None else now
+    added = np.where(added > 0, added, added[added > 0].min()
+                     if np.any(added > 0) else now)
+    return .5 ** ((now - added) / (86400. * half_life))
+
+
+def _check_forest(forest):
+    """
+    Args:
+        forest (sklearn classifier model): the fit model of a stage
+    Returns:
+        nothing, raises a ValueError if the model has no trees to keep,
+        i.e. a boosted stage, which has to be refit from scratch with
+        create_ensemble_model
+    """
+    if not hasattr(forest, 'estimators_'):
+        raise ValueError('only random forest stages can grow trees, refit '
+                         'the {} stage from scratch with '
+                         'create_ensemble_model'.format(
+                             type(forest).__name__))
+
+
+def _trim_forest(grown, max_trees):
+    """
+    Args:
+        grown (RandomForestClassifier): a grown forest
+        max_trees (int): if the forest has more trees than this, the oldest
+        trees are dropped
+    Returns:
+        grown (RandomForestClassifier): the forest, without the out of bag
+        estimates it may have copied from the forest it was grown from, as
+        they do not describe its trees any more
+    """
+    for name in ('oob_score_', 'oob_decision_function_'):
+        if name in grown.__dict__:
+            delattr(grown, name)
+    grown.set_params(oob_score=False)
+    if max_trees is not None and len(grown.estimators_) > max_trees:
+        grown.estimators_ = grown.estimators_[-max_trees:]
+        grown.n_estimators = max_trees
+    return grown
+
+
+def grow_forest(forest, X, y, n_new_trees, sample_weight=None,
+                max_trees=None):
+    """
+    Args:
+        forest (RandomForestClassifier): a fit forest, left unchanged
+        X (2d numpy array): the rows to grow the new trees on
+        y (1d numpy array): the targets
+        n_new_trees (int): the number of trees to add
+        sample_weight (1d numpy array): optional weight of every row
+        max_trees (int): if the grown forest has more trees than this, the
+        oldest trees are dropped
+    Returns:
+        grown (RandomForestClassifier): a copy of the forest with its old
+        trees and the new ones
+    """
+    _check_forest(forest)
+    grown = copy.copy(forest)
+    grown.estimators_ = list(forest.estimators_)
+    # the old trees were bootstrapped from fewer rows, so warm_start would
+    # compute out of bag estimates from the wrong rows
+    grown.set_params(warm_start=True, oob_score=False,
+                     n_estimators=len(grown.estimators_) + n_new_trees)
+    grown.fit(X, y, sample_weight=sample_weight)
+    grown.set_params(warm_start=False)
+    return _trim_forest(grown, max_trees)
+
+
+def grow_forest_oob(forest, X, y, n_new_trees, sample_weight=None,
+                    max_trees=None):
+    """
+    Args:
+        forest (RandomForestClassifier): a fit bootstrapped forest, left
+        unchanged
+        X (2d numpy array): the rows to grow the new trees on
+        y (1d numpy array): the targets
+        n_new_trees (int): the number of trees to add
+        sample_weight (1d numpy array): optional weight of every row
+        max_trees (int): if the grown forest has more trees than this, the
+        oldest trees are dropped
+    Returns:
+        grown (RandomForestClassifier): a copy of the forest with its old
+        trees and the new ones
+        probas (1d numpy array): the out of bag probability of the positive
+        class of every row, from the new trees alone
+    """
+    _check_forest(forest)
+    random_state = forest.random_state
+    if isinstance(random_state, (int, np.integer)):
+        random_state += len(forest.estimators_)
+    new = with_oob(forest).set_params(n_estimators=n_new_trees,
+                                      warm_start=False,
+                                      random_state=random_state)
+    new.fit(X, y, sample_weight=sample_weight)
+    probas = oob_probas(new, X)
+    return _trim_forest(merge_forests([forest, new]), max_trees), probas
+
+
+def incremental_update(X_new, y_new, n_new_trees=(50, 50, 50),
+                       half_life=None, max_trees=None, publish=True,
+                       dirname=TRAINING_STORE, stacking='in_sample'):
+    """
+    Args:
+        X_new (2d numpy array): account history features of newly labelled
+        accounts, see history_from_tweets
+        y_new (1d numpy array): their labels, 1 = fake and 0 = human
+        n_new_trees (tuple): the trees to grow for the history, behavior
+        rate, and ensemble models
+        half_life (float): the recency half life in days of the row weights,
+        or None to weight every row the same
+        max_trees (tuple): the most trees to keep per stage, or None to
+        keep every tree
+        publish (boolean): whether to publish the refreshed models as a new
+        version of the v2 bundle
+        dirname (str): the training store
+        stacking (str): how the live ensemble model was stacked, see
+        create_ensemble_model, 'in_sample' fits the new ensemble trees on
+        the probabilities of the grown base models, 'out_of_fold' and
+        'out_of_bag' on the out of bag probabilities of their new trees
+    Returns:
+        models (tuple): the refreshed history, behavior rate, and ensemble
+        models
+        version (str): the bundle version they were published under, with
+        the time and memory of every stage in its profile.json, or None,
+        the new rows are added to the store once the models are grown and
+        published, so an update that raises stores nothing
+    """
+    if stacking not in ('in_sample', 'out_of_fold', 'out_of_bag'):
+        raise ValueError('unknown stacking {!r}'.format(stacking))
+    grow = grow_forest if stacking == 'in_sample' else grow_forest_oob
+    profiler = TrainingProfiler()
+    with profiler.stage('loading'):
+        check_history_features(X_new)
+        model, modelb, model_ens = load_models_v2()
+        for forest in (model, modelb, model_ens):
+            _check_forest(forest)
+        store = load_training_store(dirname)
+        added = np.full(X_new.shape[0], time.time())
+        y = np.hstack((store['y'], y_new))
+        weights = recency_weights(np.hstack((store['added'], added)),
+                                  half_life)
+        max_trees = max_trees or (None, None, None)
+        block = V2_SCHEMA.block_from_history(np.vstack((store['X'], X_new)))
+        del store
+    with profiler.stage('history_model'):
+        model = grow(model, block.history, y, n_new_trees[0],
+                     weights, max_trees[0])
+    with profiler.stage('behavior_model'):
+        modelb = grow(modelb, block.behavior, y, n_new_trees[1],
+                      weights, max_trees[1])
+    with profiler.stage('base_probas'):
+        if stacking == 'in_sample':
+            block.set_base_probas(
+                model.predict_proba(block.history)[:, 1],
+                modelb.predict_proba(block.behavior)[:, 1])
+        else:
+            (model, history_probas), (modelb, behavior_probas) = \
+                model, modelb
+            block.set_base_probas(history_probas, behavior_probas)
+    with profiler.stage('ensemble_model'):
+        model_ens = grow_forest(model_ens, block.matrix, y,
+                                n_new_trees[2], weights, max_trees[2])
+    models = (model, modelb, model_ens)
+    version = publish_bundle(V2_BUNDLE, models, V2_SCHEMA,
+                             profiler=profiler) if publish else None
+    # the new rows are stored last, so that an update that fails can be
+    # retried without storing its rows twice
+    add_store_chunk(X_new, y_new, added, dirname)
+    return models, version
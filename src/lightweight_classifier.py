@@ -1,15 +1,37 @@
 import numpy as np
 import pandas as pd
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.cross_validation import train_test_split, cross_val_score
+try:
+    from sklearn.ensemble import HistGradientBoostingClassifier
+except ImportError:
+    try:
+        from sklearn.experimental import enable_hist_gradient_boosting
+        from sklearn.ensemble import HistGradientBoostingClassifier
+    except ImportError:
+        HistGradientBoostingClassifier = None
+from sklearn.base import clone
+try:
+    from sklearn.model_selection import train_test_split, cross_val_score, \
+        GridSearchCV
+except ImportError:
+    from sklearn.cross_validation import train_test_split, cross_val_score
+    from sklearn.grid_search import GridSearchCV
 from imblearn.under_sampling import RandomUnderSampler
 from process_loaded_data import check_if_many_relative_followers_to_friends
 from datetime import datetime
 from pymongo import MongoClient
-from tweet_scrape_processor import process_tweet
-from sklearn.grid_search import GridSearchCV
+from tweet_scrape_processor import extract_user_features
+from feature_schema import V1_SCHEMA, V2_SCHEMA, EnsembleBlock
+from lightweight_predictor import score_stacked_stage, cascade_mask
+from forest_compression import compression_curve
+from training_pipeline import ArtifactCache, file_digest
+from training_profiler import TrainingProfiler
+from stacking import fit_out_of_fold, grid_params
+from halving_search import SuccessiveHalvingSearch
+from oob_evaluation import OutOfBagSearch, oob_report, oob_probas
 from sklearn.metrics import classification_report, confusion_matrix
 from dill import pickle
+import time
 
 """
 This module is used to create the random forest ensemble that will classify
@@ -67,6 +89,13 @@ using only class A features.
 To run this, just run the function:
     create_ensemble_model()
 
+The training is split into stages (loading the frames, the balanced splits,
+the behavior rate matrices, each forest, and the base model probabilities)
+whose results are cached in models/cache by training_pipeline, so running
+it again after changing, say, the grid of the ensemble model only refits
+the ensemble model. The splits are seeded so that the runs are
+reproducible.
+
 Todo:
     * train the model with more samples from today's set of Twitter's
     false negatives so that the model can understand the patterns of
@@ -83,6 +112,9 @@ def view_feature_importances(df, model):
     Returns:
         nothing, this just prints the feature importances in descending order
     """
+    if not hasattr(model, 'feature_importances_'):
+        print('{} has no feature importances'.format(type(model).__name__))
+        return
     columns = df.columns
     features = model.feature_importances_
     featimps = []
@@ -93,19 +125,27 @@ def view_feature_importances(df, model):
                                                    ascending=False))
 
 
-def evaluate_model(model, X_train, y_train):
+def evaluate_model(model, X_train, y_train, oob=False):
     """
     Args:
         model (sklearn classification model): this model from sklearn that
         will be used to fit the data and to see the 10 fold cross val score of
         X_train (2d numpy array): this is the feature matrix
         y_train (1d numpy array): this is the array of targets
+        oob (boolean): whether to report the out of bag accuracy and
+        confusion matrix of a bootstrapped forest from its single fit
+        instead of fitting it ten more times to cross validate
     Returns:
         prints information about the model's accuracy using 10
          fold cross validation
         model (sklearn classification model): the model that has already been
         fit to the data
     """
+    if oob:
+        report = oob_report(model, X_train, y_train)
+        print(report['accuracy'])
+        print(report['confusion_matrix'])
+        return report['model']
     print(np.mean(cross_val_score(model, X_train, y_train,
                                   cv=10, n_jobs=-1, verbose=10)))
     model.fit(X_train, y_train)
@@ -138,7 +178,8 @@ def view_classification_report(model, X_test, y_test):
     print(classification_report(y_test, model.predict(X_test)))
 
 
-def gridsearch(paramgrid, model, X_train, y_train):
+def gridsearch(paramgrid, model, X_train, y_train, search='grid',
+               n_jobs=-1, random_state=None):
     """
     Args:
         paramgrid (dictionary): a dictionary of lists where the keys are the
@@ -146,18 +187,37 @@ def gridsearch(paramgrid, model, X_train, y_train):
         different parameter values to search over
         X_train (2d numpy array): this is the feature matrix
         y_train (1d numpy array): this is the array of targets
+        search (str): 'halving' for a successive halving search (see
+        halving_search), 'oob' to pick the forest with the best out of bag
+        accuracy (see oob_evaluation), or 'grid', the default, for the
+        exhaustive ten fold grid search
+        n_jobs (int): the number of cpus the whole search may use, the
+        model itself fits single threaded during the search
+        random_state (int): the seed of the folds and of the models of the
+        successive halving search, None keeps the random_state of the model
     Returns:
         best_model (sklearn classifier): a fit sklearn classifier with the
         best parameters from the gridsearch
         gridsearch (gridsearch object): the gridsearch object that has
         already been fit
     """
-    gridsearch = GridSearchCV(model,
-                              paramgrid,
-                              n_jobs=-1,
-                              verbose=10,
-                              cv=10)
+    if search == 'halving':
+        gridsearch = SuccessiveHalvingSearch(model, paramgrid, n_jobs=n_jobs,
+                                             random_state=random_state,
+                                             verbose=10)
+    elif search == 'oob':
+        gridsearch = OutOfBagSearch(model, paramgrid, verbose=10)
+    else:
+        if 'n_jobs' in model.get_params():
+            model = clone(model).set_params(n_jobs=1)
+        gridsearch = GridSearchCV(model,
+                                  paramgrid,
+                                  n_jobs=n_jobs,
+                                  verbose=10,
+                                  cv=10)
     gridsearch.fit(X_train, y_train)
+    if search == 'grid' and 'n_jobs' in model.get_params():
+        gridsearch.best_estimator_.set_params(n_jobs=n_jobs)
     best_model = gridsearch.best_estimator_
     print('these are the parameters of the best model')
     print(best_model)
@@ -178,6 +238,8 @@ def balance_classes(sm, X, y):
         y (1d numpy array): this is the corresponding balanced target array
     Returns X and y after being fit with the resampling method
     """
+    if hasattr(sm, 'fit_resample'):
+        return sm.fit_resample(X, y)
     X, y = sm.fit_sample(X, y)
     return X, y
 
@@ -346,8 +408,9 @@ def get_and_process_mongo_tweets(dbname, collection):
     tab = db[collection].find()
     for document in tab:
         tweet_list.append(document)
-    processed_tweets = np.array([process_tweet(tweet) for tweet in tweet_list])
-    tweet_history = processed_tweets[:, :19].astype(float)
+    tweet_history = np.empty((len(tweet_list), V1_SCHEMA.n_features))
+    for row, tweet in zip(tweet_history, tweet_list):
+        row[:] = extract_user_features(tweet)
     return tweet_history
 
 
@@ -390,264 +453,556 @@ def behavior_network_ratio_feature_creation(df):
     return df
 
 
-def create_ensemble_model():
+CASCADE_BANDS = [(.05, .95), (.1, .9), (.2, .8), (.3, .7), (.4, .6)]
+
+
+def calibrate_cascade_band(model, modelb, model_ens, X, y,
+                           bands=CASCADE_BANDS):
     """
     Args:
-        none
-    Returns
-        nothing, this prints out the performance of the model and then
-        saves it to a pkl file, it takes in the training user tweet data,
-        the miley cyrus data, and the celebrity users data, as additional
-        information to train the model to sense spam in today's times
+        model (sklearn classification model): the fit history model
+        modelb (sklearn classification model): the fit behavior rate model
+        model_ens (sklearn classification model): the fit ensemble model
+        X (2d numpy array): held out account history feature matrix
+        y (1d numpy array): the corresponding targets
+        bands (list): the (low, high) cascade bands to try
+    Returns:
+        report (pandas dataframe): for each band, the share of rows that
+        skip the ensemble model, how often the cascade agrees with the full
+        ensemble, the accuracy of both, and the throughput of both in rows
+        per second, which is also printed
+    """
+    block = V2_SCHEMA.block_from_history(X)
+    start = time.time()
+    y_pred = model.predict_proba(block.history)[:, 1]
+    y_pred_b = modelb.predict_proba(block.behavior)[:, 1]
+    block.set_base_probas(y_pred, y_pred_b)
+    base_time = time.time() - start
+    start = time.time()
+    _, full_pred = score_stacked_stage(model_ens, block)
+    full_time = base_time + time.time() - start
+    report = []
+    for band in bands:
+        start = time.time()
+        _, pred = score_stacked_stage(model_ens, block, band)
+        cascade_time = base_time + time.time() - start
+        report.append({'band': band,
+                       'skipped': 1 - np.mean(cascade_mask(y_pred, y_pred_b,
+                                                           band)),
+                       'agreement': np.mean(pred == full_pred),
+                       'accuracy': np.mean(pred == y),
+                       'full_accuracy': np.mean(full_pred == y),
+                       'throughput': len(y) / cascade_time,
+                       'full_throughput': len(y) / full_time})
+    report = pd.DataFrame(report)
+    print(report)
+    return report
+
+
+TRAINING_FILES = ('data/training_user_tweet_data.csv',
+                  'data/mileycyrususers.csv',
+                  'data/celebrityusers.csv')
+HISTORY_PARAMGRID = {'n_estimators': [200],
+                     'max_features': ['sqrt'],
+                     'criterion': ['entropy'],
+                     'min_samples_split': [10],
+                     'min_samples_leaf': [8],
+                     'max_depth': [30],
+                     'bootstrap': [True]}
+BEHAVIOR_PARAMGRID = {'n_estimators': [200],
+                      'max_features': ['sqrt'],
+                      'criterion': ['entropy'],
+                      'min_samples_split': [16],
+                      'min_samples_leaf': [18],
+                      'max_depth': [30],
+                      'bootstrap': [True]}
+ENSEMBLE_PARAMGRID = {'n_estimators': [500],
+                      'max_features': ['sqrt'],
+                      'criterion': ['entropy'],
+                      'min_samples_split': [16],
+                      'min_samples_leaf': [11],
+                      'max_depth': [20],
+                      'bootstrap': [True]}
+BOOSTED_PARAMGRID = {'max_iter': [200],
+                     'learning_rate': [.1],
+                     'max_leaf_nodes': [31],
+                     'min_samples_leaf': [20],
+                     'l2_regularization': [0.]}
+STAGE_PARAMGRIDS = {'forest': (HISTORY_PARAMGRID, BEHAVIOR_PARAMGRID,
+                               ENSEMBLE_PARAMGRID),
+                    'boosted': (BOOSTED_PARAMGRID, BOOSTED_PARAMGRID,
+                                BOOSTED_PARAMGRID)}
+FOREST_STAGES = ('forest', 'forest', 'forest')
+
+
+def load_training_frames(filenames=TRAINING_FILES):
     """
-    print('this is the portion that checks absolute user behavior values')
-    df = pd.read_csv('data/training_user_tweet_data.csv')
-    cyrusdf = pd.read_csv('data/mileycyrususers.csv')
-    celebdf = pd.read_csv('data/celebrityusers.csv')
-    df = behavior_network_ratio_feature_creation(df)
-    cyrusdf = behavior_network_ratio_feature_creation(cyrusdf)
-    celebdf = behavior_network_ratio_feature_creation(celebdf)
-    print('this is the portion that checks absolute user behavior values')
-    y = df.pop('label_y')
-    y = y.values
-    X = df.values
-    ycyrus = cyrusdf.pop('label_y')
-    ycyrus = ycyrus.values
-    yceleb = celebdf.pop('label_y')
-    yceleb = yceleb.values
-    cyrusX = cyrusdf.values
-    celebX = celebdf.values
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=.2)
+    Args:
+        filenames (tuple): the training user tweet data, the miley cyrus
+        data, and the celebrity users data csv files
+    Returns:
+        frames (list): one (X, y) tuple per file, with the relative volume
+        features added and the columns checked against the v2 schema
+    """
+    frames = []
+    for filename in filenames:
+        df = behavior_network_ratio_feature_creation(pd.read_csv(filename))
+        y = df.pop('label_y').values
+        V2_SCHEMA.check_columns(df.columns)
+        frames.append((df.values, y))
+    return frames
+
+
+def split_training_data(frames, test_size=.2, random_state=0):
+    """
+    Args:
+        frames (list): the output of load_training_frames
+        test_size (float): the share of every file that is held out
+        random_state (int): the seed of the splits and of the undersampling
+    Returns:
+        split (dict): the training and test feature matrices and targets,
+        where the training user tweet data is undersampled to balance the
+        classes before the miley cyrus and celebrity rows are added, the
+        held out miley cyrus and celebrity rows on their own as the new
+        kind of spam, and held_out with the (X, y) test rows of every file
+        on their own
+    """
+    (X, y), (cyrusX, ycyrus), (celebX, yceleb) = frames
+    X_train, X_test, y_train, y_test = \
+        train_test_split(X, y, test_size=test_size,
+                         random_state=random_state)
     cyX_train, cyX_test, cyy_train, cyy_test = \
-        train_test_split(cyrusX, ycyrus, test_size=.2)
+        train_test_split(cyrusX, ycyrus, test_size=test_size,
+                         random_state=random_state)
     ceX_train, ceX_test, cey_train, cey_test = \
-        train_test_split(celebX, yceleb, test_size=.2)
-    X_train_b, y_train_b = balance_classes(RandomUnderSampler(),
-                                           X_train, y_train)
-    X_test_b, y_test_b = balance_classes(RandomUnderSampler(),
-                                         X_test, y_test)
-    X_train_b = np.vstack((X_train_b, cyX_train, ceX_train))
-    y_train_b = np.hstack((y_train_b, cyy_train, cey_train))
-    X_test_b = np.vstack((X_test_b, cyX_test, ceX_test))
-    y_test_b = np.hstack((y_test_b, cyy_test, cey_test))
-    weights = 1
-    X_train_bw = X_train_b * weights
-    paramgrid = {'n_estimators': [200],
-                 'max_features': ['auto'],
-                 'criterion': ['entropy'],
-                 'min_samples_split': [10],
-                 'min_samples_leaf': [8],
-                 'max_depth': [30],
-                 'bootstrap': [True]}
-    model = RandomForestClassifier(n_jobs=-1)
-    model, gs = gridsearch(paramgrid, model, X_train_bw, y_train_b)
-    print("\nthis is the model performance on the training data\n")
-    view_classification_report(model, X_train_bw, y_train_b)
-    view_classification_report(model, X_test_b*weights, y_test_b)
-    print(confusion_matrix(y_train_b, model.predict(X_train_bw)))
-    print("this is the model performance on the test data\n")
-    print(confusion_matrix(y_test_b, model.predict(X_test_b*weights)))
-    print("this is the model performance on different split ratios\n")
-    print("\nthese are the model feature importances\n")
-    view_feature_importances(df, model)
-    y_pred = model.predict_proba(X_train_bw)[:, 1]
-    print('this is the portion that checks user behavior rate values')
-    X_train_bwr = X_train_bw/X_train_bw[:, 13].reshape(-1, 1)
-    weights = 1
-    X_train_bwr = X_train_bwr * weights
-    paramgrid = {'n_estimators': [200],
-                 'max_features': ['auto'],
-                 'criterion': ['entropy'],
-                 'min_samples_split': [16],
-                 'min_samples_leaf': [18],
-                 'max_depth': [30],
-                 'bootstrap': [True]}
-    modelb = RandomForestClassifier(n_jobs=-1)
-    modelb, gs = gridsearch(paramgrid, modelb, X_train_bwr, y_train_b)
-    print("\nthis is the model performance on the training data\n")
-    view_classification_report(modelb, X_train_bwr, y_train_b)
-    print(confusion_matrix(y_train_b, modelb.predict(X_train_bwr)))
-    print("this is the model performance on the test data\n")
-    X_test_br = X_test_b * weights/X_test_b[:, 13].reshape(-1, 1)
-    view_classification_report(modelb, X_test_br, y_test_b)
-    print(confusion_matrix(y_test_b, modelb.predict(X_test_br)))
-    print("\nthese are the model feature importances\n")
-    view_feature_importances(df, modelb)
-    y_pred_b = modelb.predict_proba(X_train_bwr)[:, 1]
-    print('this is the portion that ensembles these two facets')
-    ensemble_X = np.hstack((X_train_bw, X_train_bwr,
-                            y_pred.reshape(-1, 1), y_pred_b.reshape(-1, 1)))
-    model_ens = RandomForestClassifier(n_jobs=-1)
-    paramgrid = {'n_estimators': [500],
-                 'max_features': ['auto'],
-                 'criterion': ['entropy'],
-                 'min_samples_split': [16],
-                 'min_samples_leaf': [11],
-                 'max_depth': [20],
-                 'bootstrap': [True]}
-    model_ens, gs = gridsearch(paramgrid, model_ens, ensemble_X, y_train_b)
-    print("\nthis is the model performance on the training data\n")
-    view_classification_report(model_ens, ensemble_X, y_train_b)
-    print(confusion_matrix(y_train_b, model_ens.predict(ensemble_X)))
-    print("this is the model performance on the test data\n")
-    y_pred_test = model.predict_proba(X_test_b)[:, 1]
-    X_test_br = X_test_b/X_test_b[:, 13].reshape(-1, 1)
-    y_pred_test_b = modelb.predict_proba(X_test_br)[:, 1]
-    ensemble_X_test = np.hstack((X_test_b, X_test_br,
-                                 y_pred_test.reshape(-1, 1),
-                                 y_pred_test_b.reshape(-1, 1)))
-    view_classification_report(model_ens, ensemble_X_test, y_test_b)
-    print(confusion_matrix(y_test_b, model_ens.predict(ensemble_X_test)))
-    columns = \
-        list(df.columns)+[column+'_rate' for
-                          column in df.columns] + \
-        ['pred_model_1', 'pred_model_2']
-    ensdf = pd.DataFrame(ensemble_X, columns=columns)
-    view_feature_importances(ensdf, model_ens)
-    print('evaluating the model on the new kind of spam')
-    newX = np.vstack((cyX_test, ceX_test))
-    newXbr = newX/newX[:, 13].reshape(-1, 1)
-    newy = np.hstack((cyy_test, cey_test))
-    newy_pred = model.predict(newX)
-    newy_pred_b = modelb.predict(newXbr)
-    newXens = np.hstack((newX, newXbr,
-                         newy_pred.reshape(-1, 1),
-                         newy_pred_b.reshape(-1, 1)))
-    print(confusion_matrix(newy, model_ens.predict(newXens)))
-    print('fitting to all and writing to pkl')
-    y_all = np.hstack((y_train_b, y_test_b))
-    behavior_X = np.vstack((X_train_bw, X_test_b))
-    behavior_rate_X = np.vstack((X_train_bwr, X_test_br))
-    ensemble_X = np.vstack((ensemble_X, ensemble_X_test))
-    model.fit(behavior_X, y_all)
-    modelb.fit(behavior_rate_X, y_all)
-    model_ens.fit(ensemble_X, y_all)
-    write_model_to_pkl(model, 'account_history_rf_v2')
-    write_model_to_pkl(modelb, 'behavior_rate_rf_v2')
-    write_model_to_pkl(model_ens, 'ensemble_rf_v2')
+        train_test_split(celebX, yceleb, test_size=test_size,
+                         random_state=random_state)
+    X_train_b, y_train_b = \
+        balance_classes(RandomUnderSampler(random_state=random_state),
+                        X_train, y_train)
+    X_test_b, y_test_b = \
+        balance_classes(RandomUnderSampler(random_state=random_state),
+                        X_test, y_test)
+    return {'X_train': np.vstack((X_train_b, cyX_train, ceX_train)),
+            'y_train': np.hstack((y_train_b, cyy_train, cey_train)),
+            'X_test': np.vstack((X_test_b, cyX_test, ceX_test)),
+            'y_test': np.hstack((y_test_b, cyy_test, cey_test)),
+            'X_new': np.vstack((cyX_test, ceX_test)),
+            'y_new': np.hstack((cyy_test, cey_test)),
+            'held_out': {'cresci': (X_test_b, y_test_b),
+                         'cyrus': (cyX_test, cyy_test),
+                         'celebrity': (ceX_test, cey_test)}}
+
+
+def build_training_matrix(split, weights=1):
+    """
+    Args:
+        split (dict): the output of split_training_data
+        weights (float): what the training history features are scaled by
+    Returns:
+        matrix (2d numpy array): the stacked ensemble input of the training
+        rows followed by the test rows, with the history and behavior rate
+        features filled in
+    """
+    n_train = split['X_train'].shape[0]
+    block = V2_SCHEMA.allocate(n_train + split['X_test'].shape[0])
+    np.multiply(split['X_train'], weights, out=block.history[:n_train])
+    block.history[n_train:] = split['X_test']
+    block.fill_behavior_rates()
+    return block.matrix
 
-if __name__ == "__main__":
-    df = pd.read_csv('data/training_user_tweet_data.csv')
-    cyrusdf = pd.read_csv('data/mileycyrususers.csv')
-    celebdf = pd.read_csv('data/celebrityusers.csv')
-    df = behavior_network_ratio_feature_creation(df)
-    cyrusdf = behavior_network_ratio_feature_creation(cyrusdf)
-    celebdf = behavior_network_ratio_feature_creation(celebdf)
+
+def stage_model(kind):
+    """
+    Args:
+        kind (str): 'forest' for a random forest or 'boosted' for a
+        histogram binned gradient boosted model
+    Returns:
+        model (sklearn classifier model): an unfit model of that kind
+    """
+    if kind == 'forest':
+        return RandomForestClassifier(n_jobs=-1)
+    if kind == 'boosted':
+        if HistGradientBoostingClassifier is None:
+            raise ImportError('boosted stages need scikit-learn 0.21 or '
+                              'later')
+        return HistGradientBoostingClassifier()
+    raise ValueError("unknown stage kind '{}', expected 'forest' or "
+                     "'boosted'".format(kind))
+
+
+def fit_stage(X, y, paramgrid, kind='forest', search='grid',
+              random_state=None):
+    """
+    Args:
+        X (2d numpy array): the feature matrix of the stage
+        y (1d numpy array): the targets
+        paramgrid (dictionary): the grid to search over
+        kind (str): the kind of model, see stage_model
+        search (str): the kind of search, see gridsearch
+        random_state (int): the seed of a successive halving search
+    Returns:
+        model (sklearn classifier model): the best model of the gridsearch
+    """
+    model, _ = gridsearch(paramgrid, stage_model(kind), X, y, search=search,
+                          random_state=random_state)
+    return model
+
+
+def load_training_block(cache, random_state=0):
+    """
+    Args:
+        cache (ArtifactCache): where the stage results are cached
+        random_state (int): the seed of the splits
+    Returns:
+        trained (dict): the split, the stacked block of the training rows
+        followed by the test rows with the history and behavior rate
+        features filled in, its train and test views, and the cache keys of
+        the stages so far
+    """
+    keys = {}
+    keys['frames'], frames = \
+        cache.cached('frames', [file_digest(filename)
+                                for filename in TRAINING_FILES],
+                     load_training_frames)
+    keys['split'], split = \
+        cache.cached('split', [keys['frames'], random_state],
+                     lambda: split_training_data(frames,
+                                                 random_state=random_state))
+    keys['matrix'], matrix = \
+        cache.cached('matrix', [keys['split']],
+                     lambda: build_training_matrix(split))
+    block = EnsembleBlock(V2_SCHEMA, matrix)
+    n_train = split['X_train'].shape[0]
+    train_block = block.rows(0, n_train)
+    test_block = block.rows(n_train, len(block))
+    return {'split': split,
+            'block': block,
+            'train_block': train_block,
+            'test_block': test_block,
+            'keys': keys}
+
+
+def train_ensemble_stages(cache=None, random_state=0, paramgrids=None,
+                          stage_kinds=FOREST_STAGES, search='grid'):
+    """
+    Args:
+        cache (ArtifactCache): where the stage results are cached, defaults
+        to models/cache
+        random_state (int): the seed of the splits, and of the searches if
+        they are successive halving searches
+        paramgrids (tuple): the grids of the history, behavior rate, and
+        ensemble models, defaulting to the grids of their stage kinds
+        stage_kinds (tuple): the kind of model of every stage, 'forest' or
+        'boosted', see stage_model
+        search (str): how every stage is searched, see gridsearch
+    Returns:
+        trained (dict): the output of load_training_block with the base
+        model probabilities filled in, the three fit models, and the cache
+        keys of every stage
+    """
+    cache = cache or ArtifactCache()
+    paramgrids = paramgrids or tuple(STAGE_PARAMGRIDS[kind][stage] for
+                                     stage, kind in enumerate(stage_kinds))
+    trained = load_training_block(cache, random_state)
+    block = trained['block']
+    train_block = trained['train_block']
+    keys = trained['keys']
+    y_train = trained['split']['y_train']
+    keys['history_model'], model = \
+        cache.cached('history_model', [keys['matrix'], paramgrids[0],
+                                       stage_kinds[0], search, random_state],
+                     lambda: fit_stage(train_block.history, y_train,
+                                       paramgrids[0], stage_kinds[0],
+                                       search, random_state))
+    keys['behavior_model'], modelb = \
+        cache.cached('behavior_model', [keys['matrix'], paramgrids[1],
+                                        stage_kinds[1], search, random_state],
+                     lambda: fit_stage(train_block.behavior, y_train,
+                                       paramgrids[1], stage_kinds[1],
+                                       search, random_state))
+    keys['base_probas'], base_probas = \
+        cache.cached('base_probas', [keys['history_model'],
+                                     keys['behavior_model']],
+                     lambda: np.column_stack(
+                         (model.predict_proba(block.history)[:, 1],
+                          modelb.predict_proba(block.behavior)[:, 1])))
+    block.base_probas[:] = base_probas
+    keys['ensemble_model'], model_ens = \
+        cache.cached('ensemble_model', [keys['base_probas'], paramgrids[2],
+                                        stage_kinds[2], search, random_state],
+                     lambda: fit_stage(train_block.matrix, y_train,
+                                       paramgrids[2], stage_kinds[2],
+                                       search, random_state))
+    trained['models'] = (model, modelb, model_ens)
+    return trained
+
+
+def train_stacked_stages(cache=None, random_state=0,
+                         paramgrids=(HISTORY_PARAMGRID, BEHAVIOR_PARAMGRID,
+                                     ENSEMBLE_PARAMGRID),
+                         n_folds=5, merge_folds=False):
+    """
+    Args:
+        cache (ArtifactCache): where the stage results are cached, defaults
+        to models/cache
+        random_state (int): the seed of the splits and the folds
+        paramgrids (tuple): the grids of the history, behavior rate, and
+        ensemble models, with one value per parameter
+        n_folds (int): the number of out of fold stacking folds
+        merge_folds (boolean): whether the base models are the merged full
+        size fold models instead of a final fit on all the rows, see
+        stacking.fit_out_of_fold
+    Returns:
+        trained (dict): the same as train_ensemble_stages, where the ensemble
+        model is fit on out of fold base model probabilities of the training
+        rows, and the test rows get the probabilities of the final base
+        models
+    """
+    cache = cache or ArtifactCache()
+    trained = load_training_block(cache, random_state)
+    train_block = trained['train_block']
+    test_block = trained['test_block']
+    params = [grid_params(paramgrid) for paramgrid in paramgrids]
+    trained['keys']['stacked'], (models, oof_probas) = \
+        cache.cached('stacked', [trained['keys']['matrix'], paramgrids,
+                                 n_folds, merge_folds, random_state],
+                     lambda: fit_out_of_fold(train_block,
+                                             trained['split']['y_train'],
+                                             *params, n_folds=n_folds,
+                                             merge_folds=merge_folds,
+                                             random_state=random_state))
+    train_block.base_probas[:] = oof_probas
+    model, modelb, _ = models
+    test_block.set_base_probas(
+        model.predict_proba(test_block.history)[:, 1],
+        modelb.predict_proba(test_block.behavior)[:, 1])
+    trained['models'] = models
+    return trained
+
+
+def train_oob_stages(cache=None, random_state=0,
+                     paramgrids=(HISTORY_PARAMGRID, BEHAVIOR_PARAMGRID,
+                                 ENSEMBLE_PARAMGRID)):
+    """
+    Args:
+        cache (ArtifactCache): where the stage results are cached, defaults
+        to models/cache
+        random_state (int): the seed of the splits
+        paramgrids (tuple): the grids of the history, behavior rate, and
+        ensemble models, every candidate is fit once and picked by its out
+        of bag accuracy
+    Returns:
+        trained (dict): the same as train_ensemble_stages, where the ensemble
+        model is fit on the out of bag base model probabilities of the
+        training rows, the test rows get the probabilities of the whole base
+        models, and oob holds the out of bag accuracy, confusion matrix and
+        probabilities of every stage
+    """
+    cache = cache or ArtifactCache()
+    trained = load_training_block(cache, random_state)
+    train_block = trained['train_block']
+    test_block = trained['test_block']
+    keys = trained['keys']
+    y_train = trained['split']['y_train']
+    keys['history_oob'], model = \
+        cache.cached('history_oob', [keys['matrix'], paramgrids[0]],
+                     lambda: gridsearch(paramgrids[0],
+                                        RandomForestClassifier(n_jobs=-1),
+                                        train_block.history, y_train,
+                                        search='oob')[0])
+    keys['behavior_oob'], modelb = \
+        cache.cached('behavior_oob', [keys['matrix'], paramgrids[1]],
+                     lambda: gridsearch(paramgrids[1],
+                                        RandomForestClassifier(n_jobs=-1),
+                                        train_block.behavior, y_train,
+                                        search='oob')[0])
+    train_block.set_base_probas(oob_probas(model, train_block.history),
+                                oob_probas(modelb, train_block.behavior))
+    test_block.set_base_probas(
+        model.predict_proba(test_block.history)[:, 1],
+        modelb.predict_proba(test_block.behavior)[:, 1])
+    keys['ensemble_oob'], model_ens = \
+        cache.cached('ensemble_oob', [keys['history_oob'],
+                                      keys['behavior_oob'], paramgrids[2]],
+                     lambda: gridsearch(paramgrids[2],
+                                        RandomForestClassifier(n_jobs=-1),
+                                        train_block.matrix, y_train,
+                                        search='oob')[0])
+    trained['models'] = (model, modelb, model_ens)
+    trained['oob'] = dict(
+        (stage, oob_report(forest, X, y_train, fit=False))
+        for stage, forest, X in (('history', model, train_block.history),
+                                 ('behavior', modelb, train_block.behavior),
+                                 ('ensemble', model_ens, train_block.matrix)))
+    for stage in ('history', 'behavior', 'ensemble'):
+        print('this is the out of bag performance of the {} '
+              'model'.format(stage))
+        print(trained['oob'][stage]['accuracy'])
+        print(trained['oob'][stage]['confusion_matrix'])
+    return trained
+
+
+def refit_ensemble_stages(trained, cache=None):
+    """
+    Args:
+        trained (dict): the output of train_ensemble_stages
+        cache (ArtifactCache): where the stage results are cached
+    Returns:
+        models (tuple): copies of the history, behavior rate, and ensemble
+        models with the same parameters fit to the training and test rows
+    """
+    cache = cache or ArtifactCache()
+    block = trained['block']
+    keys = trained['keys']
+    y_all = np.hstack((trained['split']['y_train'],
+                       trained['split']['y_test']))
+    model, modelb, model_ens = trained['models']
+    _, model = cache.cached('history_refit', [keys['history_model']],
+                            lambda: clone(model).fit(block.history, y_all))
+    _, modelb = cache.cached('behavior_refit', [keys['behavior_model']],
+                             lambda: clone(modelb).fit(block.behavior,
+                                                       y_all))
+    _, model_ens = cache.cached('ensemble_refit', [keys['ensemble_model']],
+                                lambda: clone(model_ens).fit(block.matrix,
+                                                             y_all))
+    return model, modelb, model_ens
+
+
+def report_ensemble_stages(trained):
+    """
+    Args:
+        trained (dict): the output of train_ensemble_stages
+    Returns:
+        nothing, prints the performance of every stage on the training
+        data, the test data, and the new kind of spam
+    """
+    split = trained['split']
+    train_block = trained['train_block']
+    test_block = trained['test_block']
+    y_train_b = split['y_train']
+    y_test_b = split['y_test']
+    model, modelb, model_ens = trained['models']
     print('this is the portion that checks absolute user behavior values')
-    y = df.pop('label_y')
-    y = y.values
-    X = df.values
-    ycyrus = cyrusdf.pop('label_y')
-    ycyrus = ycyrus.values
-    yceleb = celebdf.pop('label_y')
-    yceleb = yceleb.values
-    cyrusX = cyrusdf.values
-    celebX = celebdf.values
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=.2)
-    cyX_train, cyX_test, cyy_train, cyy_test = \
-        train_test_split(cyrusX, ycyrus, test_size=.2)
-    ceX_train, ceX_test, cey_train, cey_test = \
-        train_test_split(celebX, yceleb, test_size=.2)
-    X_train_b, y_train_b = balance_classes(RandomUnderSampler(),
-                                           X_train, y_train)
-    X_test_b, y_test_b = balance_classes(RandomUnderSampler(),
-                                         X_test, y_test)
-    X_train_b = np.vstack((X_train_b, cyX_train, ceX_train))
-    y_train_b = np.hstack((y_train_b, cyy_train, cey_train))
-    X_test_b = np.vstack((X_test_b, cyX_test, ceX_test))
-    y_test_b = np.hstack((y_test_b, cyy_test, cey_test))
-    weights = 1
-    X_train_bw = X_train_b * weights
-    paramgrid = {'n_estimators': [200],
-                 'max_features': ['auto'],
-                 'criterion': ['entropy'],
-                 'min_samples_split': [10],
-                 'min_samples_leaf': [8],
-                 'max_depth': [30],
-                 'bootstrap': [True]}
-    model = RandomForestClassifier(n_jobs=-1)
-    model, gs = gridsearch(paramgrid, model, X_train_bw, y_train_b)
     print("\nthis is the model performance on the training data\n")
-    view_classification_report(model, X_train_bw, y_train_b)
-    print(confusion_matrix(y_train_b, model.predict(X_train_bw)))
+    view_classification_report(model, train_block.history, y_train_b)
+    print(confusion_matrix(y_train_b, model.predict(train_block.history)))
     print("this is the model performance on the test data\n")
-    view_classification_report(model, X_test_b*weights, y_test_b)
-    print(confusion_matrix(y_test_b, model.predict(X_test_b*weights)))
-    print("this is the model performance on different split ratios\n")
+    view_classification_report(model, test_block.history, y_test_b)
+    print(confusion_matrix(y_test_b, model.predict(test_block.history)))
     print("\nthese are the model feature importances\n")
-    view_feature_importances(df, model)
-    y_pred = model.predict_proba(X_train_bw)[:, 1]
+    histdf = pd.DataFrame(train_block.history, columns=V2_SCHEMA.features)
+    view_feature_importances(histdf, model)
     print('this is the portion that checks user behavior rate values')
-    X_train_bwr = X_train_bw/X_train_bw[:, 13].reshape(-1, 1)
-    weights = 1
-    X_train_bwr = X_train_bwr * weights
-    paramgrid = {'n_estimators': [200],
-                 'max_features': ['auto'],
-                 'criterion': ['entropy'],
-                 'min_samples_split': [16],
-                 'min_samples_leaf': [18],
-                 'max_depth': [30],
-                 'bootstrap': [True]}
-    modelb = RandomForestClassifier(n_jobs=-1)
-    modelb, gs = gridsearch(paramgrid, modelb, X_train_bwr, y_train_b)
     print("\nthis is the model performance on the training data\n")
-    view_classification_report(modelb, X_train_bwr, y_train_b)
-    print(confusion_matrix(y_train_b, modelb.predict(X_train_bwr)))
+    view_classification_report(modelb, train_block.behavior, y_train_b)
+    print(confusion_matrix(y_train_b, modelb.predict(train_block.behavior)))
     print("this is the model performance on the test data\n")
-    X_test_br = X_test_b * weights/X_test_b[:, 13].reshape(-1, 1)
-    view_classification_report(modelb, X_test_br, y_test_b)
-    print(confusion_matrix(y_test_b, modelb.predict(X_test_br)))
+    view_classification_report(modelb, test_block.behavior, y_test_b)
+    print(confusion_matrix(y_test_b, modelb.predict(test_block.behavior)))
     print("\nthese are the model feature importances\n")
-    view_feature_importances(df, modelb)
-    y_pred_b = modelb.predict_proba(X_train_bwr)[:, 1]
+    view_feature_importances(histdf, modelb)
     print('this is the portion that ensembles these two facets')
-    ensemble_X = np.hstack((X_train_bw, X_train_bwr,
-                            y_pred.reshape(-1, 1), y_pred_b.reshape(-1, 1)))
-    model_ens = RandomForestClassifier(n_jobs=-1)
-    paramgrid = {'n_estimators': [500],
-                 'max_features': ['auto'],
-                 'criterion': ['entropy'],
-                 'min_samples_split': [16],
-                 'min_samples_leaf': [11],
-                 'max_depth': [20],
-                 'bootstrap': [True]}
-    model_ens, gs = gridsearch(paramgrid, model_ens, ensemble_X, y_train_b)
     print("\nthis is the model performance on the training data\n")
-    view_classification_report(model_ens, ensemble_X, y_train_b)
-    print(confusion_matrix(y_train_b, model_ens.predict(ensemble_X)))
+    view_classification_report(model_ens, train_block.matrix, y_train_b)
+    print(confusion_matrix(y_train_b, model_ens.predict(train_block.matrix)))
     print("this is the model performance on the test data\n")
-    y_pred_test = model.predict_proba(X_test_b)[:, 1]
-    X_test_br = X_test_b/X_test_b[:, 13].reshape(-1, 1)
-    y_pred_test_b = modelb.predict_proba(X_test_br)[:, 1]
-    ensemble_X_test = np.hstack((X_test_b, X_test_br,
-                                 y_pred_test.reshape(-1, 1),
-                                 y_pred_test_b.reshape(-1, 1)))
-    view_classification_report(model_ens, ensemble_X_test, y_test_b)
-    print(confusion_matrix(y_test_b, model_ens.predict(ensemble_X_test)))
-    columns = \
-        list(df.columns)+[column+'_rate' for
-                          column in df.columns] + \
-        ['pred_model_1', 'pred_model_2']
-    ensdf = pd.DataFrame(ensemble_X, columns=columns)
+    view_classification_report(model_ens, test_block.matrix, y_test_b)
+    print(confusion_matrix(y_test_b, model_ens.predict(test_block.matrix)))
+    ensdf = pd.DataFrame(train_block.matrix,
+                         columns=V2_SCHEMA.ensemble_columns)
     view_feature_importances(ensdf, model_ens)
     print('evaluating the model on the new kind of spam')
-    newX = np.vstack((cyX_test, ceX_test))
-    newXbr = newX/newX[:, 13].reshape(-1, 1)
-    newy = np.hstack((cyy_test, cey_test))
-    newy_pred = model.predict(newX)
-    newy_pred_b = modelb.predict(newXbr)
-    newXens = np.hstack((newX, newXbr,
-                         newy_pred.reshape(-1, 1),
-                         newy_pred_b.reshape(-1, 1)))
-    print(confusion_matrix(newy, model_ens.predict(newXens)))
+    new_block = V2_SCHEMA.block_from_history(split['X_new'])
+    newy_pred = model.predict(new_block.history)
+    newy_pred_b = modelb.predict(new_block.behavior)
+    new_block.set_base_probas(newy_pred, newy_pred_b)
+    print(confusion_matrix(split['y_new'],
+                           model_ens.predict(new_block.matrix)))
+
+
+def create_ensemble_model(compress=False, cache=None, random_state=0,
+                          stacking='in_sample', n_folds=5,
+                          stage_kinds=FOREST_STAGES, profiler=None):
+    """
+    Args:
+        compress (boolean): whether to also report the accuracy, size and
+        latency of greedily compressed versions of the ensemble, choosing
+        trees on half of the held out test set and measuring on the other
+        half, and write that curve to models/ensemble_rf_v2_compression.csv
+        cache (ArtifactCache): where the stage results are cached, defaults
+        to models/cache
+        random_state (int): the seed of the splits
+        stacking (str): 'in_sample' gridsearches every stage, fitting the
+        ensemble model on in-sample probabilities, and then refits all
+        three forests on the training and test rows; 'out_of_fold' trains
+        with one pass of out of fold stacking (see train_stacked_stages)
+        and 'out_of_bag' picks every stage by out of bag accuracy and fits
+        the ensemble model on out of bag probabilities (see
+        train_oob_stages), and both pickle their models as they are
+        n_folds (int): the number of out of fold stacking folds
+        stage_kinds (tuple): the kind of model of every stage, 'forest' or
+        'boosted' (see stage_model and stage_comparison), boosted stages
+        only work with in_sample stacking and without compress
+        profiler (TrainingProfiler): records the time and memory of every
+        stage and the size of the models, given to the cache if it has no
+        profiler yet, and written to models/ensemble_rf_v2_profile.json
+    Returns
+        nothing, this prints out the performance of the model and then
+        saves it to a pkl file, it takes in the training user tweet data,
+        the miley cyrus data, and the celebrity users data, as additional
+        information to train the model to sense spam in today's times
+    """
+    cache = cache or ArtifactCache()
+    profiler = profiler or cache.profiler or TrainingProfiler()
+    cache.profiler = cache.profiler or profiler
+    if tuple(stage_kinds) != FOREST_STAGES and \
+            (compress or stacking != 'in_sample'):
+        raise ValueError('compression, out of fold and out of bag stacking '
+                         'need forests in every stage')
+    if stacking == 'out_of_fold':
+        trained = train_stacked_stages(cache, random_state, n_folds=n_folds)
+    elif stacking == 'out_of_bag':
+        trained = train_oob_stages(cache, random_state)
+    else:
+        trained = train_ensemble_stages(cache, random_state,
+                                        stage_kinds=stage_kinds,
+                                        search='halving')
+    model, modelb, model_ens = trained['models']
+    X_test_b = trained['test_block'].history
+    y_test_b = trained['split']['y_test']
+    with profiler.stage('report'):
+        report_ensemble_stages(trained)
+        print("this is the agreement and throughput of cascade bands\n")
+        calibrate_cascade_band(model, modelb, model_ens, X_test_b, y_test_b)
+    if compress:
+        print('this is the size, latency and accuracy of smaller ensembles')
+        X_select, X_eval, y_select, y_eval = \
+            train_test_split(X_test_b, y_test_b, test_size=.5,
+                             random_state=random_state)
+        with profiler.stage('compression_curve'):
+            curve, _ = compression_curve(model, modelb, model_ens,
+                                         X_select, y_select, X_eval, y_eval)
+        curve.to_csv('models/ensemble_rf_v2_compression.csv', index=False)
+    if stacking == 'in_sample':
+        print('fitting to all and writing to pkl')
+        model, modelb, model_ens = refit_ensemble_stages(trained, cache)
+    for model_name, fit_model in (('account_history_rf_v2', model),
+                                  ('behavior_rate_rf_v2', modelb),
+                                  ('ensemble_rf_v2', model_ens)):
+        with profiler.stage('pickle_' + model_name):
+            write_model_to_pkl(fit_model, model_name)
+        profiler.record_model(model_name, fit_model,
+                              'models/{}_model.pkl'.format(model_name))
+    print('this is where the time and memory of training went')
+    profiler.summary()
+    profiler.write('models/ensemble_rf_v2_profile.json')
+
+if __name__ == "__main__":
+    trained = train_ensemble_stages()
+    report_ensemble_stages(trained)
     # print('fitting to all and writing to pkl')
-    # y_all = np.hstack((y_train_b, y_test_b))
-    # behavior_X = np.vstack((X_train_bw, X_test_b))
-    # behavior_rate_X = np.vstack((X_train_bwr, X_test_br))
-    # ensemble_X = np.vstack((ensemble_X, ensemble_X_test))
-    # model.fit(behavior_X, y_all)
-    # modelb.fit(behavior_rate_X, y_all)
-    # model_ens.fit(ensemble_X, y_all)
+    # model, modelb, model_ens = refit_ensemble_stages(trained)
     # write_model_to_pkl(model, 'account_history_rf_v2')
     # write_model_to_pkl(modelb, 'behavior_rate_rf_v2')
     # write_model_to_pkl(model_ens, 'ensemble_rf_v2')
@@ -1,5 +1,14 @@
 import dill as pickle
-from tweet_scrape_processor import process_tweet, process_tweet_v2
+from tweet_scrape_processor import extract_user_features, \
+    extract_user_features_v2
+from prediction_cache import user_fingerprint
+from feature_schema import V1_SCHEMA, V2_SCHEMA
+from parallel_featurizer import parallel_featurize_tweets_v2
+from model_registry import models, bundles, load_pickled_model
+from flat_forest import FlatEnsemble
+from multiprocessing.pool import ThreadPool
+import copy
+import os
 import numpy as np
 import time
 import pandas as pd
@@ -23,28 +32,60 @@ These functions simply need a list of twitter json objects, and these
 functions will process them, and produce a dataframe with the username,
 the tweet, and the prediction, for the next step in the process
 which is to process the tweet text data into the meaninful topics
+
+The models are loaded through model_registry the first time a prediction
+is made rather than on import, so the v1 models are only ever loaded if
+make_lightweight_predictions is called. Once a v2 bundle has been published
+with model_registry.publish_bundle, the v2 predictions use its live version
+instead of the fixed model files, and pick up a newly activated version
+without restarting
 """
 
 
-def load_pickled_model(filename):
+V1_MODELS = ('account_history_rf', 'behavior_rate_rf', 'ensemble_rf')
+V2_MODELS = ('account_history_rf_v2', 'behavior_rate_rf_v2', 'ensemble_rf_v2')
+V2_FLAT = 'ensemble_rf_v2'
+V2_BUNDLE = 'ensemble_rf_v2'
+PREDICTION_COLUMNS = ['id', 'text', 'screen_name', 'pred']
+
+
+def normalize_texts(texts):
     """
     Args:
-        filename (str): path and name of the model to load from a pkl file
+        texts (list): the text of every tweet
     Returns:
-        model (sklearn classifier model): fit already, and ready to predict
+        normalized (list): the texts transliterated to ascii with unidecode,
+        which runs once per distinct text since retweets repeat the same
+        text many times
     """
-    with open(filename, 'r') as f:
-        model = pickle.load(f)
-    f.close()
-    return model
+    normalized = {}
+    for text in texts:
+        if text not in normalized:
+            normalized[text] = unidecode(text)
+    return [normalized[text] for text in texts]
 
 
-history_model = load_pickled_model('models/account_history_rf_model.pkl')
-behavior_model = load_pickled_model('models/behavior_rate_rf_model.pkl')
-ensemble_model = load_pickled_model('models/ensemble_rf_model.pkl')
-history_model_v2 = load_pickled_model('models/account_history_rf_v2_model.pkl')
-behavior_model_v2 = load_pickled_model('models/behavior_rate_rf_v2_model.pkl')
-ensemble_model_v2 = load_pickled_model('models/ensemble_rf_v2_model.pkl')
+def predictions_frame(tweet_list, pred):
+    """
+    Args:
+        tweet_list (list): list of json tweet objects downloaded from twitter
+        pred (1d numpy array): the prediction of every tweet
+    Returns
+        predicted_tweets (dataframe): a dataframe with the user id, the
+        text content of the tweet, the screen_name of the user, and
+        the predicted value where 1 = fake and 0 means human, built column
+        by column so that the id and pred columns are integer arrays
+    """
+    n_tweets = len(tweet_list)
+    ids = np.fromiter((tweet['user']['id'] for tweet in tweet_list),
+                      dtype=np.int64, count=n_tweets)
+    texts = normalize_texts([tweet['text'] for tweet in tweet_list])
+    screen_names = [tweet['user']['screen_name'] for tweet in tweet_list]
+    return pd.DataFrame({'id': ids,
+                         'text': texts,
+                         'screen_name': screen_names,
+                         'pred': np.asarray(pred, dtype=np.int64)},
+                        columns=PREDICTION_COLUMNS)
 
 
 def make_lightweight_predictions(tweet_list):
@@ -57,57 +98,370 @@ def make_lightweight_predictions(tweet_list):
         the predicted value where 1 = fake and 0 means human
     """
     start = time.time()
-    processed_tweets = np.array([process_tweet(tweet) for tweet in tweet_list])
-    tweet_history = processed_tweets[:, :19].astype(float)
-    tweets = processed_tweets[:, 19:]
-    tweet_behavior = \
-        tweet_history/tweet_history[:, 13].reshape(-1, 1)
+    history_model, behavior_model, ensemble_model = \
+        [models.get(name) for name in V1_MODELS]
+    block = V1_SCHEMA.allocate(len(tweet_list))
+    for row, tweet in zip(block.history, tweet_list):
+        row[:] = extract_user_features(tweet)
+    block.fill_behavior_rates()
     print("loading tweets: ", time.time() - start)
-    y_pred = history_model.predict_proba(tweet_history)[:, 1]
-    y_pred_b = behavior_model.predict_proba(tweet_behavior)[:, 1]
-    tweet_ensemble = np.hstack((tweet_history,
-                                tweet_behavior,
-                                y_pred.reshape(-1, 1),
-                                y_pred_b.reshape(-1, 1)))
-    pred = ensemble_model.predict(tweet_ensemble)
-    predicted_tweets = np.hstack((tweets, pred.reshape(-1, 1)))
-    columns = ['id', 'text', 'screen_name', 'pred']
-    predicted_tweets = pd.DataFrame(predicted_tweets, columns=columns)
-    predicted_tweets.pred = predicted_tweets.pred.apply(float).apply(int)
-    predicted_tweets.text = predicted_tweets.text.apply(unidecode)
-    return predicted_tweets
+    y_pred = history_model.predict_proba(block.history)[:, 1]
+    y_pred_b = behavior_model.predict_proba(block.behavior)[:, 1]
+    block.set_base_probas(y_pred, y_pred_b)
+    pred = ensemble_model.predict(block.matrix)
+    return predictions_frame(tweet_list, pred)
 
 
-def make_lightweight_predictions_v2(tweet_list):
+def featurize_tweets_v2(tweet_list, n_processes=1, dtype=np.float64):
     """
     Args:
         tweet_list (list): list of json tweet objects downloaded from twitter
+        n_processes (int): the number of processes to featurize with, more
+        than one writes the features into a shared memory block from
+        worker processes, which pays off for whole collections
+        dtype (numpy dtype): the float type of the block, the forests
+        compare their inputs as float32 so a float32 block halves the
+        memory of the stacked input without sklearn having to cast it
+    Returns:
+        block (EnsembleBlock): the stacked ensemble input of the tweets with
+        the account history and relative volume features filled in
+    """
+    if n_processes > 1:
+        block = parallel_featurize_tweets_v2(tweet_list, n_processes, dtype)
+    else:
+        block = V2_SCHEMA.allocate(len(tweet_list), dtype=dtype)
+        for row, tweet in zip(block.history, tweet_list):
+            row[:] = extract_user_features_v2(tweet)
+    return block
+
+
+def load_models_v2(flat=False):
+    """
+    Args:
+        flat (boolean): whether to get the flat forests exported by
+        flat_forest.export_flat_ensemble instead of the sklearn models
+    Returns:
+        models (list): the history, behavior rate, and ensemble models, all
+        three from the live bundle if one was published
+    """
+    if bundles.exists(V2_BUNDLE):
+        bundle = bundles.current(V2_BUNDLE)
+        V2_SCHEMA.check_columns(bundle.schema.features)
+        if not flat:
+            return bundle.stages
+        if bundle.flat is None:
+            raise ValueError('version {} of {} was published without a flat '
+                             'export'.format(bundle.version, V2_BUNDLE))
+        return [getattr(bundle.flat, stage) for stage in FlatEnsemble.stages]
+    if flat:
+        flat_ensemble = models.get_flat(V2_FLAT)
+        return [getattr(flat_ensemble, stage)
+                for stage in FlatEnsemble.stages]
+    return [models.get(name) for name in V2_MODELS]
+
+
+def scoring_key(flat=False, cascade_band=None, dtype=np.float64):
+    """
+    Args:
+        flat (boolean): whether the flat ensemble scores the tweets
+        cascade_band (tuple): the optional cascade band
+        dtype (numpy dtype): the float type of the stacked input
+    Returns:
+        key (tuple): the live bundle version (None for the pickled models)
+        and the scoring options that change predictions, so that cached
+        predictions are only reused for the same models and options
+    """
+    version = bundles.current(V2_BUNDLE).version \
+        if bundles.exists(V2_BUNDLE) else None
+    return (version, bool(flat),
+            None if cascade_band is None else tuple(cascade_band),
+            np.dtype(dtype).name)
+
+
+def cascade_mask(y_pred, y_pred_b, cascade_band):
+    """
+    Args:
+        y_pred (1d numpy array): the probabilities of the history model
+        y_pred_b (1d numpy array): the probabilities of the behavior model
+        cascade_band (tuple): the (low, high) uncertainty band
+    Returns:
+        uncertain (1d numpy array): True for the rows that need the ensemble
+        model, which are the ones where the two base models do not both
+        fall below low or both fall above high
+    """
+    low, high = cascade_band
+    return ~(((y_pred <= low) & (y_pred_b <= low)) |
+             ((y_pred >= high) & (y_pred_b >= high)))
+
+
+def score_stacked_stage(ensemble_model, block, cascade_band=None):
+    """
+    Args:
+        ensemble_model (sklearn classifier model): the stacked ensemble model
+        block (EnsembleBlock): the stacked ensemble input with the base model
+        columns already filled
+        cascade_band (tuple): optional (low, high) band, rows whose base
+        model probabilities agree outside of it skip the ensemble model and
+        take the base models' call, with the mean of the base probabilities
+        as their ensemble probability
+    Returns:
+        y_proba_ens (1d numpy array): the probability of being fake
+        pred (1d numpy array): the final prediction
+    """
+    classes = ensemble_model.classes_
+    if cascade_band is None:
+        proba = ensemble_model.predict_proba(block.matrix)
+        return proba[:, 1], classes.take(np.argmax(proba, axis=1))
+    y_pred = block.base_probas[:, 0]
+    y_pred_b = block.base_probas[:, 1]
+    uncertain = cascade_mask(y_pred, y_pred_b, cascade_band)
+    y_proba_ens = (y_pred + y_pred_b) / 2
+    pred = classes.take((y_pred >= cascade_band[1]).astype(int))
+    if uncertain.any():
+        proba = ensemble_model.predict_proba(block.matrix[uncertain])
+        y_proba_ens[uncertain] = proba[:, 1]
+        pred[uncertain] = classes.take(np.argmax(proba, axis=1))
+    return y_proba_ens, pred
+
+
+def distinct_rows(X):
+    """
+    Args:
+        X (2d numpy array): a feature matrix
+    Returns:
+        unique_ix (1d numpy array): the index of the first occurrence of
+        each distinct row
+        inverse (1d numpy array): for every row, the position of its
+        distinct row in unique_ix
+    """
+    X = np.ascontiguousarray(X)
+    rows = X.view(np.dtype((np.void, X.dtype.itemsize * X.shape[1])))
+    _, unique_ix, inverse = np.unique(rows.ravel(), return_index=True,
+                                      return_inverse=True)
+    return unique_ix, inverse.ravel()
+
+
+def with_n_jobs(model, n_jobs):
+    """
+    Args:
+        model (sklearn classifier model or FlatForest): a fit model
+        n_jobs (int): the number of threads the model may predict with
+    Returns:
+        model: a shallow copy of the model predicting with n_jobs threads,
+        so the shared model in the registry is never modified, or the model
+        itself if it has no n_jobs (i.e. a flat forest)
+    """
+    if not hasattr(model, 'n_jobs'):
+        return model
+    model = copy.copy(model)
+    model.n_jobs = n_jobs
+    return model
+
+
+_base_stage_pool = [None, None]
+
+
+def base_stage_pool():
+    """
+    Args:
+        none
+    Returns:
+        pool (ThreadPool): the one background thread that runs the history
+        model while the calling thread runs the behavior rate model, made
+        again in a forked child since threads do not survive a fork
+    """
+    if _base_stage_pool[0] != os.getpid():
+        _base_stage_pool[:] = [os.getpid(), ThreadPool(1)]
+    return _base_stage_pool[1]
+
+
+def score_base_stages(history_model, behavior_model, block, n_jobs=None):
+    """
+    Args:
+        history_model (sklearn classifier model): the fit history model
+        behavior_model (sklearn classifier model): the fit behavior rate
+        model
+        block (EnsembleBlock): a block with the behavior rates filled in
+        n_jobs (int): the total number of threads both base models may use,
+        split between them while they run at the same time, or None to run
+        them one after the other with the n_jobs they were pickled with
+    Returns:
+        y_pred (1d numpy array): the history model probabilities
+        y_pred_b (1d numpy array): the behavior rate model probabilities
+    """
+    if n_jobs is None or n_jobs < 2:
+        if n_jobs is not None:
+            history_model = with_n_jobs(history_model, 1)
+            behavior_model = with_n_jobs(behavior_model, 1)
+        return (history_model.predict_proba(block.history)[:, 1],
+                behavior_model.predict_proba(block.behavior)[:, 1])
+    history_jobs = n_jobs // 2
+    history_result = base_stage_pool().apply_async(
+        with_n_jobs(history_model, history_jobs).predict_proba,
+        (block.history,))
+    y_pred_b = with_n_jobs(behavior_model, n_jobs - history_jobs) \
+        .predict_proba(block.behavior)[:, 1]
+    y_pred = history_result.get()[:, 1]
+    return y_pred, y_pred_b
+
+
+def score_ensemble_block_v2(block, flat=False, cascade_band=None,
+                            dedupe=False, n_jobs=None):
+    """
+    Args:
+        block (EnsembleBlock): the output of featurize_tweets_v2, the
+        behavior rate and base model columns are filled in place
+        flat (boolean): whether to score with the flat ensemble exported by
+        flat_forest.export_flat_ensemble instead of the sklearn models, the
+        results are identical
+        cascade_band (tuple): optional (low, high) band so that only tweets
+        the base models are unsure or disagree about go through the
+        ensemble model, see score_stacked_stage
+        dedupe (boolean): whether to score every distinct feature row only
+        once and broadcast the result back to all the tweets that share it,
+        which are mostly the many tweets of the same prolific account
+        n_jobs (int): the thread budget, the history and behavior rate
+        models run at the same time splitting it between them, and then the
+        ensemble model uses all of it, see score_base_stages
+    Returns:
+        probas (2d numpy array): one row per tweet with the probability of
+        being fake according to the history model, the behavior rate model,
+        and the ensemble model
+        pred (1d numpy array): the prediction of the ensemble model
+    """
+    if dedupe:
+        unique_ix, inverse = distinct_rows(block.history)
+        if len(unique_ix) < len(block):
+            unique_block = block.schema.allocate(len(unique_ix),
+                                                 dtype=block.matrix.dtype)
+            unique_block.history[:] = block.history[unique_ix]
+            probas, pred = score_ensemble_block_v2(unique_block, flat,
+                                                   cascade_band,
+                                                   n_jobs=n_jobs)
+            return probas[inverse], pred[inverse]
+    history_model_v2, behavior_model_v2, ensemble_model_v2 = \
+        load_models_v2(flat)
+    block.fill_behavior_rates()
+    y_pred, y_pred_b = score_base_stages(history_model_v2, behavior_model_v2,
+                                         block, n_jobs)
+    block.set_base_probas(y_pred, y_pred_b)
+    if n_jobs is not None:
+        ensemble_model_v2 = with_n_jobs(ensemble_model_v2, n_jobs)
+    y_proba_ens, pred = score_stacked_stage(ensemble_model_v2, block,
+                                            cascade_band)
+    probas = np.column_stack((y_pred, y_pred_b, y_proba_ens))
+    return probas, pred
+
+
+def score_tweets_with_cache_v2(tweet_list, cache, n_processes=1,
+                               flat=False, cascade_band=None,
+                               dedupe=False, n_jobs=None,
+                               dtype=np.float64):
+    """
+    Args:
+        tweet_list (list): list of json tweet objects downloaded from twitter
+        cache (UserPredictionCache): the per-user cache to look up, users
+        that are new or whose counts changed are scored and stored in it
+        n_processes (int): the number of processes to featurize misses with
+        flat (boolean): whether to score misses with the flat ensemble
+        cascade_band (tuple): the optional cascade band to score misses with
+        dedupe (boolean): whether to score each distinct missed row once
+        n_jobs (int): the thread budget to score misses with
+        dtype (numpy dtype): the float type to featurize misses with
+    Returns:
+        pred (1d numpy array): the prediction of the ensemble model, where
+        a cached prediction is only reused if it was made by the live
+        bundle version with the same flat, cascade_band and dtype
+    """
+    pred = np.empty(len(tweet_list), dtype=int)
+    miss_ix = []
+    fingerprints = []
+    key = scoring_key(flat, cascade_band, dtype)
+    for ix, tweet in enumerate(tweet_list):
+        fingerprint = (key, user_fingerprint(tweet))
+        entry = cache.get(tweet['user']['id'], fingerprint)
+        if entry is None:
+            miss_ix.append(ix)
+            fingerprints.append(fingerprint)
+        else:
+            pred[ix] = entry['pred']
+    if miss_ix:
+        missed_tweets = [tweet_list[ix] for ix in miss_ix]
+        block = featurize_tweets_v2(missed_tweets, n_processes, dtype)
+        probas, missed_pred = score_ensemble_block_v2(block, flat,
+                                                      cascade_band, dedupe,
+                                                      n_jobs)
+        pred[miss_ix] = missed_pred
+        for row, (tweet, fingerprint) in enumerate(zip(missed_tweets,
+                                                       fingerprints)):
+            cache.put(tweet['user']['id'], fingerprint,
+                      block.history[row].copy(),
+                      probas[row], int(missed_pred[row]))
+    return pred
+
+
+def make_lightweight_predictions_v2(tweet_list, cache=None, n_processes=1,
+                                    flat=False, cascade_band=None,
+                                    dedupe=True, n_jobs=None,
+                                    dtype=np.float64):
+    """
+    Args:
+        tweet_list (list): list of json tweet objects downloaded from twitter
+        cache (UserPredictionCache): optional per-user cache so that only
+        new or changed accounts are featurized and scored by the forests
+        n_processes (int): the number of processes to featurize with, see
+        featurize_tweets_v2
+        flat (boolean): whether to score with the flat ensemble, see
+        score_ensemble_block_v2
+        cascade_band (tuple): optional (low, high) band, tweets whose base
+        model probabilities both fall outside of it on the same side skip
+        the ensemble model, see score_stacked_stage
+        dedupe (boolean): whether to score each distinct feature row once
+        and broadcast the prediction to every tweet that shares it, the
+        returned dataframe has one row per tweet either way
+        n_jobs (int): the number of threads the forests may use in total,
+        the history and behavior rate models run at the same time sharing
+        it, None keeps the n_jobs the models were pickled with and runs them
+        one after the other
+        dtype (numpy dtype): the float type of the stacked input, float32
+        gives the same predictions as float64 (see
+        compare_float32_predictions) with half the memory
     Returns
         predicted_tweets (dataframe): a dataframe with the user id, the
         text content of the tweet, the screen_name of the user, and
         the predicted value where 1 = fake and 0 means human
     """
-    start = time.time()
-    processed_tweets = np.array([process_tweet_v2(tweet)
-                                 for tweet in tweet_list])
-    tweet_history = processed_tweets[:, :23].astype(float)
-    tweets = processed_tweets[:, 23:]
-    tweet_behavior = \
-        tweet_history/tweet_history[:, 13].reshape(-1, 1)
-    print("loading tweets: ", time.time() - start)
-    y_pred = history_model_v2.predict_proba(tweet_history)[:, 1]
-    y_pred_b = behavior_model_v2.predict_proba(tweet_behavior)[:, 1]
-    tweet_ensemble = np.hstack((tweet_history,
-                                tweet_behavior,
-                                y_pred.reshape(-1, 1),
-                                y_pred_b.reshape(-1, 1)))
-    pred = ensemble_model_v2.predict(tweet_ensemble)
-    predicted_tweets = np.hstack((tweets, pred.reshape(-1, 1)))
-    columns = ['id', 'text', 'screen_name', 'pred']
-    predicted_tweets = pd.DataFrame(predicted_tweets, columns=columns)
-    predicted_tweets.pred = predicted_tweets.pred.apply(float).apply(int)
-    predicted_tweets.text = predicted_tweets.text.apply(unidecode)
-    return predicted_tweets
+    if cache is None:
+        block = featurize_tweets_v2(tweet_list, n_processes, dtype)
+        _, pred = score_ensemble_block_v2(block, flat, cascade_band,
+                                          dedupe, n_jobs)
+    else:
+        pred = score_tweets_with_cache_v2(tweet_list, cache, n_processes,
+                                          flat, cascade_band, dedupe, n_jobs,
+                                          dtype)
+    return predictions_frame(tweet_list, pred)
+
+
+def compare_float32_predictions(tweet_list, **kwargs):
+    """
+    Args:
+        tweet_list (list): list of json tweet objects downloaded from twitter
+        **kwargs: passed on to score_ensemble_block_v2 (i.e. flat,
+        cascade_band, dedupe)
+    Returns:
+        comparison (dict): the number of tweets, the number whose float32
+        prediction differs from the float64 one, and the largest absolute
+        difference of any of the three probabilities
+    """
+    results = []
+    for dtype in (np.float64, np.float32):
+        block = featurize_tweets_v2(tweet_list, dtype=dtype)
+        results.append(score_ensemble_block_v2(block, **kwargs))
+    (probas_64, pred_64), (probas_32, pred_32) = results
+    return {'n_tweets': len(tweet_list),
+            'n_mismatched': int(np.sum(pred_64 != pred_32)),
+            'max_proba_diff': float(np.max(np.abs(probas_64 - probas_32)))
+            if len(tweet_list) else 0.0}
 
 
 if __name__ == "__main__":
@@ -1,7 +1,8 @@
 import time
 from tweet_text_processor import process_real_and_fake_tweets_w_plots
 from tweet_scraper import download_tweets_given_search_query
-from lightweight_predictor import make_lightweight_predictions_v2
+from lightweight_predictor import make_lightweight_predictions_v2, \
+    load_models_v2
 from pymongo import MongoClient
 
 """
@@ -19,7 +20,7 @@ are downloaded through twitter's api
 
 def botboosted_demonstration(dbname, collection, verbose=True,
                              searchQuery='Your Topic',
-                             save=False):
+                             save=False, cache=None):
     """
     Args:
         dbname (str): the name of the mongodb to connect to which has
@@ -30,6 +31,8 @@ def botboosted_demonstration(dbname, collection, verbose=True,
         of the collection, to be used in the title of the barplots
         save (boolean): whether to save the prediction information to a
         csv or not
+        cache (UserPredictionCache): optional per-user cache shared across
+        queries, it is saved to its file after the predictions are made
     Returns:
          None, plots barplots and stacked barplots with representative tweets
          for that topic
@@ -39,6 +42,7 @@ def botboosted_demonstration(dbname, collection, verbose=True,
         totalstart = time.time()
         print('loading model...')
         start = time.time()
+    load_models_v2()
     if verbose:
         print("loading model took: ", time.time() - start)
         print('getting and processing tweets...')
@@ -52,7 +56,10 @@ def botboosted_demonstration(dbname, collection, verbose=True,
         print("loading and processing tweet data took: ", time.time() - start)
         print('making predictions...')
         start = time.time()
-    predicted_tweets = make_lightweight_predictions_v2(tweet_list)
+    predicted_tweets = make_lightweight_predictions_v2(tweet_list,
+                                                       cache=cache)
+    if cache is not None and cache.filename is not None:
+        cache.save()
     if save:
         filename = 'pred_v2_{}.csv'.format(searchQuery.replace(' ', '_'))
         predicted_tweets.to_csv(filename)
@@ -66,7 +73,7 @@ def botboosted_demonstration(dbname, collection, verbose=True,
         print("entire thing took: ", time.time() - totalstart)
 
 
-def botboosted(searchQuery, verbose=False, save=False):
+def botboosted(searchQuery, verbose=False, save=False, cache=None):
     """
     Args:
         searchQuery (str): this is a twitter api search query to use
@@ -74,6 +81,8 @@ def botboosted(searchQuery, verbose=False, save=False):
         verbose (boolean): whether to print out all outputs or not
         save (boolean): whether to save the prediction information to a
         csv or not
+        cache (UserPredictionCache): optional per-user cache shared across
+        queries, it is saved to its file after the predictions are made
     Returns:
          None, plots barplots and stacked barplots with representative tweets
          for that topic
@@ -82,6 +91,7 @@ def botboosted(searchQuery, verbose=False, save=False):
         totalstart = time.time()
         print('loading model...')
         start = time.time()
+    load_models_v2()
     if verbose:
         print("loading model took: ", time.time() - start)
         print('getting and processing tweets...')
@@ -92,7 +102,10 @@ def botboosted(searchQuery, verbose=False, save=False):
         print("loading and processing tweet data took: ", time.time() - start)
         print('making predictions...')
         start = time.time()
-    predicted_tweets = make_lightweight_predictions_v2(tweet_list)
+    predicted_tweets = make_lightweight_predictions_v2(tweet_list,
+                                                       cache=cache)
+    if cache is not None and cache.filename is not None:
+        cache.save()
     if save:
         filename = 'pred_v2_{}.csv'.format(searchQuery.replace(' ', '_'))
         predicted_tweets.to_csv(filename)
@@ -0,0 +1,570 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import dill as pickle
+from feature_schema import FeatureSchema
+from flat_forest import FlatEnsemble, flat_dirname
+try:
+    import joblib
+except ImportError:
+    from sklearn.externals import joblib
+
+logger = logging.getLogger(__name__)
+
+"""
+This module loads the models of the random forest ensemble on first use
+rather than when a module is imported, so that a process only pays for the
+models it actually predicts with (i.e. the deprecated v1 models are never
+loaded unless make_lightweight_predictions is called)
+
+A model named 'ensemble_rf_v2' lives at models/ensemble_rf_v2_model.pkl,
+which is the name write_model_to_pkl gives it. If a
+models/ensemble_rf_v2_model.joblib file sits next to it, that one is loaded
+instead with its arrays memory-mapped read only, which is faster than
+unpickling with dill and lets the operating system share the file pages
+between processes. Note that sklearn copies the node arrays of each tree
+into its own buffer when a tree is unpickled, so the resident memory of
+sklearn forests is not shared this way; use fork after loading to share
+those pages, or export the models with flat_forest.export_flat_ensemble,
+whose arrays are memory-mapped as they are.
+
+To convert the pickled models once:
+    convert_pickled_models(['account_history_rf_v2', 'behavior_rate_rf_v2',
+                            'ensemble_rf_v2'])
+
+Retrained ensembles can instead be published as versioned bundles, which
+hold all three stages, the feature schema they were trained on, and a
+checksum of their files, under models/bundles/<name>/<version>. Which
+version is live is recorded in models/bundles/<name>/CURRENT, and
+publishing, activating or rolling back a version replaces that file with
+os.rename, which is atomic. A long running process (i.e. the prediction
+service) checks the pointer at most every check_interval seconds and swaps
+to the new bundle in place without restarting, and the bundles it already
+loaded stay loaded so that rolling back is instant.
+
+To deploy a retrained ensemble to every running process:
+    version = publish_bundle('ensemble_rf_v2', (model, modelb, model_ens),
+                             V2_SCHEMA)
+And to go back to the version before it:
+    bundles.rollback('ensemble_rf_v2')
+"""
+
+
+BUNDLE_STAGES = FlatEnsemble.stages
+
+
+def load_pickled_model(filename):
+    """
+    Args:
+        filename (str): path and name of the model to load from a pkl file
+    Returns:
+        model (sklearn classifier model): fit already, and ready to predict
+    """
+    with open(filename, 'r') as f:
+        model = pickle.load(f)
+    f.close()
+    return model
+
+
+def model_filename(name, extension='pkl', model_dir='models'):
+    """
+    Args:
+        name (str): the name the model was written with
+        extension (str): pkl for dill pickles, joblib for memory-mappable
+        joblib files
+        model_dir (str): the directory the models are kept in
+    Returns:
+        filename (str): the path of the model file
+    """
+    return os.path.join(model_dir, '{}_model.{}'.format(name, extension))
+
+
+def convert_pickled_models(names, model_dir='models'):
+    """
+    Args:
+        names (list): the names of the pickled models to convert
+        model_dir (str): the directory the models are kept in
+    Returns:
+        nothing, writes an uncompressed joblib file next to each pkl file so
+        that the registry can memory-map it
+    """
+    for name in names:
+        model = load_pickled_model(model_filename(name, 'pkl', model_dir))
+        joblib.dump(model, model_filename(name, 'joblib', model_dir))
+
+
+class ModelRegistry(object):
+    """
+    this is a lazily loaded, thread safe collection of fit models that are
+    looked up by name
+    """
+    def __init__(self, model_dir='models', mmap_mode='r'):
+        """
+        Args:
+            model_dir (str): the directory the models are kept in
+            mmap_mode (str): how joblib files are memory-mapped, or None to
+            read them fully into memory
+        Returns:
+            nothing, initializes an empty registry
+        """
+        self.model_dir = model_dir
+        self.mmap_mode = mmap_mode
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """
+        Args:
+            name (str): the name the model was written with
+        Returns:
+            model (sklearn classifier model): the model, loaded from disk the
+            first time it is asked for
+        """
+        return self._get(name, self._load)
+
+    def get_flat(self, name):
+        """
+        Args:
+            name (str): the name a flat ensemble was exported with
+        Returns:
+            flat (FlatEnsemble): the flat ensemble, memory-mapped from
+            models/<name>_flat the first time it is asked for
+        """
+        return self._get(flat_dirname(name, self.model_dir),
+                         self._load_flat)
+
+    def _get(self, key, loader):
+        """
+        Args:
+            key (str): what the model is stored under in the registry
+            loader (function): loads the model given its key
+        Returns:
+            model: the loaded model
+        """
+        model = self._models.get(key)
+        if model is None:
+            with self._lock:
+                model = self._models.get(key)
+                if model is None:
+                    model = loader(key)
+                    self._models[key] = model
+        return model
+
+    def _load(self, name):
+        """
+        Args:
+            name (str): the name the model was written with
+        Returns:
+            model (sklearn classifier model): the model read from its joblib
+            file if there is one, and from its pkl file otherwise
+        """
+        joblib_filename = model_filename(name, 'joblib', self.model_dir)
+        if os.path.exists(joblib_filename):
+            return joblib.load(joblib_filename, mmap_mode=self.mmap_mode)
+        return load_pickled_model(model_filename(name, 'pkl',
+                                                 self.model_dir))
+
+    def _load_flat(self, dirname):
+        """
+        Args:
+            dirname (str): the directory of the flat ensemble
+        Returns:
+            flat (FlatEnsemble): the flat ensemble with its arrays
+            memory-mapped, so that every process shares the same pages
+        """
+        return FlatEnsemble.load(dirname, mmap_mode=self.mmap_mode)
+
+    def preload(self, names):
+        """
+        Args:
+            names (list): the names of the models to load now
+        Returns:
+            nothing, loads the models, which is useful before forking
+            worker processes so that they share the loaded models
+        """
+        for name in names:
+            self.get(name)
+
+    def loaded(self):
+        """
+        Args:
+            none
+        Returns:
+            names (list): the names of the models loaded so far
+        """
+        return sorted(self._models)
+
+
+def bundle_dirname(name, model_dir='models'):
+    """
+    Args:
+        name (str): the name of the bundle
+        model_dir (str): the directory the models are kept in
+    Returns:
+        dirname (str): the directory that holds every version of the bundle
+    """
+    return os.path.join(model_dir, 'bundles', name)
+
+
+def bundle_checksum(dirname, filenames):
+    """
+    Args:
+        dirname (str): the directory of a bundle version
+        filenames (list): the files of the bundle, relative to dirname
+    Returns:
+        checksum (str): the sha256 hex digest of the names and contents of
+        the files
+    """
+    digest = hashlib.sha256()
+    for filename in sorted(filenames):
+        digest.update(filename.encode('utf-8'))
+        with open(os.path.join(dirname, filename), 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_pointer(name, version, previous, model_dir='models'):
+    """
+    Args:
+        name (str): the name of the bundle
+        version (str): the version to make live
+        previous (str): the version that was live before, for rollback
+        model_dir (str): the directory the models are kept in
+    Returns:
+        nothing, atomically replaces the CURRENT file of the bundle
+    """
+    pointer = os.path.join(bundle_dirname(name, model_dir), 'CURRENT')
+    tmp_pointer = '{}.{}.{}.tmp'.format(pointer, os.getpid(),
+                                        threading.current_thread().ident)
+    with open(tmp_pointer, 'w') as f:
+        json.dump({'version': version, 'previous': previous}, f)
+    os.rename(tmp_pointer, pointer)
+
+
+def read_pointer(name, model_dir='models'):
+    """
+    Args:
+        name (str): the name of the bundle
+        model_dir (str): the directory the models are kept in
+    Returns:
+        pointer (dict): the live version and the version before it, or None
+        if no version of the bundle was ever published
+    """
+    pointer = os.path.join(bundle_dirname(name, model_dir), 'CURRENT')
+    if not os.path.exists(pointer):
+        return None
+    with open(pointer, 'r') as f:
+        return json.load(f)
+
+
+def reserve_version(name, dirname, version=None):
+    """
+    Args:
+        name (str): the name of the bundle
+        dirname (str): the directory that holds every version of the bundle
+        version (str): the version to publish under, or None for the
+        current time, with a -01, -02... suffix if a version was already
+        published or is being published in the same second
+    Returns:
+        version (str): the version that was reserved
+        tmp_dirname (str): the hidden directory the version is written to
+        first, so that a half written bundle can never be picked up, whose
+        creation reserves the version against concurrent publishes
+    """
+    given = version is not None
+    base = version or time.strftime('%Y%m%d-%H%M%S')
+    n = 0
+    while True:
+        version = base if n == 0 else '{}-{:02d}'.format(base, n)
+        tmp_dirname = os.path.join(dirname, '.{}.tmp'.format(version))
+        if not os.path.exists(os.path.join(dirname, version)):
+            try:
+                os.makedirs(tmp_dirname)
+                return version, tmp_dirname
+            except OSError:
+                if not os.path.isdir(tmp_dirname):
+                    raise
+        if given:
+            raise ValueError('version {} of {} already exists'.format(
+                version, name))
+        n += 1
+
+
+def publish_bundle(name, stage_models, schema, version=None, flat=False,
+                   activate=True, model_dir='models', profiler=None):
+    """
+    Args:
+        name (str): the name of the bundle (i.e. 'ensemble_rf_v2')
+        stage_models (tuple): the fit history, behavior rate, and ensemble
+        models
+        schema (FeatureSchema): the schema the models were trained on
+        version (str): the version to publish under, defaults to the
+        current time, see reserve_version
+        flat (boolean): whether to export the flat ensemble into the bundle
+        as well, so that flat scoring follows the live version too
+        activate (boolean): whether to make the new version live right away
+        model_dir (str): the directory the models are kept in
+        profiler (TrainingProfiler): the profile of the training run, which
+        is written to profile.json in the bundle with the size of every
+        stage model
+    Returns:
+        version (str): the version the bundle was published under
+    """
+    dirname = bundle_dirname(name, model_dir)
+    version, tmp_dirname = reserve_version(name, dirname, version)
+    final_dirname = os.path.join(dirname, version)
+    filenames = []
+    for stage, model in zip(BUNDLE_STAGES, stage_models):
+        filenames.append(stage + '.joblib')
+        joblib.dump(model, os.path.join(tmp_dirname, filenames[-1]))
+    if flat:
+        FlatEnsemble.from_models(*stage_models).save(
+            os.path.join(tmp_dirname, 'flat'))
+        filenames += [os.path.join('flat', filename) for filename in
+                      os.listdir(os.path.join(tmp_dirname, 'flat'))]
+    manifest = {'name': name,
+                'version': version,
+                'created': time.time(),
+                'features': schema.features,
+                'rate_divisor': schema.features[schema.divisor_ix],
+                'files': sorted(filenames),
+                'checksum': bundle_checksum(tmp_dirname, filenames)}
+    with open(os.path.join(tmp_dirname, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    if profiler is not None:
+        for stage, model in zip(BUNDLE_STAGES, stage_models):
+            profiler.record_model(stage, model, os.path.join(
+                tmp_dirname, stage + '.joblib'))
+        profiler.write(os.path.join(tmp_dirname, 'profile.json'))
+    os.rename(tmp_dirname, final_dirname)
+    if activate:
+        pointer = read_pointer(name, model_dir)
+        write_pointer(name, version, pointer and pointer['version'],
+                      model_dir)
+    return version
+
+
+class ModelBundle(object):
+    """
+    this is one version of the three stage ensemble together with the
+    feature schema it was trained on
+    """
+    def __init__(self, version, history, behavior, ensemble, schema,
+                 checksum, flat=None):
+        """
+        Args:
+            version (str): the version of the bundle
+            history (sklearn classifier model): the fit history model
+            behavior (sklearn classifier model): the fit behavior rate model
+            ensemble (sklearn classifier model): the fit ensemble model
+            schema (FeatureSchema): the schema the models were trained on
+            checksum (str): the checksum of the bundle files
+            flat (FlatEnsemble): the flat export of the stages, if any
+        Returns:
+            nothing, initializes the bundle
+        """
+        self.version = version
+        self.history = history
+        self.behavior = behavior
+        self.ensemble = ensemble
+        self.schema = schema
+        self.checksum = checksum
+        self.flat = flat
+
+    @property
+    def stages(self):
+        return [self.history, self.behavior, self.ensemble]
+
+    @classmethod
+    def load(cls, dirname, mmap_mode='r'):
+        """
+        Args:
+            dirname (str): the directory of a bundle version
+            mmap_mode (str): how the model arrays are memory-mapped, or None
+            to read them fully into memory
+        Returns:
+            bundle (ModelBundle): the loaded bundle, after checking that its
+            files match the checksum in its manifest
+        """
+        with open(os.path.join(dirname, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+        checksum = bundle_checksum(dirname, manifest['files'])
+        if checksum != manifest['checksum']:
+            raise ValueError('bundle {} does not match its checksum, it was '
+                             'modified or partially copied'.format(dirname))
+        stages = [joblib.load(os.path.join(dirname, stage + '.joblib'),
+                              mmap_mode=mmap_mode)
+                  for stage in BUNDLE_STAGES]
+        flat_dir = os.path.join(dirname, 'flat')
+        flat = FlatEnsemble.load(flat_dir, mmap_mode=mmap_mode) \
+            if os.path.isdir(flat_dir) else None
+        schema = FeatureSchema(manifest['features'], manifest['rate_divisor'])
+        return cls(manifest['version'], *stages, schema=schema,
+                   checksum=checksum, flat=flat)
+
+
+class BundleRegistry(object):
+    """
+    this keeps the live version of every bundle loaded, and swaps to a new
+    version when the CURRENT pointer of the bundle changes on disk
+    """
+    def __init__(self, model_dir='models', mmap_mode='r', check_interval=1.):
+        """
+        Args:
+            model_dir (str): the directory the models are kept in
+            mmap_mode (str): how the model arrays are memory-mapped
+            check_interval (float): the most seconds between two reads of
+            the pointer of a bundle
+        Returns:
+            nothing, initializes an empty registry
+        """
+        self.model_dir = model_dir
+        self.mmap_mode = mmap_mode
+        self.check_interval = check_interval
+        self._live = {}
+        self._checked = {}
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    def exists(self, name):
+        """
+        Args:
+            name (str): the name of the bundle
+        Returns:
+            exists (boolean): whether a version of the bundle is live
+        """
+        return name in self._live or \
+            read_pointer(name, self.model_dir) is not None
+
+    def current(self, name):
+        """
+        Args:
+            name (str): the name of the bundle
+        Returns:
+            bundle (ModelBundle): the live version of the bundle, which is
+            reloaded if the pointer changed since it was last checked
+        """
+        if time.time() - self._checked.get(name, 0) >= self.check_interval:
+            self.refresh(name)
+        return self._live[name]
+
+    def refresh(self, name):
+        """
+        Args:
+            name (str): the name of the bundle
+        Returns:
+            bundle (ModelBundle): the version the pointer names, loaded if
+            it was not loaded already, and made live in this process, or the
+            version that is already live if the new one fails to load (i.e.
+            its checksum does not match), which is logged and retried after
+            check_interval seconds
+        """
+        with self._lock:
+            pointer = read_pointer(name, self.model_dir)
+            if pointer is None:
+                raise ValueError('no version of {} was published'.format(name))
+            self._checked[name] = time.time()
+            try:
+                bundle = self._load(name, pointer['version'])
+            except Exception:
+                if name not in self._live:
+                    raise
+                logger.exception('could not load version %s of %s, still '
+                                 'serving version %s', pointer['version'],
+                                 name, self._live[name].version)
+                return self._live[name]
+            self._live[name] = bundle
+            # only the live version and the one a rollback goes back to are
+            # kept in memory, so publishing does not grow the process
+            for key in list(self._loaded):
+                if key[0] == name and \
+                        key[1] not in (bundle.version, pointer['previous']):
+                    del self._loaded[key]
+        return bundle
+
+    def _load(self, name, version):
+        """
+        Args:
+            name (str): the name of the bundle
+            version (str): the version to load
+        Returns:
+            bundle (ModelBundle): the bundle, loaded from disk only if this
+            version is not in memory already
+        """
+        key = (name, version)
+        if key not in self._loaded:
+            dirname = os.path.join(bundle_dirname(name, self.model_dir),
+                                   version)
+            self._loaded[key] = ModelBundle.load(dirname, self.mmap_mode)
+        return self._loaded[key]
+
+    def versions(self, name):
+        """
+        Args:
+            name (str): the name of the bundle
+        Returns:
+            versions (list): every published version of the bundle, oldest
+            first when the default versions were used
+        """
+        dirname = bundle_dirname(name, self.model_dir)
+        if not os.path.isdir(dirname):
+            return []
+        return sorted(version for version in os.listdir(dirname)
+                      if not version.startswith('.') and
+                      os.path.isdir(os.path.join(dirname, version)))
+
+    def activate(self, name, version):
+        """
+        Args:
+            name (str): the name of the bundle
+            version (str): a published version to make live
+        Returns:
+            bundle (ModelBundle): the now live bundle, every other process
+            picks it up within check_interval seconds
+        """
+        if version not in self.versions(name):
+            raise ValueError('version {} of {} was never '
+                             'published'.format(version, name))
+        self._load(name, version)
+        pointer = read_pointer(name, self.model_dir)
+        write_pointer(name, version, pointer and pointer['version'],
+                      self.model_dir)
+        return self.refresh(name)
+
+    def rollback(self, name):
+        """
+        Args:
+            name (str): the name of the bundle
+        Returns:
+            bundle (ModelBundle): the version that was live before the
+            current one, which is live again
+        """
+        pointer = read_pointer(name, self.model_dir)
+        if pointer is None or pointer['previous'] is None:
+            raise ValueError('there is no earlier version of {} to roll '
+                             'back to'.format(name))
+        return self.activate(name, pointer['previous'])
+
+    def remove(self, name, version):
+        """
+        Args:
+            name (str): the name of the bundle
+            version (str): a version that is not live
+        Returns:
+            nothing, deletes the version from disk and from memory
+        """
+        pointer = read_pointer(name, self.model_dir)
+        if pointer is not None and pointer['version'] == version:
+            raise ValueError('version {} of {} is live'.format(version, name))
+        self._loaded.pop((name, version), None)
+        shutil.rmtree(os.path.join(bundle_dirname(name, self.model_dir),
+                                   version))
+
+
+models = ModelRegistry()
+bundles = BundleRegistry()
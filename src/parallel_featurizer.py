@@ -0,0 +1,148 @@
+import multiprocessing as mp
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+from feature_schema import V2_SCHEMA, EnsembleBlock
+from tweet_scrape_processor import extract_user_features_v2
+
+"""
+This module featurizes large lists of tweets (i.e. whole mongo collections)
+across several worker processes
+
+The stacked ensemble input is allocated once in shared memory, and every
+worker writes the feature rows of its range of tweets straight into that
+matrix, so no feature rows are pickled back to the parent. The workers are
+forked after the tweets and the shared matrix are set up, so the tweets are
+inherited rather than sent to them, and the returned block is a zero-copy
+view over the shared matrix that the predictor can score directly
+
+Example:
+    block = parallel_featurize_tweets_v2(tweet_list, n_processes=8)
+    probas, pred = score_ensemble_block_v2(block)
+"""
+
+
+_worker_state = {}
+
+
+def split_ranges(n_rows, n_groups):
+    """
+    Args:
+        n_rows (int): the number of rows to split up
+        n_groups (int): the number of groups to split the rows into
+    Returns:
+        ranges (list): a list of (start, stop) tuples which are
+        approximately equal in length and cover every row
+    """
+    bounds = np.linspace(0, n_rows, n_groups + 1).astype(int)
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])
+            if stop > start]
+
+
+def shared_block(n_rows, schema=V2_SCHEMA, dtype=np.float64):
+    """
+    Args:
+        n_rows (int): the number of tweets
+        schema (FeatureSchema): the layout of the stacked ensemble input
+        dtype (numpy dtype): the float type of the block
+    Returns:
+        raw (RawArray): the shared memory backing the block
+        block (EnsembleBlock): a block whose matrix is a view over raw
+    """
+    raw = RawArray(np.dtype(dtype).char, n_rows * schema.n_ensemble_columns)
+    matrix = np.frombuffer(raw, dtype=dtype)
+    matrix = matrix.reshape(n_rows, schema.n_ensemble_columns)
+    return raw, EnsembleBlock(schema, matrix)
+
+
+def _init_worker(raw, n_rows, tweet_list, schema, extract_features,
+                 dtype=np.float64):
+    """
+    Args:
+        raw (RawArray): the shared memory backing the block
+        n_rows (int): the number of tweets
+        tweet_list (list): the tweets to featurize
+        schema (FeatureSchema): the layout of the stacked ensemble input
+        extract_features (function): turns a tweet into its feature row
+        dtype (numpy dtype): the float type of the block
+    Returns:
+        nothing, attaches the worker to the shared block
+    """
+    matrix = np.frombuffer(raw, dtype=dtype)
+    matrix = matrix.reshape(n_rows, schema.n_ensemble_columns)
+    _worker_state['block'] = EnsembleBlock(schema, matrix)
+    _worker_state['tweet_list'] = tweet_list
+    _worker_state['extract_features'] = extract_features
+
+
+def _featurize_range(bounds):
+    """
+    Args:
+        bounds (tuple): the (start, stop) rows this worker is responsible for
+    Returns:
+        n_rows (int): the number of rows written to the shared block
+    """
+    start, stop = bounds
+    history = _worker_state['block'].history
+    tweet_list = _worker_state['tweet_list']
+    extract_features = _worker_state['extract_features']
+    for ix in range(start, stop):
+        history[ix] = extract_features(tweet_list[ix])
+    return stop - start
+
+
+def parallel_featurize_tweets(tweet_list, schema, extract_features,
+                              n_processes=None, chunks_per_process=4,
+                              dtype=np.float64):
+    """
+    Args:
+        tweet_list (list): list of json tweet objects downloaded from twitter
+        schema (FeatureSchema): the layout of the stacked ensemble input
+        extract_features (function): turns a tweet into its feature row
+        n_processes (int): the number of worker processes, defaults to the
+        number of cpus
+        chunks_per_process (int): how many ranges each worker gets, so that
+        a slow range does not hold up the whole batch
+        dtype (numpy dtype): the float type of the block
+    Returns:
+        block (EnsembleBlock): the stacked ensemble input with the account
+        history features filled in, backed by shared memory
+    """
+    n_processes = n_processes or mp.cpu_count()
+    n_rows = len(tweet_list)
+    raw, block = shared_block(n_rows, schema, dtype)
+    ranges = split_ranges(n_rows, n_processes * chunks_per_process)
+    # fork so that the workers inherit the tweets and the shared memory
+    # instead of having them pickled over
+    try:
+        context = mp.get_context('fork')
+    except AttributeError:
+        context = mp
+    pool = context.Pool(n_processes, initializer=_init_worker,
+                        initargs=(raw, n_rows, tweet_list, schema,
+                                  extract_features, dtype))
+    try:
+        n_written = sum(pool.map(_featurize_range, ranges))
+    finally:
+        pool.close()
+        pool.join()
+    if n_written != n_rows:
+        raise RuntimeError('featurized {} of {} tweets'.format(n_written,
+                                                               n_rows))
+    return block
+
+
+def parallel_featurize_tweets_v2(tweet_list, n_processes=None,
+                                 dtype=np.float64):
+    """
+    Args:
+        tweet_list (list): list of json tweet objects downloaded from twitter
+        n_processes (int): the number of worker processes, defaults to the
+        number of cpus
+        dtype (numpy dtype): the float type of the block
+    Returns:
+        block (EnsembleBlock): the v2 stacked ensemble input with the
+        account history features filled in, backed by shared memory
+    """
+    return parallel_featurize_tweets(tweet_list, V2_SCHEMA,
+                                     extract_user_features_v2,
+                                     n_processes=n_processes, dtype=dtype)
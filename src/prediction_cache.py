@@ -0,0 +1,194 @@
+import os
+import time
+from collections import OrderedDict
+import dill as pickle
+
+"""
+This module holds a per-user cache of features and random forest
+probabilities so that accounts that show up across many queries are not
+re-featurized and re-scored every time make_lightweight_predictions_v2 is
+called
+
+An entry is keyed by the twitter user id and is only considered valid while
+every account field the model reads (the statuses, followers, friends,
+favourites and listed counts, and the verified, geo enabled, default profile
+image and background image flags) and the few tweet level fields it uses are
+unchanged, and while it is younger than the time to live.
+make_lightweight_predictions_v2 also puts the live bundle version and the
+scoring options into the fingerprint (see lightweight_predictor.scoring_key),
+so publishing or rolling back a bundle turns every entry made by the other
+models stale right away. The time to live bounds how stale the account_age
+feature can become for an account whose fields have not moved.
+
+Entries are evicted least recently used first once the cache is full, and
+the whole cache can be written to and read from a pkl file so that it
+persists across processes
+
+Example:
+    cache = UserPredictionCache(filename='models/user_prediction_cache.pkl')
+    predicted_tweets = make_lightweight_predictions_v2(tweet_list,
+                                                       cache=cache)
+    cache.save()
+    print(cache.stats())
+"""
+
+
+def user_fingerprint(tweet):
+    """
+    Args:
+        tweet (json): single tweet object downloaded from twitter's api
+    Returns:
+        fingerprint (tuple): the account fields and the tweet level fields
+        that the features are built from, other than the dates, an entry is
+        only reused if this is unchanged
+    """
+    user = tweet['user']
+    return (user['statuses_count'],
+            user['followers_count'],
+            user['friends_count'],
+            user['favourites_count'],
+            user['listed_count'],
+            user['verified'],
+            user['geo_enabled'],
+            user['default_profile_image'],
+            user['profile_use_background_image'],
+            tweet['favorite_count'],
+            tweet['retweet_count'],
+            len(tweet['entities']['hashtags']),
+            len(tweet['entities']['user_mentions']))
+
+
+class UserPredictionCache(object):
+    """
+    this is an lru cache with a time to live that maps a user id to the
+    features and the probabilities of the three random forests computed for
+    that user, and it keeps hit and miss statistics
+    """
+    def __init__(self, maxsize=100000, ttl=86400, filename=None):
+        """
+        Args:
+            maxsize (int): the largest number of users to keep
+            ttl (int): the number of seconds an entry stays valid
+            filename (str): path of the pkl file that backs the cache, it is
+            loaded here if it already exists
+        Returns:
+            nothing, initializes the cache
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.filename = filename
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        if filename is not None and os.path.exists(filename):
+            self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id, fingerprint):
+        """
+        Args:
+            user_id (int): the twitter user id
+            fingerprint (tuple): the output of user_fingerprint for the tweet
+        Returns:
+            entry (dict): the cached features, probabilities and prediction,
+            or None if the user is not cached, has changed, or has expired
+        """
+        record = self._entries.pop(user_id, None)
+        if record is None:
+            self.misses += 1
+            return None
+        stored_fingerprint, stored_at, entry = record
+        if stored_fingerprint != fingerprint or \
+                time.time() - stored_at > self.ttl:
+            self.stale += 1
+            self.misses += 1
+            return None
+        self._entries[user_id] = record
+        self.hits += 1
+        return entry
+
+    def put(self, user_id, fingerprint, features, probas, pred):
+        """
+        Args:
+            user_id (int): the twitter user id
+            fingerprint (tuple): the output of user_fingerprint for the tweet
+            features (1d numpy array): the feature row of the user
+            probas (1d numpy array): probability of being fake according to
+            the history, behavior rate, and ensemble models
+            pred (int): the final prediction where 1 = fake and 0 = human
+        Returns:
+            nothing, stores the entry and evicts the least recently used
+            entries if the cache is over its size
+        """
+        self._entries.pop(user_id, None)
+        self._entries[user_id] = (fingerprint, time.time(),
+                                  {'features': features,
+                                   'probas': probas,
+                                   'pred': pred})
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        """
+        Args:
+            none
+        Returns:
+            stats (dict): the size of the cache and its hit, miss, stale and
+            eviction counts along with the hit rate
+        """
+        lookups = self.hits + self.misses
+        return {'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'evictions': self.evictions,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+    def _filename(self, filename):
+        """
+        Args:
+            filename (str): the file passed to save or load, or None
+        Returns:
+            filename (str): the file, defaulting to the file the cache was
+            created with, raises a ValueError if there is neither
+        """
+        filename = filename or self.filename
+        if filename is None:
+            raise ValueError('the cache was created without a filename, '
+                             'pass one to save or load')
+        return filename
+
+    def save(self, filename=None):
+        """
+        Args:
+            filename (str): where to write the cache, defaults to the file
+            the cache was created with, a ValueError is raised if there is
+            neither
+        Returns:
+            nothing, writes the entries to a pkl file through a temporary
+            file so that a crash never leaves a half written cache behind
+        """
+        filename = self._filename(filename)
+        tmp_filename = '{}.tmp'.format(filename)
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump(self._entries, f)
+        os.rename(tmp_filename, filename)
+
+    def load(self, filename=None):
+        """
+        Args:
+            filename (str): the pkl file to read, defaults to the file the
+            cache was created with
+        Returns:
+            nothing, replaces the entries with the ones stored on disk
+        """
+        filename = self._filename(filename)
+        with open(filename, 'rb') as f:
+            self._entries = pickle.load(f)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
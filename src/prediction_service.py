@@ -0,0 +1,381 @@
+import json
+import numbers
+import threading
+import time
+from collections import deque
+from functools import partial
+import numpy as np
+from lightweight_predictor import make_lightweight_predictions_v2, \
+    load_models_v2
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from queue import Queue, Empty
+    from urllib.request import Request, urlopen
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from Queue import Queue, Empty
+    from urllib2 import Request, urlopen
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+"""
+This module runs a long lived local scoring service that keeps the v2 random
+forest ensemble loaded, so that an analysis does not have to start a new
+python process and reload the forests every time
+
+Requests are json lists of tweets posted to http://localhost:8765/predict,
+and concurrent requests are merged into micro batches: the batcher waits at
+most max_wait seconds after the first request for more requests to arrive,
+up to max_batch_size tweets, scores them all with one call to
+make_lightweight_predictions_v2, and hands each request its own rows back.
+Every request is checked for the fields the features are built from
+before it joins a batch, which only looks at their types so that the tweets
+are featurized once, in the batch. If a batch still fails (i.e. on a date
+that does not parse), its requests are scored one at a time, so a bad
+request only fails itself. A request with missing or mistyped fields gets a
+400 response, and any other error a 500.
+GET /stats reports the p50 and p99 request latency and the throughput.
+Every batch asks the model registry for the live bundle, so publishing or
+rolling back a bundle takes effect without restarting the service.
+
+To run the service:
+    serve(max_batch_size=1024, max_wait=.01)
+
+And to use it:
+    predictions = request_predictions(tweet_list)
+"""
+
+
+TWEET_FIELDS = {'text': string_types,
+                'created_at': string_types,
+                'favorite_count': numbers.Number,
+                'retweet_count': numbers.Number,
+                'user': dict,
+                'entities': dict}
+USER_FIELDS = dict([('id', numbers.Number),
+                    ('screen_name', string_types),
+                    ('created_at', string_types)] +
+                   [(name, numbers.Number) for name in
+                    ('profile_use_background_image', 'geo_enabled',
+                     'verified', 'followers_count', 'default_profile_image',
+                     'listed_count', 'statuses_count', 'friends_count',
+                     'favourites_count')])
+ENTITY_FIELDS = {'hashtags': list, 'user_mentions': list}
+
+
+class MalformedTweets(ValueError):
+    """
+    this is raised for a prediction request whose tweets cannot be scored
+    """
+
+
+def check_fields(value, fields, where):
+    """
+    Args:
+        value (dict): a tweet or its user
+        fields (dict): the type of every required field
+        where (str): how to name the value in the error
+    Returns:
+        nothing, raises MalformedTweets for the first missing or mistyped
+        field
+    """
+    if not isinstance(value, dict):
+        raise MalformedTweets('{} is not a json object'.format(where))
+    for name, field_type in fields.items():
+        if name not in value:
+            raise MalformedTweets('{} has no {}'.format(where, name))
+        if not isinstance(value[name], field_type):
+            raise MalformedTweets('{} {} is a {}'.format(
+                where, name, type(value[name]).__name__))
+
+
+def validate_tweets(tweet_list):
+    """
+    Args:
+        tweet_list (list): the decoded body of a prediction request
+    Returns:
+        nothing, raises MalformedTweets naming the first tweet that lacks a
+        field the features or the prediction rows are built from, or holds
+        it with the wrong type, without featurizing the tweets
+    """
+    if not isinstance(tweet_list, list):
+        raise MalformedTweets('expected a json list of tweets')
+    for i, tweet in enumerate(tweet_list):
+        where = 'tweet {}'.format(i)
+        check_fields(tweet, TWEET_FIELDS, where)
+        check_fields(tweet['user'], USER_FIELDS, where + ' user')
+        check_fields(tweet['entities'], ENTITY_FIELDS, where + ' entities')
+
+
+class MicroBatcher(object):
+    """
+    this merges concurrent prediction requests into batches that are scored
+    by a single background thread, and keeps latency statistics
+    """
+    def __init__(self, predict, max_batch_size=512, max_wait=.01,
+                 n_latencies=10000):
+        """
+        Args:
+            predict (function): takes a list of tweets and returns a
+            dataframe with one row per tweet
+            max_batch_size (int): the most tweets to put in one batch
+            max_wait (float): the most seconds to wait for more requests
+            after the first request of a batch arrives
+            n_latencies (int): how many of the latest request latencies to
+            keep for the percentiles
+        Returns:
+            nothing, starts the background scoring thread
+        """
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.latencies = deque(maxlen=n_latencies)
+        self.n_requests = 0
+        self.n_tweets = 0
+        self.n_batches = 0
+        self.started = time.time()
+        self._queue = Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, tweet_list):
+        """
+        Args:
+            tweet_list (list): list of json tweet objects
+        Returns:
+            predicted_tweets (dataframe): the rows of the batch that belong
+            to these tweets, once the batch has been scored, MalformedTweets
+            is raised right away if the tweets lack a field
+        """
+        validate_tweets(tweet_list)
+        request = {'tweets': tweet_list,
+                   'done': threading.Event(),
+                   'start': time.time()}
+        self._queue.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['result']
+
+    def _run(self):
+        """
+        Args:
+            none
+        Returns:
+            nothing, collects requests into batches and scores them forever
+        """
+        while True:
+            batch = [self._queue.get()]
+            try:
+                self._collect(batch)
+                self._score(batch)
+            except Exception as e:
+                # the thread has to outlive any error, or every later
+                # request would wait for it forever
+                for request in batch:
+                    if not request['done'].is_set():
+                        request['error'] = e
+                        request['done'].set()
+
+    def _collect(self, batch):
+        """
+        Args:
+            batch (list): the requests of the batch so far, starting with
+            the first one
+        Returns:
+            nothing, adds the requests that arrive within max_wait seconds
+            of the first one, up to max_batch_size tweets
+        """
+        n_tweets = len(batch[0]['tweets'])
+        deadline = time.time() + self.max_wait
+        while n_tweets < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except Empty:
+                break
+            batch.append(request)
+            n_tweets += len(request['tweets'])
+
+    def _score(self, batch):
+        """
+        Args:
+            batch (list): the requests to score together
+        Returns:
+            nothing, scores the batch and wakes up every request in it, and
+            if the batch fails scores its requests one at a time so that
+            only the failing ones get the error
+        """
+        tweet_list = [tweet for request in batch
+                      for tweet in request['tweets']]
+        try:
+            predicted_tweets = self.predict(tweet_list)
+        except Exception as e:
+            if len(batch) > 1:
+                for request in batch:
+                    self._score([request])
+                return
+            batch[0]['error'] = e
+            batch[0]['done'].set()
+            return
+        start = 0
+        finished = time.time()
+        for request in batch:
+            stop = start + len(request['tweets'])
+            request['result'] = \
+                predicted_tweets.iloc[start:stop].reset_index(drop=True)
+            start = stop
+            self.latencies.append(finished - request['start'])
+            request['done'].set()
+        self.n_requests += len(batch)
+        self.n_tweets += len(tweet_list)
+        self.n_batches += 1
+
+    def stats(self):
+        """
+        Args:
+            none
+        Returns:
+            stats (dict): the p50 and p99 request latency in seconds, the
+            tweets scored per second since the service started, and the
+            request, tweet and batch counts
+        """
+        latencies = np.array(self.latencies)
+        has_latencies = latencies.shape[0] > 0
+        return {'p50': np.percentile(latencies, 50) if has_latencies
+                else None,
+                'p99': np.percentile(latencies, 99) if has_latencies
+                else None,
+                'throughput': self.n_tweets / (time.time() - self.started),
+                'requests': self.n_requests,
+                'tweets': self.n_tweets,
+                'batches': self.n_batches,
+                'mean_batch_size': float(self.n_tweets) / self.n_batches
+                if self.n_batches else 0.0}
+
+
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+    """
+    this answers POST /predict with the predictions of the posted tweets
+    and GET /stats with the batcher statistics
+    """
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers['Content-Length'])
+            tweet_list = json.loads(self.rfile.read(length).decode('utf-8'))
+        except (TypeError, ValueError) as e:
+            self._send_json({'error': 'invalid json body: {}'.format(e)}, 400)
+            return
+        if not tweet_list:
+            self._send_json([])
+            return
+        try:
+            predicted_tweets = self.server.batcher.submit(tweet_list)
+        except MalformedTweets as e:
+            self._send_json({'error': str(e)}, 400)
+            return
+        except Exception as e:
+            self._send_json({'error': repr(e)}, 500)
+            return
+        self._send_json([{'id': int(user_id), 'text': text,
+                          'screen_name': screen_name, 'pred': int(pred)}
+                         for user_id, text, screen_name, pred
+                         in predicted_tweets.values])
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_error(404)
+            return
+        self._send_json(self.server.batcher.stats())
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PredictionServer(ThreadingMixIn, HTTPServer):
+    """
+    this is a threaded http server so that concurrent requests can be
+    merged into the same batch
+    """
+    daemon_threads = True
+
+
+def make_server(host='127.0.0.1', port=8765, max_batch_size=512,
+                max_wait=.01, **kwargs):
+    """
+    Args:
+        host (str): the address to listen on, localhost by default
+        port (int): the port to listen on
+        max_batch_size (int): the most tweets to put in one batch
+        max_wait (float): the most seconds to wait for a batch to fill up
+        **kwargs: passed on to make_lightweight_predictions_v2 (i.e. cache,
+        flat, cascade_band)
+    Returns:
+        server (PredictionServer): the server with the models loaded
+    """
+    load_models_v2(kwargs.get('flat', False))
+    server = PredictionServer((host, port), PredictionRequestHandler)
+    server.batcher = MicroBatcher(partial(make_lightweight_predictions_v2,
+                                          **kwargs),
+                                  max_batch_size=max_batch_size,
+                                  max_wait=max_wait)
+    return server
+
+
+def serve(host='127.0.0.1', port=8765, max_batch_size=512, max_wait=.01,
+          **kwargs):
+    """
+    Args:
+        host (str): the address to listen on, localhost by default
+        port (int): the port to listen on
+        max_batch_size (int): the most tweets to put in one batch
+        max_wait (float): the most seconds to wait for a batch to fill up
+        **kwargs: passed on to make_lightweight_predictions_v2
+    Returns:
+        nothing, serves predictions until interrupted
+    """
+    server = make_server(host, port, max_batch_size, max_wait, **kwargs)
+    print('serving predictions on http://{}:{}'.format(host, port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def request_predictions(tweet_list, host='127.0.0.1', port=8765):
+    """
+    Args:
+        tweet_list (list): list of json tweet objects, fields that are not
+        json serializable (i.e. mongo ids) are sent as strings
+        host (str): the address the service listens on
+        port (int): the port the service listens on
+    Returns:
+        predictions (list): one dictionary per tweet with the id, text,
+        screen_name and pred of the tweet
+    """
+    body = json.dumps(tweet_list, default=str).encode('utf-8')
+    request = Request('http://{}:{}/predict'.format(host, port), data=body,
+                      headers={'Content-Type': 'application/json'})
+    return json.loads(urlopen(request).read().decode('utf-8'))
+
+
+if __name__ == "__main__":
+    serve()
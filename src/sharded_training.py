@@ -0,0 +1,229 @@
+import multiprocessing as mp
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+from feature_schema import V2_SCHEMA
+from incremental_training import TRAINING_STORE, training_store_chunks, \
+    load_store_chunk, seed_training_store
+from lightweight_predictor import V2_BUNDLE
+from lightweight_classifier import HISTORY_PARAMGRID, BEHAVIOR_PARAMGRID, \
+    ENSEMBLE_PARAMGRID
+from model_registry import publish_bundle
+from stacking import grid_params, merge_forests, stratified_folds
+
+"""
+This module trains the three stage random forest ensemble on labelled sets
+that are too large to fit a single forest on in memory
+
+The training rows are read from the training store of incremental_training,
+a directory of .npy chunks, and are split into shards without copying them:
+a shard is a list of row indices into every chunk, planned from the labels
+alone. Every shard is fit by its own worker process, which memory-maps the
+chunks, reads only the rows of its shard, builds the stacked input of just
+those rows, and grows a sub-forest of about n_estimators / n_shards trees.
+The sub-forests of a stage are then merged into one forest by concatenating
+their estimators_, so the deployed models look like any other fit forest.
+The history and behavior rate models are trained first; the workers then
+score their shard with the merged models to fill in the base model
+probabilities and grow the ensemble model sub-forests, so training memory is
+bounded by the size of a shard rather than of the whole labelled set.
+
+Every shard has to hold both classes for its sub-forests to be merged,
+which plan_shards takes care of by spreading each class of every chunk
+evenly over the shards.
+
+Example:
+    append_to_training_store(X_new, y_new)
+    models = train_sharded_ensemble(n_shards=16, n_processes=4)
+"""
+
+
+_worker_state = {}
+
+
+def plan_shards(n_shards, dirname=TRAINING_STORE, random_state=0):
+    """
+    Args:
+        n_shards (int): the number of shards
+        dirname (str): the training store
+        random_state (int): the seed of the assignment of rows to shards
+    Returns:
+        shards (list): for every shard, the (chunk, row indices) pairs of
+        the rows it holds, where every chunk of the store spreads each class
+        evenly over the shards, only the targets of the chunks are read
+    """
+    seed_training_store(dirname)
+    shards = [[] for _ in range(n_shards)]
+    counts = np.zeros((n_shards, 2), dtype=int)
+    for chunk_ix, chunk in enumerate(training_store_chunks(dirname)):
+        y = load_store_chunk(chunk, mmap_mode='r')['y']
+        folds = stratified_folds(y, n_shards, random_state + chunk_ix)
+        for shard in range(n_shards):
+            row_ix = np.flatnonzero(folds == shard)
+            if row_ix.shape[0]:
+                shards[shard].append((chunk, row_ix))
+                counts[shard] += np.bincount(np.asarray(y[row_ix], int),
+                                             minlength=2)[:2]
+    if (counts == 0).any():
+        raise ValueError('every shard needs rows of both classes so that its '
+                         'sub-forests can be merged, use fewer shards')
+    return shards
+
+
+def load_shard_block(shard):
+    """
+    Args:
+        shard (list): the (chunk, row indices) pairs of a shard
+    Returns:
+        block (EnsembleBlock): the stacked input of the rows of the shard
+        with the history and behavior rate features filled in, read from
+        the memory-mapped chunks so that only the rows of the shard are
+        ever in memory
+        y (1d numpy array): their labels
+    """
+    block = V2_SCHEMA.allocate(sum(row_ix.shape[0] for _, row_ix in shard))
+    y = np.empty(len(block))
+    start = 0
+    for chunk, row_ix in shard:
+        arrays = load_store_chunk(chunk, mmap_mode='r')
+        stop = start + row_ix.shape[0]
+        block.history[start:stop] = arrays['X'][row_ix]
+        y[start:stop] = arrays['y'][row_ix]
+        start = stop
+    block.fill_behavior_rates()
+    return block, y
+
+
+def _init_worker(stage_models):
+    """
+    Args:
+        stage_models (tuple): the merged history and behavior rate models,
+        or None while they are being trained
+    Returns:
+        nothing, keeps the models the worker inherited
+    """
+    _worker_state['stage_models'] = stage_models
+
+
+def _fit_base_shard(task):
+    """
+    Args:
+        task (tuple): the shard and the history and behavior rate model
+        parameters
+    Returns:
+        forests (tuple): the history and behavior rate sub-forests
+    """
+    shard, history_params, behavior_params = task
+    block, y = load_shard_block(shard)
+    model = RandomForestClassifier(**history_params).fit(block.history, y)
+    modelb = RandomForestClassifier(**behavior_params).fit(block.behavior, y)
+    return model, modelb
+
+
+def _fit_ensemble_shard(task):
+    """
+    Args:
+        task (tuple): the shard and the ensemble model parameters
+    Returns:
+        forest (RandomForestClassifier): the ensemble sub-forest of the
+        shard, fit on the probabilities of the merged base models
+    """
+    shard, ensemble_params = task
+    model, modelb = _worker_state['stage_models']
+    block, y = load_shard_block(shard)
+    block.set_base_probas(model.predict_proba(block.history)[:, 1],
+                          modelb.predict_proba(block.behavior)[:, 1])
+    return RandomForestClassifier(**ensemble_params).fit(block.matrix, y)
+
+
+def _map_shards(function, tasks, n_processes, stage_models=None):
+    """
+    Args:
+        function (function): the worker function
+        tasks (list): one task per shard
+        n_processes (int): the number of worker processes
+        stage_models (tuple): the models the workers should inherit
+    Returns:
+        results (list): the result of every task, in order
+    """
+    try:
+        context = mp.get_context('fork')
+    except AttributeError:
+        context = mp
+    # a fresh process per shard hands the memory of every shard back to
+    # the operating system as soon as it is fit
+    pool = context.Pool(n_processes, initializer=_init_worker,
+                        initargs=(stage_models,), maxtasksperchild=1)
+    try:
+        return pool.map(function, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def shard_params(paramgrid, n_shards, random_state):
+    """
+    Args:
+        paramgrid (dictionary): the grid of a stage, one value per parameter
+        n_shards (int): the number of shards
+        random_state (int): the seed of the sub-forests
+    Returns:
+        params (list): the parameters of the sub-forest of every shard, each
+        growing its share of the trees single threaded, where the first
+        n_estimators % n_shards shards grow one extra tree so that the
+        merged forest has exactly n_estimators trees
+    """
+    params = grid_params(paramgrid)
+    n_trees, n_extra = divmod(params.get('n_estimators', 10), n_shards)
+    if n_trees == 0:
+        raise ValueError('{} trees cannot be split over {} '
+                         'shards'.format(params.get('n_estimators', 10),
+                                         n_shards))
+    return [dict(params, n_estimators=n_trees + (shard < n_extra), n_jobs=1,
+                 random_state=random_state + shard)
+            for shard in range(n_shards)]
+
+
+def train_sharded_ensemble(n_shards, dirname=TRAINING_STORE,
+                           n_processes=None,
+                           paramgrids=(HISTORY_PARAMGRID, BEHAVIOR_PARAMGRID,
+                                       ENSEMBLE_PARAMGRID),
+                           publish=False, random_state=0):
+    """
+    Args:
+        n_shards (int): the number of shards, which bounds the memory of a
+        worker to about 1 / n_shards of the store
+        dirname (str): the training store, see incremental_training
+        n_processes (int): the number of shards fit at the same time,
+        defaults to the number of cpus
+        paramgrids (tuple): the grids of the history, behavior rate, and
+        ensemble models, with one value per parameter
+        publish (boolean): whether to publish the merged models as a new
+        version of the v2 bundle
+        random_state (int): the seed of the shards and the sub-forests
+    Returns:
+        models (tuple): the merged history, behavior rate, and ensemble
+        models
+    """
+    n_processes = n_processes or mp.cpu_count()
+    shards = plan_shards(n_shards, dirname, random_state)
+    history_params, behavior_params, ensemble_params = \
+        [shard_params(paramgrid, n_shards, random_state)
+         for paramgrid in paramgrids]
+    base_forests = _map_shards(_fit_base_shard,
+                               list(zip(shards, history_params,
+                                        behavior_params)),
+                               n_processes)
+    model = merge_forests([forests[0] for forests in base_forests])
+    modelb = merge_forests([forests[1] for forests in base_forests])
+    # fork after the base models are merged so that every worker inherits
+    # them instead of having them pickled over
+    ensemble_forests = _map_shards(_fit_ensemble_shard,
+                                   list(zip(shards, ensemble_params)),
+                                   n_processes, (model, modelb))
+    model_ens = merge_forests(ensemble_forests)
+    for forest in (model, modelb, model_ens):
+        forest.n_jobs = -1
+    models = (model, modelb, model_ens)
+    if publish:
+        publish_bundle(V2_BUNDLE, models, V2_SCHEMA)
+    return models
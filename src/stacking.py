@@ -0,0 +1,163 @@
+import copy
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+try:
+    from joblib import Parallel, delayed
+except ImportError:
+    from sklearn.externals.joblib import Parallel, delayed
+
+"""
+This module trains the three stage random forest ensemble with out of fold
+stacking in a single pass
+
+The training rows are split into stratified folds. For every fold, the
+history and behavior rate models are fit on the other folds, in parallel
+across the folds, and predict the probabilities of the rows of the held out
+fold, so that every training row gets base model probabilities from models
+that never saw it. The ensemble model is then fit once on those out of fold
+probabilities, which are what it will see for new tweets, instead of on the
+in-sample probabilities of base models that were fit on the same rows.
+
+Every fold grows full n_estimators forests, so the probabilities the
+ensemble model is fit on come from forests of the size it is served. The
+deployed base models then either get a single final fit on all the rows
+(the default), which costs one more forest per base model and differs from
+the fold forests only in seeing every row instead of (n_folds - 1) /
+n_folds of them, or with merge_folds=True are the merged fold forests,
+which need no refit but hold n_folds times the trees, and so cost n_folds
+times the memory and prediction time of a single forest when serving.
+
+Example:
+    models, oof_probas = fit_out_of_fold(block, y, history_params,
+                                         behavior_params, ensemble_params)
+"""
+
+
+def stratified_folds(y, n_folds=5, random_state=0):
+    """
+    Args:
+        y (1d numpy array): the targets
+        n_folds (int): the number of folds
+        random_state (int): the seed of the shuffle
+    Returns:
+        folds (1d numpy array): the fold of every row, with every class
+        spread as evenly as possible over the folds
+    """
+    rng = np.random.RandomState(random_state)
+    folds = np.empty(y.shape[0], dtype=int)
+    for label in np.unique(y):
+        rows = np.flatnonzero(y == label)
+        rng.shuffle(rows)
+        folds[rows] = np.arange(rows.shape[0]) % n_folds
+    return folds
+
+
+def grid_params(paramgrid):
+    """
+    Args:
+        paramgrid (dictionary): a grid with a single value per parameter
+    Returns:
+        params (dictionary): the parameters of the grid
+    """
+    if any(len(values) != 1 for values in paramgrid.values()):
+        raise ValueError('out of fold stacking fits one set of parameters, '
+                         'narrow the grid down with gridsearch first')
+    return dict((name, values[0]) for name, values in paramgrid.items())
+
+
+def merge_forests(forests):
+    """
+    Args:
+        forests (list): fit random forests with the same classes and
+        features
+    Returns:
+        forest (RandomForestClassifier): a shallow copy of the first forest
+        holding the trees of all of them
+    """
+    merged = copy.copy(forests[0])
+    merged.estimators_ = [tree for forest in forests
+                          for tree in forest.estimators_]
+    merged.n_estimators = len(merged.estimators_)
+    return merged
+
+
+def _fit_fold(X_history, X_behavior, y, train_ix, history_params,
+              behavior_params):
+    """
+    Args:
+        X_history (2d numpy array): the history features of every row
+        X_behavior (2d numpy array): the behavior rate features of every row
+        y (1d numpy array): the targets
+        train_ix (1d numpy array): the rows to fit on
+        history_params (dictionary): the history model parameters
+        behavior_params (dictionary): the behavior rate model parameters
+    Returns:
+        model (RandomForestClassifier): the history model of the fold
+        modelb (RandomForestClassifier): the behavior rate model of the fold
+    """
+    model = RandomForestClassifier(**history_params)
+    model.fit(X_history[train_ix], y[train_ix])
+    modelb = RandomForestClassifier(**behavior_params)
+    modelb.fit(X_behavior[train_ix], y[train_ix])
+    return model, modelb
+
+
+def fit_out_of_fold(block, y, history_params, behavior_params,
+                    ensemble_params, n_folds=5, n_jobs=-1, merge_folds=False,
+                    random_state=0):
+    """
+    Args:
+        block (EnsembleBlock): the stacked input of the training rows with
+        the history and behavior rate features filled in, the base model
+        columns are overwritten with the out of fold probabilities
+        y (1d numpy array): the targets
+        history_params (dictionary): the history model parameters
+        behavior_params (dictionary): the behavior rate model parameters
+        ensemble_params (dictionary): the ensemble model parameters
+        n_folds (int): the number of folds
+        n_jobs (int): the number of folds fit at the same time, and the
+        number of threads of the ensemble model
+        merge_folds (boolean): whether the deployed base models are the
+        merged full size fold models, with n_folds times the trees, or a
+        single final fit on all the rows
+        random_state (int): the seed of the folds and of the forests
+    Returns:
+        models (tuple): the history, behavior rate, and ensemble models
+        oof_probas (2d numpy array): the out of fold history and behavior
+        rate model probabilities of every row
+    """
+    folds = stratified_folds(y, n_folds, random_state)
+    fold_params = [dict(params, n_jobs=1)
+                   for params in (history_params, behavior_params)]
+    # the trees are grown with the gil released, so threads fit the folds
+    # in parallel without copying the training rows to other processes
+    fold_models = Parallel(n_jobs=n_jobs, backend='threading')(
+        delayed(_fit_fold)(block.history, block.behavior, y,
+                           np.flatnonzero(folds != fold),
+                           dict(fold_params[0], random_state=random_state +
+                                fold),
+                           dict(fold_params[1], random_state=random_state +
+                                fold))
+        for fold in range(n_folds))
+    for fold, (model, modelb) in enumerate(fold_models):
+        rows = np.flatnonzero(folds == fold)
+        block.base_probas[rows, 0] = \
+            model.predict_proba(block.history[rows])[:, 1]
+        block.base_probas[rows, 1] = \
+            modelb.predict_proba(block.behavior[rows])[:, 1]
+    if merge_folds:
+        model = merge_forests([models[0] for models in fold_models])
+        modelb = merge_forests([models[1] for models in fold_models])
+    else:
+        model = RandomForestClassifier(**dict(history_params, n_jobs=n_jobs,
+                                              random_state=random_state))
+        model.fit(block.history, y)
+        modelb = RandomForestClassifier(**dict(behavior_params,
+                                               n_jobs=n_jobs,
+                                               random_state=random_state))
+        modelb.fit(block.behavior, y)
+    model_ens = RandomForestClassifier(**dict(ensemble_params, n_jobs=n_jobs,
+                                              random_state=random_state))
+    model_ens.fit(block.matrix, y)
+    model.n_jobs = modelb.n_jobs = n_jobs
+    return (model, modelb, model_ens), block.base_probas.copy()
@@ -0,0 +1,144 @@
+import time
+import numpy as np
+import pandas as pd
+import dill as pickle
+from sklearn.base import clone
+from feature_schema import V2_SCHEMA
+from lightweight_classifier import train_ensemble_stages, FOREST_STAGES
+from training_pipeline import ArtifactCache
+
+"""
+This module compares the kinds of model that every stage of the ensemble
+can be trained with, so that the random forests can be swapped for
+histogram binned gradient boosted models stage by stage
+
+Every configuration of stage kinds is trained with train_ensemble_stages,
+on the same features and with the same in-sample stacking, and every stage
+of it is measured on:
+
+    fit_seconds: the time to fit the chosen parameters once on the training
+    rows, without the search
+    pickled_bytes: the size of the pickled stage model
+    latency: the best time in seconds to score all of the held out rows
+    the accuracy on the held out cresci, miley cyrus and celebrity rows
+
+The ensemble stage of a configuration is scored on the probabilities of the
+base stages of that same configuration. The fits are cached like every other
+stage, so comparing a new configuration only trains its new stages.
+
+Example:
+    comparison = compare_stage_kinds([('forest', 'forest', 'forest'),
+                                      ('boosted', 'boosted', 'forest'),
+                                      ('boosted', 'boosted', 'boosted')])
+"""
+
+
+STAGES = ('history', 'behavior', 'ensemble')
+HELD_OUT_SETS = ('cresci', 'cyrus', 'celebrity')
+
+
+def stage_inputs(block, models):
+    """
+    Args:
+        block (EnsembleBlock): the stacked input of some rows with the
+        history and behavior rate features filled in
+        models (tuple): the fit history, behavior rate, and ensemble models
+    Returns:
+        inputs (tuple): the feature matrix of every stage, with the base
+        model probabilities of the block filled in from the models
+    """
+    model, modelb, _ = models
+    block.set_base_probas(model.predict_proba(block.history)[:, 1],
+                          modelb.predict_proba(block.behavior)[:, 1])
+    return block.history, block.behavior, block.matrix
+
+
+def time_fit(model, X, y):
+    """
+    Args:
+        model (sklearn classifier model): a fit model
+        X (2d numpy array): the rows it was fit on
+        y (1d numpy array): the targets
+    Returns:
+        seconds (float): the time to fit a copy of the model from scratch
+    """
+    start = time.time()
+    clone(model).fit(X, y)
+    return time.time() - start
+
+
+def time_predict(model, X, n_repeats=3):
+    """
+    Args:
+        model (sklearn classifier model): a fit model
+        X (2d numpy array): the rows to score
+        n_repeats (int): how many times to time the scoring
+    Returns:
+        latency (float): the best time in seconds to score all of X
+    """
+    latency = np.inf
+    for _ in range(n_repeats):
+        start = time.time()
+        model.predict_proba(X)
+        latency = min(latency, time.time() - start)
+    return latency
+
+
+def compare_stage_kinds(configurations=(FOREST_STAGES,
+                                        ('boosted', 'boosted', 'boosted')),
+                        cache=None, random_state=0,
+                        filename='models/stage_comparison.csv'):
+    """
+    Args:
+        configurations (list): tuples with the kind of model of the history,
+        behavior rate, and ensemble stages, see stage_model
+        cache (ArtifactCache): where the stage results are cached, defaults
+        to models/cache
+        random_state (int): the seed of the splits
+        filename (str): the csv file to write the comparison to, or None
+    Returns:
+        comparison (pandas dataframe): one row per configuration and stage
+        with the fit time, pickled size, latency and held out accuracies
+    """
+    cache = cache or ArtifactCache()
+    rows = []
+    for stage_kinds in configurations:
+        trained = train_ensemble_stages(cache, random_state,
+                                        stage_kinds=tuple(stage_kinds))
+        split = trained['split']
+        models = trained['models']
+        train_inputs = stage_inputs(trained['train_block'], models)
+        held_out = dict((name, (stage_inputs(
+            V2_SCHEMA.block_from_history(split['held_out'][name][0]),
+            models), split['held_out'][name][1])) for name in HELD_OUT_SETS)
+        all_inputs = stage_inputs(V2_SCHEMA.block_from_history(np.vstack(
+            [split['held_out'][name][0] for name in HELD_OUT_SETS])), models)
+        configuration = '/'.join(stage_kinds)
+        for stage, name in enumerate(STAGES):
+            model = models[stage]
+            row = {'configuration': configuration,
+                   'stage': name,
+                   'kind': stage_kinds[stage],
+                   'fit_seconds': time_fit(model, train_inputs[stage],
+                                           split['y_train']),
+                   'pickled_bytes': len(pickle.dumps(model)),
+                   'latency': time_predict(model, all_inputs[stage])}
+            for held_out_name in HELD_OUT_SETS:
+                inputs, y = held_out[held_out_name]
+                row['{}_accuracy'.format(held_out_name)] = \
+                    np.mean(model.predict(inputs[stage]) == y)
+            rows.append(row)
+    comparison = pd.DataFrame(
+        rows, columns=['configuration', 'stage', 'kind', 'fit_seconds',
+                       'pickled_bytes', 'latency'] +
+        ['{}_accuracy'.format(name) for name in HELD_OUT_SETS])
+    print(comparison)
+    if filename is not None:
+        comparison.to_csv(filename, index=False)
+    return comparison
+
+
+if __name__ == "__main__":
+    compare_stage_kinds([FOREST_STAGES,
+                         ('boosted', 'boosted', 'forest'),
+                         ('boosted', 'boosted', 'boosted')])
@@ -0,0 +1,167 @@
+import numpy as np
+from feature_schema import V2_SCHEMA
+from lightweight_predictor import score_ensemble_block_v2
+
+"""
+This module tracks how the deployed v2 ensemble does on the trickle of hand
+labelled production accounts, without keeping a test matrix in memory
+
+It is a prequential (test then forget) evaluation: every (features, label)
+pair is buffered into a fixed size block, and whenever the block is full it
+is scored in one batch through the live ensemble (so a newly published
+bundle is picked up as it goes live), after which only counts are kept:
+
+    the confusion counts of everything seen so far
+    the confusion counts of the last window pairs, kept up to date with a
+    ring buffer of their labels and predictions
+    the share of every class so far and in the window, which estimates the
+    class priors of production traffic
+
+Memory is the batch block plus two window sized arrays, however long the
+stream runs.
+
+Example:
+    evaluator = PrequentialEvaluator(window=500, batch_size=50)
+    for metrics in evaluator.evaluate_stream(labelled_pairs):
+        print(metrics['window']['recall_1'])
+"""
+
+
+def confusion_metrics(counts):
+    """
+    Args:
+        counts (2d numpy array): 2x2 confusion counts, rows are the labels
+        and columns the predictions
+    Returns:
+        metrics (dict): the accuracy, the precision and recall of both
+        classes, the false positive and false negative rates, and the class
+        priors, where a ratio with nothing to count is nan
+    """
+    counts = counts.astype(float)
+    n = counts.sum()
+    tn, fp, fn, tp = counts.ravel()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {'n': int(n),
+                'accuracy': (tn + tp) / n,
+                'precision_0': tn / (tn + fn),
+                'recall_0': tn / (tn + fp),
+                'precision_1': tp / (tp + fp),
+                'recall_1': tp / (tp + fn),
+                'fpr': fp / (fp + tn),
+                'fnr': fn / (fn + tp),
+                'prior_0': (tn + fp) / n,
+                'prior_1': (fn + tp) / n}
+
+
+class PrequentialEvaluator(object):
+    """
+    this evaluates the deployed ensemble on a stream of labelled account
+    history rows in constant memory
+    """
+    def __init__(self, window=1000, batch_size=100, flat=False,
+                 n_jobs=None):
+        """
+        Args:
+            window (int): the number of most recent pairs the windowed
+            metrics are computed over
+            batch_size (int): the number of pairs scored at once
+            flat (boolean): whether to score with the flat ensemble
+            n_jobs (int): the thread budget of the scoring, see
+            score_ensemble_block_v2
+        Returns:
+            nothing, initializes the evaluator
+        """
+        self.window = window
+        self.batch_size = batch_size
+        self.flat = flat
+        self.n_jobs = n_jobs
+        self.block = V2_SCHEMA.allocate(batch_size)
+        self.labels = np.empty(batch_size, dtype=np.int8)
+        self.n_buffered = 0
+        self.window_labels = np.zeros(window, dtype=np.int8)
+        self.window_preds = np.zeros(window, dtype=np.int8)
+        self.n_seen = 0
+        self.counts = np.zeros((2, 2), dtype=np.int64)
+        self.window_counts = np.zeros((2, 2), dtype=np.int64)
+
+    def update(self, x, label):
+        """
+        Args:
+            x (1d numpy array): the account history features of one account
+            label (int): its label, 1 = fake and 0 = human
+        Returns:
+            scored (boolean): whether the pair filled the batch, so that the
+            batch was scored and the metrics were updated
+        """
+        self.block.history[self.n_buffered] = x
+        self.labels[self.n_buffered] = label
+        self.n_buffered += 1
+        if self.n_buffered < self.batch_size:
+            return False
+        self.flush()
+        return True
+
+    def flush(self):
+        """
+        Args:
+            none
+        Returns:
+            nothing, scores the buffered pairs and folds them into the
+            cumulative and windowed counts
+        """
+        if not self.n_buffered:
+            return
+        batch = self.block.rows(0, self.n_buffered)
+        _, pred = score_ensemble_block_v2(batch, self.flat,
+                                          n_jobs=self.n_jobs)
+        labels = self.labels[:self.n_buffered]
+        pred = np.asarray(pred).astype(np.int8)
+        np.add.at(self.counts, (labels, pred), 1)
+        # only the last window pairs of a batch larger than the window can
+        # still be in it, and they push out everything before them
+        labels = labels[-self.window:]
+        pred = pred[-self.window:]
+        if len(labels) == self.window:
+            self.window_counts[:] = 0
+        else:
+            positions = self.n_seen + np.arange(len(labels))
+            evicted = positions[positions >= self.window] % self.window
+            np.subtract.at(self.window_counts,
+                           (self.window_labels[evicted],
+                            self.window_preds[evicted]), 1)
+        slots = (self.n_seen + self.n_buffered - len(labels) +
+                 np.arange(len(labels))) % self.window
+        self.window_labels[slots] = labels
+        self.window_preds[slots] = pred
+        np.add.at(self.window_counts, (labels, pred), 1)
+        self.n_seen += self.n_buffered
+        self.n_buffered = 0
+
+    def metrics(self):
+        """
+        Args:
+            none
+        Returns:
+            metrics (dict): the metrics of everything scored so far under
+            cumulative and of the last window pairs under window, pairs that
+            are still buffered are not counted yet
+        """
+        return {'n_seen': self.n_seen,
+                'cumulative': confusion_metrics(self.counts),
+                'window': confusion_metrics(self.window_counts)}
+
+    def evaluate_stream(self, pairs):
+        """
+        Args:
+            pairs (iterable): (account history features, label) pairs, i.e.
+            a generator reading hand labelled accounts as they come in
+        Returns:
+            a generator of the metrics after every scored batch, ending
+            with the metrics after the last partial batch
+        """
+        for x, label in pairs:
+            if self.update(x, label):
+                yield self.metrics()
+        if self.n_buffered:
+            self.flush()
+            yield self.metrics()
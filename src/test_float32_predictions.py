@@ -0,0 +1,107 @@
+import random
+import numpy as np
+import pytest
+from sklearn.ensemble import RandomForestClassifier
+import lightweight_predictor
+from feature_schema import V2_SCHEMA
+from model_registry import BundleRegistry, publish_bundle
+
+"""
+This checks that scoring the stacked input in float32 gives the same labels
+as float64, using forests fit on the features of synthetic tweets and
+published as a v2 bundle in a temporary model directory
+
+Run from src with:
+    python -m pytest test_float32_predictions.py
+"""
+
+
+def make_tweet(user_id, rng):
+    """
+    Args:
+        user_id (int): the id of the user
+        rng (random.Random): the source of the random counts
+    Returns:
+        tweet (dict): a json tweet object with the fields the v2 features
+        are extracted from
+    """
+    return {'user': {'id': user_id,
+                     'screen_name': 'user{}'.format(user_id),
+                     'verified': False,
+                     'geo_enabled': rng.random() < .5,
+                     'profile_use_background_image': rng.random() < .5,
+                     'default_profile_image': rng.random() < .5,
+                     'followers_count': rng.randint(0, 5000),
+                     'friends_count': rng.randint(0, 2000),
+                     'listed_count': rng.randint(0, 20),
+                     'statuses_count': rng.randint(1, 50000),
+                     'favourites_count': rng.randint(0, 3000),
+                     'created_at': 'Wed Aug 27 13:08:45 +0000 {}'.format(
+                         rng.randint(2008, 2016))},
+            'text': u'tweet number {} caf\xe9'.format(user_id),
+            'created_at': 'Wed Aug 27 13:08:45 +0000 2016',
+            'favorite_count': rng.randint(0, 5),
+            'retweet_count': rng.randint(0, 5),
+            'entities': {'hashtags': [{}] * rng.randint(0, 3),
+                         'user_mentions': [{}] * rng.randint(0, 2)}}
+
+
+@pytest.fixture
+def tweet_list():
+    """
+    Args:
+        none
+    Returns:
+        tweet_list (list): 600 tweets of 300 synthetic users
+    """
+    rng = random.Random(0)
+    users = [make_tweet(user_id, rng) for user_id in range(300)]
+    return [users[rng.randrange(len(users))] for _ in range(600)]
+
+
+@pytest.fixture
+def v2_bundle(tmpdir, monkeypatch, tweet_list):
+    """
+    Args:
+        tmpdir: the pytest temporary directory the bundle is published in
+        monkeypatch: points lightweight_predictor at that bundle
+        tweet_list (list): the tweets the forests are fit on
+    Returns:
+        nothing, publishes forests fit on the tweets, labelled fake when
+        they have more friends than followers, as the live v2 bundle
+    """
+    block = lightweight_predictor.featurize_tweets_v2(tweet_list)
+    block.fill_behavior_rates()
+    friends = V2_SCHEMA.features.index('friends_count')
+    followers = V2_SCHEMA.features.index('followers_count')
+    y = (block.history[:, friends] > block.history[:, followers]).astype(int)
+    model = RandomForestClassifier(20, random_state=0)
+    model.fit(block.history, y)
+    modelb = RandomForestClassifier(20, random_state=1)
+    modelb.fit(block.behavior, y)
+    block.set_base_probas(model.predict_proba(block.history)[:, 1],
+                          modelb.predict_proba(block.behavior)[:, 1])
+    model_ens = RandomForestClassifier(30, random_state=2)
+    model_ens.fit(block.matrix, y)
+    publish_bundle(lightweight_predictor.V2_BUNDLE,
+                   (model, modelb, model_ens), V2_SCHEMA,
+                   model_dir=str(tmpdir))
+    monkeypatch.setattr(lightweight_predictor, 'bundles',
+                        BundleRegistry(model_dir=str(tmpdir)))
+
+
+def test_float32_predictions_match_float64(v2_bundle, tweet_list):
+    """
+    Args:
+        v2_bundle: the live synthetic v2 bundle
+        tweet_list (list): the tweets to predict
+    Returns:
+        nothing, asserts that both dtypes label every tweet the same
+    """
+    predicted_64 = lightweight_predictor.make_lightweight_predictions_v2(
+        tweet_list, dtype=np.float64)
+    predicted_32 = lightweight_predictor.make_lightweight_predictions_v2(
+        tweet_list, dtype=np.float32)
+    assert len(predicted_64) == len(tweet_list)
+    assert predicted_64['pred'].nunique() == 2
+    assert (predicted_64['pred'].values == predicted_32['pred'].values).all()
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+try:
+    import joblib
+except ImportError:
+    from sklearn.externals import joblib
+
+"""
+This module caches the intermediate results of training the random forest
+ensemble on disk, so that re-running the training only recomputes the stages
+whose inputs changed
+
+Every stage result is stored under a key made from the name of the stage and
+a sha256 digest of everything the stage depends on: the contents of the
+files it reads, its parameters (i.e. the hyperparameter grid of a forest),
+and the keys of the stages it builds on. A change anywhere therefore gives
+new keys to that stage and to every stage downstream of it, and leaves the
+keys, and the cached results, of the other stages alone. Changing the grid
+of the ensemble model, for example, refits only the ensemble model.
+
+The keys do not cover the code of a stage, so after changing how a stage is
+computed or what its result holds, bump its format version in
+STAGE_VERSIONS, which is part of its key: results of the old code are then
+never loaded again, and neither are those of the stages downstream of it.
+A stage that is not listed is at version 1.
+
+Given a TrainingProfiler, the cache also records the time and memory of
+every stage it computes or loads, see training_profiler.
+
+Example:
+    cache = ArtifactCache()
+    frames_key, frames = cache.cached('frames', [file_digest(filename)],
+                                      lambda: load_frames(filename))
+    model_key, model = cache.cached('history_model', [frames_key, paramgrid],
+                                    lambda: fit(frames, paramgrid))
+"""
+
+
+STAGE_VERSIONS = {'split': 2, 'stacked': 2}
+
+
+def file_digest(filename):
+    """
+    Args:
+        filename (str): the file to hash
+    Returns:
+        digest (str): the sha256 hex digest of the contents of the file
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def params_digest(parts):
+    """
+    Args:
+        parts (list): json serializable parameters and upstream keys
+    Returns:
+        digest (str): the sha256 hex digest of the parts, which does not
+        depend on the order of the keys of any dictionary in them
+    """
+    encoded = json.dumps(parts, sort_keys=True, default=repr)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+class ArtifactCache(object):
+    """
+    this stores the result of every training stage in a joblib file named
+    after the stage and the digest of its inputs
+    """
+    def __init__(self, cache_dir='models/cache', verbose=True,
+                 profiler=None):
+        """
+        Args:
+            cache_dir (str): the directory the stage results are kept in
+            verbose (boolean): whether to print which stages are loaded
+            from the cache and which are computed
+            profiler (TrainingProfiler): records every stage, if given
+        Returns:
+            nothing, initializes the cache
+        """
+        self.cache_dir = cache_dir
+        self.verbose = verbose
+        self.profiler = profiler
+
+    def key(self, stage, parts):
+        """
+        Args:
+            stage (str): the name of the stage
+            parts (list): everything the stage result depends on
+        Returns:
+            key (str): the key the stage result is stored under, which also
+            covers the format version of the stage past the first
+        """
+        if STAGE_VERSIONS.get(stage, 1) > 1:
+            parts = [parts, {'version': STAGE_VERSIONS[stage]}]
+        return '{}-{}'.format(stage, params_digest(parts)[:16])
+
+    def filename(self, key):
+        """
+        Args:
+            key (str): the key of a stage result
+        Returns:
+            filename (str): the file the stage result is stored in
+        """
+        return os.path.join(self.cache_dir, key + '.joblib')
+
+    def cached(self, stage, parts, compute):
+        """
+        Args:
+            stage (str): the name of the stage
+            parts (list): everything the stage result depends on, including
+            the keys of the upstream stages
+            compute (function): computes the stage result when it is not
+            cached yet
+        Returns:
+            key (str): the key of the stage result, to pass on to the
+            stages that depend on it
+            result: the stage result, loaded from the cache if it was
+            computed before with the same inputs
+        """
+        key = self.key(stage, parts)
+        filename = self.filename(key)
+        hit = os.path.exists(filename)
+        if self.profiler is None:
+            return key, self._load_or_compute(key, filename, hit, compute)
+        with self.profiler.stage(stage, key=key, cached=hit):
+            return key, self._load_or_compute(key, filename, hit, compute)
+
+    def _load_or_compute(self, key, filename, hit, compute):
+        """
+        Args:
+            key (str): the key of the stage result
+            filename (str): the file the stage result is stored in
+            hit (boolean): whether the file exists
+            compute (function): computes the stage result
+        Returns:
+            result: the stage result
+        """
+        if hit:
+            if self.verbose:
+                print('loading {} from the cache'.format(key))
+            return joblib.load(filename)
+        if self.verbose:
+            print('computing {}'.format(key))
+        result = compute()
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        # write to a temporary file first so that an interrupted run never
+        # leaves a partial result behind
+        tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        joblib.dump(result, tmp_filename)
+        os.rename(tmp_filename, filename)
+        return result
+
+    def clear(self, stage=None):
+        """
+        Args:
+            stage (str): only remove the results of this stage, or every
+            result if None
+        Returns:
+            nothing, deletes the cached results
+        """
+        if not os.path.isdir(self.cache_dir):
+            return
+        for filename in os.listdir(self.cache_dir):
+            if stage is None or filename.startswith(stage + '-'):
+                os.remove(os.path.join(self.cache_dir, filename))
@@ -0,0 +1,213 @@
+import contextlib
+import json
+import os
+import sys
+import time
+import dill as pickle
+try:
+    import resource
+except ImportError:
+    resource = None
+
+"""
+This module profiles where the time and memory of training go
+
+Every stage of a training run (loading the data, resampling, the grid
+searches, fitting, pickling) is wrapped in profiler.stage(name), which
+records its wall time, its cpu time including the cpu time of finished
+worker processes, and the peak resident memory of the process during the
+stage. On linux the peak is reset at the start of every stage, so it is the
+peak of that stage alone; elsewhere it is the peak of the process so far.
+Stages should therefore not be nested.
+record_model adds the size of every trained model in memory and on disk,
+and write saves all of it as a json report next to the models, so that
+reports of successive training runs can be diffed to catch regressions.
+
+Example:
+    profiler = TrainingProfiler()
+    with profiler.stage('fit'):
+        model.fit(X, y)
+    profiler.record_model('model', model, 'models/model.pkl')
+    profiler.write('models/model_profile.json')
+"""
+
+
+def cpu_seconds():
+    """
+    Args:
+        none
+    Returns:
+        seconds (float): the user and system cpu time of this process and of
+        its finished child processes
+    """
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def reset_peak_rss():
+    """
+    Args:
+        none
+    Returns:
+        reset (boolean): whether the peak resident memory of the process
+        could be reset, which needs linux
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def peak_rss():
+    """
+    Args:
+        none
+    Returns:
+        peak (int): the peak resident memory of the process in bytes, since
+        the last reset_peak_rss on linux, or None if it cannot be measured
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macos reports bytes, linux reports kilobytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def model_nbytes(model):
+    """
+    Args:
+        model (sklearn classifier model): a fit model
+    Returns:
+        nbytes (int): the bytes of the node arrays of the trees of a forest
+        or tree, or the pickled size of any other model
+    """
+    trees = getattr(model, 'estimators_', None)
+    if trees is None and hasattr(model, 'tree_'):
+        trees = [model]
+    try:
+        states = [tree.tree_.__getstate__() for tree in trees]
+        return sum(state['nodes'].nbytes + state['values'].nbytes
+                   for state in states)
+    except (AttributeError, KeyError, TypeError):
+        return len(pickle.dumps(model))
+
+
+class TrainingProfiler(object):
+    """
+    this collects the time and memory of every stage of a training run and
+    the size of the models it produces
+    """
+    def __init__(self):
+        """
+        Args:
+            none
+        Returns:
+            nothing, initializes the profiler
+        """
+        self.started = time.time()
+        self.stages = []
+        self.models = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, **details):
+        """
+        Args:
+            name (str): the name of the stage, a stage that runs more than
+            once gets one entry per run
+            details: anything else to record with the stage (i.e. whether
+            it was loaded from the cache)
+        Returns:
+            a context manager that records the stage when it exits, also
+            when it raises
+        """
+        reset = reset_peak_rss()
+        wall_start = time.time()
+        cpu_start = cpu_seconds()
+        try:
+            yield self
+        finally:
+            wall = time.time() - wall_start
+            cpu = cpu_seconds() - cpu_start
+            self.stages.append(dict(details,
+                                    stage=name,
+                                    start=wall_start - self.started,
+                                    wall_seconds=wall,
+                                    cpu_seconds=cpu,
+                                    peak_rss_bytes=peak_rss(),
+                                    peak_is_per_stage=reset))
+
+    def record_model(self, name, model, filename=None):
+        """
+        Args:
+            name (str): the name of the model
+            model (sklearn classifier model): the fit model
+            filename (str): the file the model was written to, if any
+        Returns:
+            nothing, records the size of the model in memory and on disk,
+            and the name of its file, which sits next to the report
+        """
+        self.models[name] = {
+            'type': type(model).__name__,
+            'memory_bytes': model_nbytes(model),
+            'file': filename and os.path.basename(filename),
+            'file_bytes': os.path.getsize(filename)
+            if filename and os.path.exists(filename) else None}
+
+    def report(self):
+        """
+        Args:
+            none
+        Returns:
+            report (dict): the stages in the order they finished, the
+            models, and the totals of the run
+        """
+        return {'started': self.started,
+                'wall_seconds': time.time() - self.started,
+                'cpu_seconds': sum(stage['cpu_seconds']
+                                   for stage in self.stages),
+                'peak_rss_bytes': max([stage['peak_rss_bytes'] for stage in
+                                       self.stages
+                                       if stage['peak_rss_bytes']] or
+                                      [None]),
+                'stages': self.stages,
+                'models': self.models}
+
+    def summary(self):
+        """
+        Args:
+            none
+        Returns:
+            nothing, prints the wall time, cpu time and peak memory of
+            every stage
+        """
+        for stage in self.stages:
+            print('{:<24} {:>10.2f}s wall {:>10.2f}s cpu {:>10} peak '
+                  'rss'.format(stage['stage'], stage['wall_seconds'],
+                               stage['cpu_seconds'],
+                               stage['peak_rss_bytes']))
+
+    def write(self, filename):
+        """
+        Args:
+            filename (str): the json file to write the report to
+        Returns:
+            report (dict): the report that was written
+        """
+        report = self.report()
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmp_filename, 'w') as f:
+            json.dump(report, f, indent=2, default=repr)
+        os.rename(tmp_filename, filename)
+        return report